@@ -0,0 +1,167 @@
+"""
+Handling of the persistent cache of the LLM article analyses
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import hashlib
+import json
+import logging
+import threading
+import typing
+
+import json_files
+import metrics
+import near_duplicates as near_duplicates_module
+import user_preferences_handler
+
+IntrinsicAnalysisDict: typing.TypeAlias = dict[str, typing.Union[list[str], typing.Optional[float]]]
+
+def hash_article(formatted_article: str) -> str:
+    """
+    Returns the hash identifying the article content as it is shown to the LLM
+    """
+    return hashlib.sha256(formatted_article.encode("utf-8")).hexdigest()
+
+def fingerprint_preferences(user_preferences: user_preferences_handler.UserPreferences) -> str:
+    """
+    Returns the fingerprint of the part of the user preferences shown to the LLM (the interest scores)
+    """
+    interests = {theme: score_information.score for theme, score_information in user_preferences.interests.items()}
+    return hashlib.sha256(json.dumps(interests, sort_keys=True).encode("utf-8")).hexdigest()
+
+@dataclass
+class CachedAnalysis:
+    """
+    A data structure class for storing what is known about an article from previous analyses
+    """
+    intrinsic: typing.Optional[IntrinsicAnalysisDict]
+    main_themes_alignment: typing.Optional[float]
+    def __init__(self, intrinsic: typing.Optional[IntrinsicAnalysisDict], main_themes_alignment: typing.Optional[float]):
+        self.intrinsic = intrinsic
+        self.main_themes_alignment = main_themes_alignment
+
+class AnalysisCache:
+    """
+    A persistent cache of the LLM analyses
+
+    The preference-independent part of an analysis (themes, fluffiness, title descriptiveness) is keyed by the model and the article hash,
+    the theme alignment additionally by the fingerprint of the user interests, so that only the alignment has to be recomputed when the interests change.
+    The cache is stored as an append-only JSON lines file.
+    With a near-duplicate index the analyses of near-duplicate texts (e.g. the same wire story republished on many sites) are reused, see `resolve_article_hash`.
+    """
+    def __init__(self, cache_path: str, near_duplicates: typing.Optional[near_duplicates_module.NearDuplicateIndex] = None):
+        self.cache_path = cache_path
+        self.near_duplicates = near_duplicates
+        self.near_duplicate_hits = 0
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._intrinsic: dict[str, IntrinsicAnalysisDict] = {}
+        self._alignment: dict[str, float] = {}
+        self._load()
+
+    def get(self, model_name: str, article_hash: str, preferences_fingerprint: str) -> CachedAnalysis:
+        """
+        Returns the cached parts of the analysis, with None for the parts that are not cached
+        """
+        with self._lock:
+            intrinsic = self._intrinsic.get(AnalysisCache._intrinsic_key(model_name, article_hash))
+            alignment = self._alignment.get(AnalysisCache._alignment_key(model_name, article_hash, preferences_fingerprint))
+            if intrinsic is not None and alignment is not None:
+                self.hits += 1
+                metrics.increment("analysis_cache_hits_total")
+            elif intrinsic is not None:
+                self.partial_hits += 1
+                metrics.increment("analysis_cache_partial_hits_total")
+            else:
+                self.misses += 1
+                metrics.increment("analysis_cache_misses_total")
+            return CachedAnalysis(None if intrinsic is None else dict(intrinsic), alignment)
+
+    def get_intrinsic(self, model_name: str, article_hash: str) -> typing.Optional[IntrinsicAnalysisDict]:
+        """
+        Returns the cached preference-independent part of the analysis, or None if it is not cached
+        """
+        with self._lock:
+            intrinsic = self._intrinsic.get(AnalysisCache._intrinsic_key(model_name, article_hash))
+            if intrinsic is None:
+                self.misses += 1
+                metrics.increment("analysis_cache_misses_total")
+                return None
+            self.hits += 1
+            metrics.increment("analysis_cache_hits_total")
+            return dict(intrinsic)
+
+    def get_alignment(self, model_name: str, article_hash: str, preferences_fingerprint: str) -> typing.Optional[float]:
+        """
+        Returns the cached theme alignment for the given user interests, or None if it is not cached
+        """
+        with self._lock:
+            return self._alignment.get(AnalysisCache._alignment_key(model_name, article_hash, preferences_fingerprint))
+
+    def put_intrinsic(self, model_name: str, article_hash: str, intrinsic: IntrinsicAnalysisDict):
+        """
+        Stores the preference-independent part of an analysis
+        """
+        key = AnalysisCache._intrinsic_key(model_name, article_hash)
+        with self._lock:
+            self._intrinsic[key] = intrinsic
+            self._append({"kind": "intrinsic", "key": key, "value": intrinsic})
+
+    def put_alignment(self, model_name: str, article_hash: str, preferences_fingerprint: str, main_themes_alignment: float):
+        """
+        Stores the theme alignment of an article for the given user interests
+        """
+        key = AnalysisCache._alignment_key(model_name, article_hash, preferences_fingerprint)
+        with self._lock:
+            self._alignment[key] = main_themes_alignment
+            self._append({"kind": "alignment", "key": key, "value": main_themes_alignment})
+
+    def resolve_article_hash(self, model_name: str, article_hash: str, text: str) -> str:
+        """
+        Returns the hash the article should be looked up and stored by: the hash of an already analysed near-duplicate of the text if there is one,
+        its own hash otherwise (or if there is no near-duplicate index). Articles without a near-duplicate are added to the index.
+        """
+        if self.near_duplicates is None:
+            return article_hash
+        with self._lock:
+            if AnalysisCache._intrinsic_key(model_name, article_hash) in self._intrinsic:
+                return article_hash
+        signature = self.near_duplicates.signature(text)
+        if signature is None:
+            return article_hash
+        for duplicate_hash, similarity in self.near_duplicates.find(signature):
+            with self._lock:
+                is_analysed = AnalysisCache._intrinsic_key(model_name, duplicate_hash) in self._intrinsic
+                if is_analysed:
+                    self.near_duplicate_hits += 1
+            if is_analysed and duplicate_hash != article_hash:
+                metrics.increment("analysis_cache_near_duplicate_hits_total")
+                logging.info(f"Reusing the analysis of a {similarity:.0%} similar article")
+                return duplicate_hash
+        self.near_duplicates.add(article_hash, signature)
+        return article_hash
+
+    @staticmethod
+    def _intrinsic_key(model_name: str, article_hash: str) -> str:
+        return f"{model_name}|{article_hash}"
+
+    @staticmethod
+    def _alignment_key(model_name: str, article_hash: str, preferences_fingerprint: str) -> str:
+        return f"{model_name}|{article_hash}|{preferences_fingerprint}"
+
+    def _append(self, record: dict[str, typing.Any]):
+        try:
+            json_files.append_json_line(self.cache_path, record)
+        except OSError as e:
+            logging.error(f"Error: Failed to save the analysis to the cache '{self.cache_path}': {e}")
+
+    def _load(self):
+        for record in json_files.read_json_lines(self.cache_path, "analysis cache"):
+            if record.get("kind") == "intrinsic":
+                self._intrinsic[record["key"]] = record["value"]
+            elif record.get("kind") == "alignment":
+                self._alignment[record["key"]] = record["value"]
@@ -4,13 +4,26 @@ Handling the article analysis
 
 from dataclasses import dataclass
 import json
+import logging
 import typing
-import google.generativeai
+import numpy
+import analysis_cache as analysis_cache_module
+import llm_backend
+import llm_response
+import metrics
+import prompts
+import prompt_builder as prompt_builder_module
 import user_preferences_handler
 import user_preferences_models
 import fetch_article
+import page_cache as page_cache_module
+import theme_alignment
 import constants
 
+# The power mean of the scores is taken over shifted scores so that a single zero does not zero the whole mean
+SCORE_SHIFT = 0.1
+POWER_MEAN_EXPONENT = 0.25
+
 @dataclass
 class ArticleAnalysis:
     """
@@ -23,53 +36,312 @@ class ArticleAnalysis:
 
     title: str
     hostname: str
-    def __init__(self, raw_analysis: str, title: str, hostname: str):
-        analysis = json.loads(raw_analysis)
+    prompt_tokens: typing.Optional[int]
+    def __init__(self, raw_analysis: str, title: str, hostname: str, prompt_tokens: typing.Optional[int] = None):
+        with metrics.span("parse_analysis"):
+            analysis = json.loads(raw_analysis)
         self.main_themes = analysis.get("main_themes")
         self.main_themes_alignment = analysis.get("main_themes_alignment")
         self.how_fluffy = analysis.get("how_fluffy")
         self.how_descriptive_title = analysis.get("how_descriptive_title")
         self.title = "unknown" if title is None else title
         self.hostname = "unknown" if hostname is None else hostname
+        self.prompt_tokens = prompt_tokens
 
         if self.main_themes is None:
             self.main_themes = []
 
+    def to_dict(self) -> dict[str, typing.Union[str, list[str], typing.Optional[float]]]:
+        """
+        Converts the class to a JSON serializable dictionary
+        """
+        return {
+            "title": self.title,
+            "hostname": self.hostname,
+            "main_themes": self.main_themes,
+            "main_themes_alignment": self.main_themes_alignment,
+            "how_fluffy": self.how_fluffy,
+            "how_descriptive_title": self.how_descriptive_title,
+            "prompt_tokens": self.prompt_tokens
+        }
+
+    def intrinsic_to_dict(self) -> analysis_cache_module.IntrinsicAnalysisDict:
+        """
+        Converts the preference-independent part of the analysis to a JSON serializable dictionary
+        """
+        return {
+            "main_themes": self.main_themes,
+            "how_fluffy": self.how_fluffy,
+            "how_descriptive_title": self.how_descriptive_title
+        }
+
 @dataclass
 class ArticleScores:
     """
-    A data structure class for storing the article scores
+    A data structure class for storing the article scores, None for the scores that could not be computed because the LLM did not provide the raw score
     """
-    main_themes_alignment: float
-    fluffiness_alignment: float
-    title_descriptiveness: float
-    overall: float
-    def __init__(self, main_themes_alignment: float, fluffiness_alignment: float, title_descriptiveness: float, overall: float):
+    main_themes_alignment: typing.Optional[float]
+    fluffiness_alignment: typing.Optional[float]
+    title_descriptiveness: typing.Optional[float]
+    overall: typing.Optional[float]
+    def __init__(self, main_themes_alignment: typing.Optional[float], fluffiness_alignment: typing.Optional[float], title_descriptiveness: typing.Optional[float], overall: typing.Optional[float]):
         self.main_themes_alignment = main_themes_alignment
         self.fluffiness_alignment = fluffiness_alignment
         self.title_descriptiveness = title_descriptiveness
         self.overall = overall
 
-def analyse_article(model: google.generativeai.GenerativeModel, url: str, user_preferences: user_preferences_handler.UserPreferences) -> typing.Optional[ArticleAnalysis]:
+    def to_dict(self) -> dict[str, typing.Optional[float]]:
+        """
+        Converts the class to a JSON serializable dictionary
+        """
+        return {
+            "main_themes_alignment": self.main_themes_alignment,
+            "fluffiness_alignment": self.fluffiness_alignment,
+            "title_descriptiveness": self.title_descriptiveness,
+            "overall": self.overall
+        }
+
+def format_score(score: typing.Optional[float]) -> str:
+    """
+    Formats a score for display, "n/a" for the scores the LLM did not provide
+    """
+    return "n/a" if score is None else f"{score:.1f}"
+
+@dataclass
+class RankedArticle:
+    """
+    A data structure class for storing a rated article together with the index of its analysis in the rated list
+    """
+    index: int
+    analysis: ArticleAnalysis
+    scores: ArticleScores
+    def __init__(self, index: int, analysis: ArticleAnalysis, scores: ArticleScores):
+        self.index = index
+        self.analysis = analysis
+        self.scores = scores
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        """
+        Converts the class to a JSON serializable dictionary
+        """
+        return {
+            "index": self.index,
+            "analysis": self.analysis.to_dict(),
+            "scores": self.scores.to_dict()
+        }
+
+@dataclass
+class PackedAnalyses:
+    """
+    A data structure class for storing the analyses of a pack of articles in the order of the articles, and whether an LLM request was sent for them
+    """
+    analyses: list[typing.Optional[ArticleAnalysis]]
+    requested: bool
+    def __init__(self, analyses: list[typing.Optional[ArticleAnalysis]], requested: bool):
+        self.analyses = analyses
+        self.requested = requested
+
+@dataclass
+class AnalysisContext:
+    """
+    A data structure class for storing what the analyses are made with: the LLM backend, the cache whose parts of previous analyses are reused (if any),
+    the prompt builder keeping the prompts within its token budget and the response reader validating the replies (the default ones if none are given)
+    """
+    backend: llm_backend.LLMBackend
+    analysis_cache: typing.Optional[analysis_cache_module.AnalysisCache]
+    prompt_builder: prompt_builder_module.PromptBuilder
+    response_reader: llm_response.ResponseReader
+    def __init__(self, backend: llm_backend.LLMBackend, analysis_cache: typing.Optional[analysis_cache_module.AnalysisCache] = None,
+                 prompt_builder: typing.Optional[prompt_builder_module.PromptBuilder] = None, response_reader: typing.Optional[llm_response.ResponseReader] = None):
+        self.backend = backend
+        self.analysis_cache = analysis_cache
+        self.prompt_builder = prompt_builder if prompt_builder is not None else prompt_builder_module.PromptBuilder()
+        self.response_reader = response_reader if response_reader is not None else llm_response.ResponseReader()
+
+def analyse_article(context: AnalysisContext, url: str, user_preferences: user_preferences_handler.UserPreferences, page_cache: typing.Optional[page_cache_module.PageCache] = None,
+                    split_analysis: bool = False) -> typing.Optional[ArticleAnalysis]:
     """
     Uses an LLM to generate raw scores about the article
     """
-    metadata = fetch_article.extract_article_metadata(fetch_article.fetch_article(url))
+    metadata = fetch_article.extract_article_metadata(fetch_article.fetch_article(url, page_cache), page_cache)
     if metadata is None:
         return None
-    prompt = metadata.format_for_llm() + "\n" + user_preferences.format_for_llm()
-    response = model.generate_content(prompt)
-    response_text = response.text.strip().removeprefix("```json").removeprefix("```").removeprefix("`").removesuffix("```").removesuffix("`").strip()
-    return ArticleAnalysis(response_text, metadata.title, metadata.hostname)
+    try:
+        return analyse_metadata(context, metadata, user_preferences, split_analysis)
+    except (llm_response.MalformedResponseError, llm_backend.ReplayMissError) as e:
+        logging.error(f"Error: Failed to analyse '{url}': {e}")
+        return None
+
+def analyse_metadata(context: AnalysisContext, metadata: fetch_article.ArticleMetadata, user_preferences: user_preferences_handler.UserPreferences, split_analysis: bool = False) -> ArticleAnalysis:
+    """
+    Uses an LLM to generate raw scores about an already fetched and extracted article, reusing the cached parts of previous analyses if the context has an analysis cache.
+    With `split_analysis` the article is analysed without the user preferences and the alignment is computed separately, see `analyse_metadata_for_users`.
+    Raises `llm_response.MalformedResponseError` if the LLM does not provide a valid analysis
+    and `llm_backend.ReplayMissError` if a replaying backend has no recorded response for one of the prompts.
+    """
+    if split_analysis:
+        return analyse_metadata_for_users(context, metadata, [user_preferences])[0]
+    prompt = context.prompt_builder.build(metadata, user_preferences)
+    if context.analysis_cache is None:
+        return ArticleAnalysis(generate_analysis(context, prompt), metadata.title, metadata.hostname, prompt.estimated_tokens)
+
+    # The article is keyed by what is actually sent, so that changing the budget does not reuse analyses of differently trimmed text
+    article_hash = context.analysis_cache.resolve_article_hash(context.backend.model_name, analysis_cache_module.hash_article(prompt.article), metadata.text)
+    preferences_fingerprint = analysis_cache_module.fingerprint_preferences(user_preferences)
+    cached = context.analysis_cache.get(context.backend.model_name, article_hash, preferences_fingerprint)
+    if cached.intrinsic is None:
+        analysis = ArticleAnalysis(generate_analysis(context, prompt), metadata.title, metadata.hostname, prompt.estimated_tokens)
+        store_analysis(context.analysis_cache, context.backend.model_name, article_hash, preferences_fingerprint, analysis)
+        return analysis
+    return analysis_from_cache(context, metadata, cached, user_preferences, article_hash)
+
+def analyse_metadata_packed(context: AnalysisContext, metadatas: list[fetch_article.ArticleMetadata], user_preferences: user_preferences_handler.UserPreferences) -> PackedAnalyses:
+    """
+    Analyses several articles with a single LLM request, returning the analyses in the order of the articles.
+    The articles with cached analyses are not sent (no request at all is sent if all of them are cached). None is returned for the articles missing from the reply (or with invalid fields in it)
+    and for all the sent articles if the request fails, they are expected to be analysed on their own with `analyse_metadata`.
+    """
+    analysis_cache = context.analysis_cache
+    model_name = context.backend.model_name
+    analyses: list[typing.Optional[ArticleAnalysis]] = [None] * len(metadatas)
+    article_prompts = [context.prompt_builder.build(metadata, user_preferences) for metadata in metadatas]
+    article_hashes = [analysis_cache_module.hash_article(prompt.article) for prompt in article_prompts]
+    if analysis_cache is not None:
+        article_hashes = [analysis_cache.resolve_article_hash(model_name, article_hash, metadata.text) for article_hash, metadata in zip(article_hashes, metadatas)]
+    preferences_fingerprint = analysis_cache_module.fingerprint_preferences(user_preferences)
+    to_generate = []
+    for index, metadata in enumerate(metadatas):
+        if analysis_cache is not None:
+            cached = analysis_cache.get(model_name, article_hashes[index], preferences_fingerprint)
+            if cached.intrinsic is not None:
+                analyses[index] = analysis_from_cache(context, metadata, cached, user_preferences, article_hashes[index])
+                continue
+        to_generate.append(index)
+    if len(to_generate) == 0:
+        return PackedAnalyses(analyses, False)
+
+    interests, interests_included = context.prompt_builder.format_interests(user_preferences, "\n".join(f"{metadatas[index].title}\n{metadatas[index].text}" for index in to_generate))
+    articles = "\n\n".join(f"Article {number}:\n{article_prompts[index].article}" for number, index in enumerate(to_generate, 1))
+    prompt = f"{articles}\n\nUser interests: {interests}"
+    prompt_tokens = prompt_builder_module.estimate_tokens(prompt)
+    logging.info(f"Packed prompt of ~{prompt_tokens} tokens for {len(to_generate)} articles ({interests_included}/{len(user_preferences.interests)} interests)")
+    try:
+        replies = context.response_reader.generate_many(context.backend, prompt, llm_response.ANALYSIS_FIELDS, len(to_generate), prompts.PACKED_SYSTEM_INSTRUCTION)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        logging.warning(f"Warning: The packed request for {len(to_generate)} articles failed: {e}")
+        return PackedAnalyses(analyses, True)
+    for index, reply in zip(to_generate, replies):
+        if reply is None:
+            continue
+        # The shared request is split evenly between its articles
+        analysis = ArticleAnalysis(json.dumps(reply), metadatas[index].title, metadatas[index].hostname, prompt_tokens // len(to_generate))
+        analyses[index] = analysis
+        if analysis_cache is not None:
+            store_analysis(analysis_cache, model_name, article_hashes[index], preferences_fingerprint, analysis)
+    return PackedAnalyses(analyses, True)
+
+def store_analysis(analysis_cache: analysis_cache_module.AnalysisCache, model_name: str, article_hash: str, preferences_fingerprint: str, analysis: ArticleAnalysis):
+    """
+    Stores both parts of a full analysis in the cache
+    """
+    analysis_cache.put_intrinsic(model_name, article_hash, analysis.intrinsic_to_dict())
+    if analysis.main_themes_alignment is not None:
+        analysis_cache.put_alignment(model_name, article_hash, preferences_fingerprint, analysis.main_themes_alignment)
+
+def analysis_from_cache(context: AnalysisContext, metadata: fetch_article.ArticleMetadata, cached: analysis_cache_module.CachedAnalysis, user_preferences: user_preferences_handler.UserPreferences,
+                        article_hash: str) -> ArticleAnalysis:
+    """
+    Builds the analysis from its cached parts (the preference-independent part has to be cached), asking the LLM only for the alignment if it is not cached
+    """
+    intrinsic = typing.cast(analysis_cache_module.IntrinsicAnalysisDict, cached.intrinsic)
+    main_themes_alignment = cached.main_themes_alignment
+    if main_themes_alignment is None:
+        main_themes_alignment = resolve_alignment(context, metadata, intrinsic, user_preferences, article_hash)
+    return ArticleAnalysis(json.dumps({**intrinsic, "main_themes_alignment": main_themes_alignment}), metadata.title, metadata.hostname)
+
+def analyse_metadata_for_users(context: AnalysisContext, metadata: fetch_article.ArticleMetadata, users_preferences: list[user_preferences_handler.UserPreferences]) -> list[ArticleAnalysis]:
+    """
+    Analyses the article once without any user preferences and then computes the theme alignment for each of the users,
+    locally from the main themes where possible and with a short prompt without the article text otherwise.
+    Returns the analyses in the order of the given preferences.
+    """
+    analysis_cache = context.analysis_cache
+    model_name = context.backend.model_name
+    prompt = context.prompt_builder.build(metadata)
+    article_hash = analysis_cache_module.hash_article(prompt.article)
+    intrinsic = None
+    prompt_tokens = None
+    if analysis_cache is not None:
+        article_hash = analysis_cache.resolve_article_hash(model_name, article_hash, metadata.text)
+        intrinsic = analysis_cache.get_intrinsic(model_name, article_hash)
+    if intrinsic is None:
+        intrinsic = generate_intrinsic_analysis(context, prompt)
+        prompt_tokens = prompt.estimated_tokens
+        if analysis_cache is not None:
+            analysis_cache.put_intrinsic(model_name, article_hash, intrinsic)
+
+    analyses = []
+    for user_preferences in users_preferences:
+        main_themes_alignment = None
+        if analysis_cache is not None:
+            main_themes_alignment = analysis_cache.get_alignment(model_name, article_hash, analysis_cache_module.fingerprint_preferences(user_preferences))
+        if main_themes_alignment is None:
+            main_themes_alignment = theme_alignment.align_themes(typing.cast(list[str], intrinsic.get("main_themes") or []), user_preferences)
+        if main_themes_alignment is None:
+            main_themes_alignment = resolve_alignment(context, metadata, intrinsic, user_preferences, article_hash)
+        analyses.append(ArticleAnalysis(json.dumps({**intrinsic, "main_themes_alignment": main_themes_alignment}), metadata.title, metadata.hostname, prompt_tokens))
+    return analyses
+
+def resolve_alignment(context: AnalysisContext, metadata: fetch_article.ArticleMetadata, intrinsic: analysis_cache_module.IntrinsicAnalysisDict, user_preferences: user_preferences_handler.UserPreferences,
+                      article_hash: str) -> typing.Optional[float]:
+    """
+    Asks the LLM for the theme alignment of an article whose preference-independent analysis is known, storing the alignment in the cache
+    """
+    main_themes = typing.cast(list[str], intrinsic.get("main_themes") or [])
+    main_themes_alignment = analyse_alignment(context, metadata.title, main_themes, user_preferences)
+    if main_themes_alignment is not None and context.analysis_cache is not None:
+        preferences_fingerprint = analysis_cache_module.fingerprint_preferences(user_preferences)
+        context.analysis_cache.put_alignment(context.backend.model_name, article_hash, preferences_fingerprint, main_themes_alignment)
+    return main_themes_alignment
+
+def generate_analysis(context: AnalysisContext, prompt: prompt_builder_module.BuiltPrompt) -> str:
+    """
+    Asks the LLM for the full analysis of the article, returning the validated analysis as JSON
+    """
+    logging.info(prompt.describe())
+    return json.dumps(context.response_reader.generate(context.backend, prompt.text, llm_response.ANALYSIS_FIELDS, prompts.SYSTEM_INSTRUCTION))
+
+def generate_intrinsic_analysis(context: AnalysisContext, prompt: prompt_builder_module.BuiltPrompt) -> analysis_cache_module.IntrinsicAnalysisDict:
+    """
+    Asks the LLM for the preference-independent part of the analysis of the article
+    """
+    logging.info(prompt.describe())
+    analysis = context.response_reader.generate(context.backend, prompt.text, llm_response.INTRINSIC_FIELDS, prompts.INTRINSIC_SYSTEM_INSTRUCTION)
+    return {
+        "main_themes": typing.cast(list[str], analysis["main_themes"]),
+        "how_fluffy": typing.cast(float, analysis["how_fluffy"]),
+        "how_descriptive_title": typing.cast(float, analysis["how_descriptive_title"])
+    }
+
+def analyse_alignment(context: AnalysisContext, title: str, main_themes: list[str], user_preferences: user_preferences_handler.UserPreferences) -> typing.Optional[float]:
+    """
+    Uses an LLM to rate only the theme alignment of an article from its already known main themes, without sending the article text
+    """
+    prompt = context.prompt_builder.build_alignment(title, main_themes, user_preferences)
+    logging.info(prompt.describe())
+    analysis = context.response_reader.generate(context.backend, prompt.text, llm_response.ALIGNMENT_FIELDS, prompts.ALIGNMENT_SYSTEM_INSTRUCTION)
+    return typing.cast(float, analysis["main_themes_alignment"])
 
 def rate_article(article_analysis: ArticleAnalysis, user_preference_models: user_preferences_models.UserPreferencesModels) -> ArticleScores:
     """
     Generates the scores for the article from the raw data from the LLM
     """
-    themes_alignment_score = max(0, min(10, article_analysis.main_themes_alignment))
-    fluffiness_alignment_score = None if article_analysis.how_fluffy is None else max(0, min(10, user_preference_models.fluffiness_model.predict([[article_analysis.how_fluffy]])[0]))
-    title_descriptiveness_score = None if article_analysis.how_descriptive_title is None else max(0, min(10, user_preference_models.title_descriptiveness_model.predict([[article_analysis.how_descriptive_title]])[0]))
-    combined_score = combine_scores(list(filter(lambda x: x is not None, [themes_alignment_score, fluffiness_alignment_score, title_descriptiveness_score])))
+    with metrics.span("rate"):
+        themes_alignment_score = None if article_analysis.main_themes_alignment is None else max(0.0, min(10.0, article_analysis.main_themes_alignment))
+        fluffiness_alignment_score = None if article_analysis.how_fluffy is None else max(0.0, min(10.0, float(user_preference_models.fluffiness_table.predict_many([article_analysis.how_fluffy])[0])))
+        title_descriptiveness_score = None if article_analysis.how_descriptive_title is None else max(0.0, min(10.0, float(user_preference_models.title_descriptiveness_table.predict_many([article_analysis.how_descriptive_title])[0])))
+        present_scores = [score for score in [themes_alignment_score, fluffiness_alignment_score, title_descriptiveness_score] if score is not None]
+        combined_score = None if len(present_scores) == 0 else combine_scores(present_scores)
 
     return ArticleScores(themes_alignment_score, fluffiness_alignment_score, title_descriptiveness_score, combined_score)
 
@@ -77,12 +349,64 @@ def combine_scores(scores: list[float]) -> float:
     """
     Combines a list of scores into a single score
     """
-    S = 0.1
+    S = SCORE_SHIFT
     def transform(x: float) -> float:
         return x*(constants.MAX_SCORE - S)/constants.MAX_SCORE + S
 
     def inverse_transform(x: float) -> float:
         return constants.MAX_SCORE/(constants.MAX_SCORE - S)*(x-S)
 
-    p = 0.25
-    return inverse_transform(pow(sum([pow(transform(score), p) for score in scores]) / len(scores), 1/p))
\ No newline at end of file
+    p = POWER_MEAN_EXPONENT
+    return inverse_transform(pow(sum([pow(transform(score), p) for score in scores]) / len(scores), 1/p))
+
+def combine_score_matrix(scores: numpy.ndarray) -> numpy.ndarray:
+    """
+    Combines each row of a (n_articles, n_scores) matrix into a single score like `combine_scores`, ignoring the NaN (missing) scores.
+    Rows without any scores are combined into NaN.
+    """
+    S = SCORE_SHIFT
+    p = POWER_MEAN_EXPONENT
+    present = ~numpy.isnan(scores)
+    powered = numpy.power(numpy.where(present, scores, 0.0)*(constants.MAX_SCORE - S)/constants.MAX_SCORE + S, p)
+    counts = present.sum(axis=1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        means = numpy.where(present, powered, 0.0).sum(axis=1) / counts
+    return constants.MAX_SCORE/(constants.MAX_SCORE - S)*(numpy.power(means, 1/p) - S)
+
+def optional_scores(values: list[typing.Optional[float]]) -> numpy.ndarray:
+    """
+    Converts a list of optional scores into an array with NaN for the missing ones
+    """
+    return numpy.array([numpy.nan if value is None else value for value in values], dtype=float)
+
+def calibrate_scores(raw_scores: numpy.ndarray, table: user_preferences_models.LookupTableModel) -> numpy.ndarray:
+    """
+    Predicts the user scores for the present LLM scores and clamps them to the score range, keeping the missing ones as NaN
+    """
+    present = ~numpy.isnan(raw_scores)
+    calibrated = numpy.full(raw_scores.shape, numpy.nan)
+    if present.any():
+        calibrated[present] = numpy.clip(table.predict_many(raw_scores[present]), constants.MIN_SCORE, constants.MAX_SCORE)
+    return calibrated
+
+def rate_articles(article_analyses: list[ArticleAnalysis], user_preference_models: user_preferences_models.UserPreferencesModels) -> list[RankedArticle]:
+    """
+    Generates the scores for all of the articles at once, returning them ranked from the best overall score to the worst.
+    The scores are the same as the ones from `rate_article`, articles without any scores are ranked last.
+    """
+    with metrics.span("rate"):
+        themes_alignment_scores = numpy.clip(optional_scores([analysis.main_themes_alignment for analysis in article_analyses]), constants.MIN_SCORE, constants.MAX_SCORE)
+        fluffiness_scores = calibrate_scores(optional_scores([analysis.how_fluffy for analysis in article_analyses]), user_preference_models.fluffiness_table)
+        title_descriptiveness_scores = calibrate_scores(optional_scores([analysis.how_descriptive_title for analysis in article_analyses]), user_preference_models.title_descriptiveness_table)
+        score_matrix = numpy.column_stack([themes_alignment_scores, fluffiness_scores, title_descriptiveness_scores]).reshape((-1, 3))
+        combined_scores = combine_score_matrix(score_matrix)
+        # The NaN scores of the articles without any scores sort last, the stable sort keeps ties in the input order
+        order = numpy.argsort(-combined_scores, kind="stable")
+
+    def as_optional(value: float) -> typing.Optional[float]:
+        return None if numpy.isnan(value) else float(value)
+
+    return [
+        RankedArticle(int(index), article_analyses[index], ArticleScores(as_optional(score_matrix[index, 0]), as_optional(score_matrix[index, 1]), as_optional(score_matrix[index, 2]), as_optional(combined_scores[index])))
+        for index in order
+    ]
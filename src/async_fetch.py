@@ -0,0 +1,204 @@
+"""
+Handling of the asynchronous fetching of articles with pooled connections, per-host limits, conditional requests and retries
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import asyncio
+import concurrent.futures
+import email.utils
+import logging
+import threading
+import time
+import typing
+
+import metrics
+import page_cache as page_cache_module
+import constants
+
+if typing.TYPE_CHECKING:
+    import aiohttp
+
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+USER_AGENT = "Mozilla/5.0 (compatible; article-recommender)"
+
+@dataclass
+class FetchResult:
+    """
+    A data structure class for storing the outcome of fetching a single URL
+    """
+    url: str
+    page: typing.Optional[str]
+    status: typing.Optional[int]
+    from_cache: bool
+    not_modified: bool
+    attempts: int
+    error: typing.Optional[str]
+    def __init__(self, url: str, page: typing.Optional[str] = None, status: typing.Optional[int] = None, from_cache: bool = False, not_modified: bool = False, attempts: int = 0, error: typing.Optional[str] = None):
+        self.url = url
+        self.page = page
+        self.status = status
+        self.from_cache = from_cache
+        self.not_modified = not_modified
+        self.attempts = attempts
+        self.error = error
+
+class AsyncFetcher:
+    """
+    Fetches pages over a pool of keep-alive connections, with at most `per_host_limit` requests to the same host at a time.
+    Expired pages in the page cache are revalidated with conditional requests (ETag/Last-Modified),
+    timeouts, connection errors and retryable statuses are retried with exponential backoff (honouring Retry-After).
+    The page cache reads and writes disk files, so it is only used from worker threads to keep the event loop free for the other fetches.
+    Must be used as an async context manager.
+    """
+    def __init__(self, page_cache: typing.Optional[page_cache_module.PageCache] = None, max_connections: int = constants.FETCH_MAX_CONNECTIONS, per_host_limit: int = constants.FETCH_PER_HOST_LIMIT, timeout_seconds: float = constants.FETCH_TIMEOUT_SECONDS, max_retries: int = constants.FETCH_MAX_RETRIES, backoff_seconds: float = constants.FETCH_BACKOFF_SECONDS):
+        self.page_cache = page_cache
+        self.max_connections = max_connections
+        self.per_host_limit = per_host_limit
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.requests = 0
+        self.retries = 0
+        self.not_modified = 0
+        self._session: typing.Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> AsyncFetcher:
+        # aiohttp is only needed with --async-fetch, so it is not imported at startup
+        import aiohttp # pylint: disable=import-outside-toplevel,redefined-outer-name
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_host_limit, ttl_dns_cache=300)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout_seconds), headers={"User-Agent": USER_AGENT})
+        return self
+
+    async def __aexit__(self, *exception_info: typing.Any):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def fetch(self, url: str) -> FetchResult:
+        """
+        Fetches the page, serving it from the page cache if it is fresh there
+        """
+        if self.page_cache is not None:
+            cached_page = await asyncio.to_thread(self.page_cache.get_page, url)
+            if cached_page is not None:
+                return FetchResult(url, cached_page, from_cache=True)
+            if self.page_cache.offline:
+                return FetchResult(url, error="not in the page cache (offline mode)")
+        # The connector already limits the connections per host, the requests over the limit wait for a free connection
+        with metrics.span("fetch"):
+            return await self._fetch_with_retries(url)
+
+    async def fetch_many(self, urls: typing.Iterable[str]) -> typing.AsyncIterator[FetchResult]:
+        """
+        Fetches all of the pages, yielding the results as soon as each one finishes
+        """
+        tasks = [asyncio.ensure_future(self.fetch(url)) for url in urls]
+        for task in asyncio.as_completed(tasks):
+            yield await task
+
+    async def _fetch_with_retries(self, url: str) -> FetchResult:
+        import aiohttp # pylint: disable=import-outside-toplevel,redefined-outer-name
+        if self._session is None:
+            raise RuntimeError("AsyncFetcher must be used as an async context manager")
+        headers = await asyncio.to_thread(self._conditional_headers, url)
+        last_error = None
+        last_status = None
+        for attempt in range(1, self.max_retries + 2):
+            if attempt > 1:
+                self.retries += 1
+                metrics.increment("fetch_retries_total")
+            delay = self.backoff_seconds * 2 ** (attempt - 1)
+            try:
+                self.requests += 1
+                metrics.increment("fetch_requests_total")
+                async with self._session.get(url, headers=headers) as response:
+                    last_status = response.status
+                    if response.status == 304 and self.page_cache is not None:
+                        stale_page = await asyncio.to_thread(self.page_cache.get_stale_page, url)
+                        if stale_page is not None:
+                            await asyncio.to_thread(self.page_cache.refresh_page, url)
+                            self.not_modified += 1
+                            metrics.increment("fetch_not_modified_total")
+                            return FetchResult(url, stale_page, response.status, from_cache=True, not_modified=True, attempts=attempt)
+                        # The cached copy disappeared in the meantime, ask for the full page
+                        headers = {}
+                        last_error = "not modified, but the cached page is gone"
+                        continue
+                    if response.status in RETRY_STATUSES:
+                        last_error = f"HTTP {response.status}"
+                        delay = max(delay, AsyncFetcher._retry_after_seconds(response.headers.get("Retry-After")))
+                    elif response.status >= 400:
+                        return FetchResult(url, status=response.status, attempts=attempt, error=f"HTTP {response.status}")
+                    else:
+                        page = await response.text(errors="replace")
+                        if self.page_cache is not None:
+                            await asyncio.to_thread(self.page_cache.put_page, url, page, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+                        return FetchResult(url, page, response.status, attempts=attempt)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = f"{type(e).__name__}: {e}"
+            if attempt <= self.max_retries:
+                logging.debug(f"Retrying '{url}' in {delay:.1f} s after: {last_error}")
+                await asyncio.sleep(delay)
+        logging.warning(f"Warning: Failed to fetch '{url}' after {self.max_retries + 1} attempts: {last_error}")
+        return FetchResult(url, status=last_status, attempts=self.max_retries + 1, error=last_error)
+
+    def _conditional_headers(self, url: str) -> dict[str, str]:
+        if self.page_cache is None:
+            return {}
+        url_entry = self.page_cache.get_page_entry(url)
+        if url_entry is None:
+            return {}
+        headers = {}
+        if "etag" in url_entry:
+            headers["If-None-Match"] = typing.cast(str, url_entry["etag"])
+        if "last_modified" in url_entry:
+            headers["If-Modified-Since"] = typing.cast(str, url_entry["last_modified"])
+        return headers
+
+    @staticmethod
+    def _retry_after_seconds(retry_after: typing.Optional[str]) -> float:
+        if retry_after is None:
+            return 0.0
+        try:
+            return min(constants.FETCH_MAX_RETRY_AFTER_SECONDS, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return 0.0
+        return min(constants.FETCH_MAX_RETRY_AFTER_SECONDS, max(0.0, retry_at.timestamp() - time.time()))
+
+class BackgroundFetcher:
+    """
+    Runs an `AsyncFetcher` on an event loop in a background thread, so that the thread-based code can share its connection pool
+    """
+    def __init__(self, page_cache: typing.Optional[page_cache_module.PageCache] = None, **fetcher_arguments: typing.Any):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="async-fetch", daemon=True)
+        self._thread.start()
+        self.fetcher = AsyncFetcher(page_cache, **fetcher_arguments)
+        asyncio.run_coroutine_threadsafe(self.fetcher.__aenter__(), self._loop).result()
+
+    def fetch(self, url: str) -> FetchResult:
+        """
+        Fetches the page, blocking the calling thread until it is done
+        """
+        return self.submit(url).result()
+
+    def submit(self, url: str) -> concurrent.futures.Future[FetchResult]:
+        """
+        Starts fetching the page, returning a future for the result
+        """
+        return asyncio.run_coroutine_threadsafe(self.fetcher.fetch(url), self._loop)
+
+    def close(self):
+        """
+        Closes the connections and stops the event loop
+        """
+        asyncio.run_coroutine_threadsafe(self.fetcher.__aexit__(None, None, None), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -0,0 +1,328 @@
+"""
+Handling of the batch analysis of many articles through a concurrent fetch -> extract -> analyse pipeline
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import concurrent.futures
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+import typing
+import article_analysis
+import async_fetch
+import extraction_pool as extraction_pool_module
+import fetch_article
+import page_cache as page_cache_module
+import user_preferences_handler
+import user_preferences_models
+import constants
+
+STAGE_NAMES = ["fetch", "extract", "analyse", "score"]
+
+def pack_limits(input_token_limit: int, output_token_limit: int, max_articles: int) -> typing.Tuple[int, int]:
+    """
+    Sizes the packed requests to the context of the model, returning the token budget of a pack and the maximum number of articles in it
+    """
+    token_budget = min(constants.PACK_TOKEN_BUDGET, int(input_token_limit * constants.PACK_CONTEXT_FRACTION))
+    return token_budget, max(1, min(max_articles, output_token_limit // constants.PACK_OUTPUT_TOKENS_PER_ARTICLE))
+
+@dataclass
+class StageStatistics:
+    """
+    A data structure class for storing the throughput statistics of a single pipeline stage
+    """
+    name: str
+    processed: int
+    failed: int
+    busy_seconds: float
+    def __init__(self, name: str):
+        self.name = name
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, duration: float, succeeded: bool):
+        """
+        Records a single item passing through the stage
+        """
+        with self._lock:
+            self.busy_seconds += duration
+            if succeeded:
+                self.processed += 1
+            else:
+                self.failed += 1
+
+    def format_summary(self, wall_seconds: float) -> str:
+        """
+        Formats the statistics of the stage for the end of batch report
+        """
+        total = self.processed + self.failed
+        throughput = total / wall_seconds if wall_seconds > 0 else 0.0
+        average = self.busy_seconds / total if total > 0 else 0.0
+        return f"{self.name}: {self.processed} ok, {self.failed} failed, {throughput:.2f} items/s, {average:.3f} s/item on average"
+
+@dataclass
+class BatchResult:
+    """
+    A data structure class for storing the result of analysing a single article of a batch
+    """
+    url: str
+    analysis: typing.Optional[article_analysis.ArticleAnalysis]
+    scores: typing.Optional[article_analysis.ArticleScores]
+    error: typing.Optional[str]
+    def __init__(self, url: str, analysis: typing.Optional[article_analysis.ArticleAnalysis] = None, scores: typing.Optional[article_analysis.ArticleScores] = None, error: typing.Optional[str] = None):
+        self.url = url
+        self.analysis = analysis
+        self.scores = scores
+        self.error = error
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        """
+        Converts the class to a JSON serializable dictionary
+        """
+        return {
+            "url": self.url,
+            "analysis": None if self.analysis is None else self.analysis.to_dict(),
+            "scores": None if self.scores is None else self.scores.to_dict(),
+            "error": self.error
+        }
+
+class BatchAnalyser:
+    """
+    Runs articles through the fetch -> extract -> analyse -> score pipeline with bounded parallelism for the fetches and the LLM calls
+    """
+    def __init__(self, context: article_analysis.AnalysisContext, user_preferences: user_preferences_handler.UserPreferences, user_preference_models: user_preferences_models.UserPreferencesModels,
+                 fetch_workers: int = constants.BATCH_FETCH_WORKERS, llm_workers: int = constants.BATCH_LLM_WORKERS, page_cache: typing.Optional[page_cache_module.PageCache] = None,
+                 split_analysis: bool = False, fetcher: typing.Optional[async_fetch.BackgroundFetcher] = None, extraction_pool: typing.Optional[extraction_pool_module.ExtractionPool] = None,
+                 pack_token_budget: typing.Optional[int] = None, pack_max_articles: int = 1, pack_max_wait_seconds: float = constants.PACK_MAX_WAIT_SECONDS):
+        self.context = context
+        self.fetcher = fetcher
+        self.extraction_pool = extraction_pool
+        self.split_analysis = split_analysis
+        self.page_cache = page_cache
+        self.user_preferences = user_preferences
+        self.user_preference_models = user_preference_models
+        self.fetch_workers = max(1, fetch_workers)
+        self.llm_workers = max(1, llm_workers)
+        self.statistics = {name: StageStatistics(name) for name in STAGE_NAMES}
+        self.wall_seconds = 0.0
+        self.prompt_tokens = 0
+        self._prompt_tokens_lock = threading.Lock()
+        # Packing several short articles into one request only applies to the combined analysis
+        self.pack_token_budget = pack_token_budget if pack_max_articles > 1 and not split_analysis else None
+        self.pack_max_articles = pack_max_articles
+        self.pack_max_wait_seconds = pack_max_wait_seconds
+        self.packed_requests = 0
+        self.pack_fallbacks = 0
+        self._pack: list[typing.Tuple[str, fetch_article.ArticleMetadata]] = []
+        self._pack_tokens = 0
+        self._pack_started = 0.0
+        self._fetches_running = 0
+        self._pack_lock = threading.Lock()
+
+    def analyse(self, urls: typing.Iterable[str]) -> typing.Iterator[BatchResult]:
+        """
+        Analyses the articles, yielding the results as soon as each one finishes (not in the input order)
+        """
+        finished: queue.Queue[BatchResult] = queue.Queue()
+        # Enough articles in flight to keep both pools busy without reading the whole input into memory
+        max_in_flight = self.fetch_workers + 2 * self.llm_workers
+        in_flight = 0
+        started = time.perf_counter()
+        url_iterator = iter(urls)
+        urls_left = True
+        with concurrent.futures.ThreadPoolExecutor(self.fetch_workers, thread_name_prefix="fetch") as fetch_pool, \
+             concurrent.futures.ThreadPoolExecutor(self.llm_workers, thread_name_prefix="llm") as llm_pool:
+            while urls_left or in_flight > 0:
+                while urls_left and in_flight < max_in_flight:
+                    url = next(url_iterator, None)
+                    if url is None:
+                        urls_left = False
+                        break
+                    with self._pack_lock:
+                        self._fetches_running += 1
+                    fetch_pool.submit(self._fetch_stage, url, llm_pool, finished)
+                    in_flight += 1
+                if in_flight == 0:
+                    break
+                try:
+                    result = finished.get(timeout=self._send_due_pack(llm_pool, finished))
+                except queue.Empty:
+                    continue
+                in_flight -= 1
+                yield result
+        self.wall_seconds = time.perf_counter() - started
+
+    def format_summary(self) -> str:
+        """
+        Formats the per-stage throughput report of the last batch
+        """
+        lines = [f"Batch finished in {self.wall_seconds:.2f} s, sending ~{self.prompt_tokens} prompt tokens"]
+        if self.pack_token_budget is not None:
+            lines.append(f"{self.packed_requests} packed requests, {self.pack_fallbacks} articles analysed on their own after incomplete replies")
+        lines.extend(self.statistics[name].format_summary(self.wall_seconds) for name in STAGE_NAMES)
+        return "\n".join(lines)
+
+    def _send_due_pack(self, llm_pool: concurrent.futures.ThreadPoolExecutor, finished: queue.Queue[BatchResult]) -> typing.Optional[float]:
+        """
+        Sends the pending pack if it has waited for more articles for longer than `pack_max_wait_seconds`,
+        returning how long to wait for a result before checking it again (None without packing)
+        """
+        if self.pack_token_budget is None:
+            return None
+        with self._pack_lock:
+            if len(self._pack) == 0:
+                return self.pack_max_wait_seconds
+            waited = time.monotonic() - self._pack_started
+            if waited < self.pack_max_wait_seconds:
+                return self.pack_max_wait_seconds - waited
+            pack = self._take_pack()
+        llm_pool.submit(self._analyse_pack_stage, pack, llm_pool, finished)
+        return self.pack_max_wait_seconds
+
+    def _fetch_stage(self, url: str, llm_pool: concurrent.futures.ThreadPoolExecutor, finished: queue.Queue[BatchResult]):
+        try:
+            stage_start = time.perf_counter()
+            fetch_error = "fetch failed"
+            if self.fetcher is None:
+                webpage = fetch_article.fetch_article(url, self.page_cache)
+            else:
+                fetch_result = self.fetcher.fetch(url)
+                webpage = fetch_result.page
+                fetch_error = f"fetch failed: {fetch_result.error}"
+            self.statistics["fetch"].record(time.perf_counter() - stage_start, webpage is not None)
+            if webpage is None:
+                finished.put(BatchResult(url, error=fetch_error))
+                return
+            stage_start = time.perf_counter()
+            if self.extraction_pool is None:
+                metadata = fetch_article.extract_article_metadata(webpage, self.page_cache)
+            else:
+                metadata = self.extraction_pool.extract(webpage)
+            self.statistics["extract"].record(time.perf_counter() - stage_start, metadata is not None)
+            if metadata is None:
+                finished.put(BatchResult(url, error="extraction failed"))
+                return
+            self._dispatch(url, metadata, llm_pool, finished)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            logging.error(f"Error: Failed to fetch '{url}': {e}")
+            finished.put(BatchResult(url, error=str(e)))
+        finally:
+            # Once nothing is being fetched no more articles can join the pending pack, so it is sent as it is
+            with self._pack_lock:
+                self._fetches_running -= 1
+                pack = self._take_pack() if self._fetches_running == 0 else []
+            if len(pack) > 0:
+                llm_pool.submit(self._analyse_pack_stage, pack, llm_pool, finished)
+
+    def _dispatch(self, url: str, metadata: fetch_article.ArticleMetadata, llm_pool: concurrent.futures.ThreadPoolExecutor, finished: queue.Queue[BatchResult]):
+        if self.pack_token_budget is None:
+            llm_pool.submit(self._analyse_stage, url, metadata, finished)
+            return
+        article_tokens = self.context.prompt_builder.build(metadata).estimated_tokens
+        # Only the short articles are packed, a long one would crowd the others out of the pack
+        if article_tokens > self.pack_token_budget // self.pack_max_articles:
+            llm_pool.submit(self._analyse_stage, url, metadata, finished)
+            return
+        full_packs = []
+        with self._pack_lock:
+            if self._pack_tokens + article_tokens > self.pack_token_budget:
+                full_packs.append(self._take_pack())
+            if len(self._pack) == 0:
+                self._pack_started = time.monotonic()
+            self._pack.append((url, metadata))
+            self._pack_tokens += article_tokens
+            if len(self._pack) >= self.pack_max_articles:
+                full_packs.append(self._take_pack())
+        for pack in full_packs:
+            llm_pool.submit(self._analyse_pack_stage, pack, llm_pool, finished)
+
+    def _take_pack(self) -> list[typing.Tuple[str, fetch_article.ArticleMetadata]]:
+        pack = self._pack
+        self._pack = []
+        self._pack_tokens = 0
+        return pack
+
+    def _analyse_pack_stage(self, pack: list[typing.Tuple[str, fetch_article.ArticleMetadata]], llm_pool: concurrent.futures.ThreadPoolExecutor, finished: queue.Queue[BatchResult]):
+        if len(pack) == 1:
+            self._analyse_stage(pack[0][0], pack[0][1], finished)
+            return
+        stage_start = time.perf_counter()
+        try:
+            packed = article_analysis.analyse_metadata_packed(self.context, [metadata for _, metadata in pack], self.user_preferences)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            # A failed request is already reported as missing analyses, this failed before anything was sent
+            logging.warning(f"Warning: Failed to prepare the packed request for {len(pack)} articles, analysing them one by one: {e}")
+            packed = article_analysis.PackedAnalyses([None] * len(pack), False)
+        analyses = packed.analyses
+        duration = (time.perf_counter() - stage_start) / len(pack)
+        with self._pack_lock:
+            if packed.requested:
+                self.packed_requests += 1
+            self.pack_fallbacks += sum(1 for analysis in analyses if analysis is None)
+        for (url, metadata), analysis in zip(pack, analyses):
+            if analysis is None:
+                llm_pool.submit(self._analyse_stage, url, metadata, finished)
+                continue
+            self.statistics["analyse"].record(duration, True)
+            self._score_stage(url, analysis, finished)
+
+    def _analyse_stage(self, url: str, metadata: fetch_article.ArticleMetadata, finished: queue.Queue[BatchResult]):
+        stage_start = time.perf_counter()
+        try:
+            analysis = article_analysis.analyse_metadata(self.context, metadata, self.user_preferences, self.split_analysis)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            self.statistics["analyse"].record(time.perf_counter() - stage_start, False)
+            logging.error(f"Error: Failed to analyse '{url}': {e}")
+            finished.put(BatchResult(url, error=str(e)))
+            return
+        self.statistics["analyse"].record(time.perf_counter() - stage_start, True)
+        self._score_stage(url, analysis, finished)
+
+    def _score_stage(self, url: str, analysis: article_analysis.ArticleAnalysis, finished: queue.Queue[BatchResult]):
+        if analysis.prompt_tokens is not None:
+            with self._prompt_tokens_lock:
+                self.prompt_tokens += analysis.prompt_tokens
+        stage_start = time.perf_counter()
+        try:
+            scores = article_analysis.rate_article(analysis, self.user_preference_models)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            self.statistics["score"].record(time.perf_counter() - stage_start, False)
+            logging.error(f"Error: Failed to score '{url}': {e}")
+            finished.put(BatchResult(url, analysis=analysis, error=str(e)))
+            return
+        self.statistics["score"].record(time.perf_counter() - stage_start, True)
+        finished.put(BatchResult(url, analysis=analysis, scores=scores))
+
+def read_urls(source: typing.TextIO) -> typing.Iterator[str]:
+    """
+    Reads URLs one per line, skipping empty lines and lines starting with '#'
+    """
+    for line in source:
+        url = line.strip()
+        if len(url) == 0 or url.startswith("#"):
+            continue
+        yield url
+
+def run_batch(analyser: BatchAnalyser, urls_path: str, output_path: str):
+    """
+    Analyses the URLs from a file ('-' for stdin) and writes the results as JSON lines to a file ('-' for stdout)
+    """
+    source = sys.stdin if urls_path == "-" else open(urls_path, 'r', encoding = "utf-8") # pylint: disable=consider-using-with
+    output = sys.stdout if output_path == "-" else open(output_path, 'w', encoding = "utf-8") # pylint: disable=consider-using-with
+    try:
+        for result in analyser.analyse(read_urls(source)):
+            output.write(json.dumps(result.to_dict()) + "\n")
+            output.flush()
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    logging.info(analyser.format_summary())
@@ -0,0 +1,356 @@
+"""
+A reproducible benchmark of the analysis and scoring pipeline on synthetic articles and preference histories.
+Reports the latency percentiles, the throughput and the peak memory of each stage and compares them against a baseline file to catch regressions.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import argparse
+import functools
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+
+import article_analysis
+import batch_analysis
+import fetch_article
+import json_files
+import llm_backend
+import page_cache as page_cache_module
+import user_preferences_handler
+import user_preferences_models
+import constants
+
+SEED = 1234
+HISTORY_SIZES = [0, 20, 50, 100, 300, 1000]
+PAGE_PARAGRAPHS = {"short": 5, "medium": 30, "long": 150}
+VOCABULARY = """analysis battery budget carbon climate code compiler court data design economy election energy engine football framework garden government health history
+industry language league market memory model music network ocean paper physics planet policy privacy process protein research rocket science security software
+space startup storage study system team technology theory travel vaccine video water weather""".split()
+# The startup of the interactive session up to the first prompt, with the work main.py leaves running in the background awaited.
+# Importing main does not run it, the session only starts when main.py is the script.
+STARTUP_SCRIPT = """
+import concurrent.futures
+import main
+main.dotenv.load_dotenv()
+with concurrent.futures.ThreadPoolExecutor(2) as background:
+    futures = [background.submit(main.load_profile, main.parse_arguments()), background.submit(main.llm_backend.GeminiBackend.client)]
+for future in futures:
+    future.result()
+"""
+STARTUP_STAGE = "startup/main"
+FILLER = "really very basically actually just quite simply some of the a an and to in that it is was for on with as".split()
+
+@dataclass
+class StageResult:
+    """
+    A data structure class for storing the measurements of a single benchmark stage
+    """
+    name: str
+    samples: list[float]
+    items_per_sample: int
+    peak_memory_bytes: int
+    def __init__(self, name: str, samples: list[float], items_per_sample: int, peak_memory_bytes: int):
+        self.name = name
+        self.samples = samples
+        self.items_per_sample = items_per_sample
+        self.peak_memory_bytes = peak_memory_bytes
+
+    def percentile_ms(self, fraction: float) -> float:
+        """
+        Returns the percentile of the run times in milliseconds
+        """
+        return percentile(sorted(self.samples), fraction) * 1000
+
+    def peak_memory_kib(self) -> float:
+        """
+        Returns the peak memory of the stage in KiB
+        """
+        return self.peak_memory_bytes / 1024
+
+    def to_dict(self) -> dict[str, typing.Union[str, int, float]]:
+        """
+        Converts the class to a JSON serializable dictionary
+        """
+        total_seconds = sum(self.samples)
+        return {
+            "name": self.name,
+            "runs": len(self.samples),
+            "p50_ms": self.percentile_ms(0.5),
+            "p90_ms": self.percentile_ms(0.9),
+            "p99_ms": self.percentile_ms(0.99),
+            "mean_ms": statistics.fmean(self.samples) * 1000,
+            "items_per_second": len(self.samples) * self.items_per_sample / total_seconds if total_seconds > 0 else 0.0,
+            "peak_memory_kib": self.peak_memory_kib()
+        }
+
+def percentile(ordered_values: list[float], fraction: float) -> float:
+    """
+    Returns the percentile of the sorted values, interpolating linearly between the closest ranks
+    """
+    if len(ordered_values) == 0:
+        return 0.0
+    position = (len(ordered_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered_values) - 1)
+    return ordered_values[lower] + (ordered_values[upper] - ordered_values[lower]) * (position - lower)
+
+def measure(name: str, run: typing.Callable[[], typing.Any], repeat: int, items_per_sample: int = 1, setup: typing.Optional[typing.Callable[[], typing.Any]] = None) -> StageResult:
+    """
+    Times `repeat` runs of the stage (after one warm-up run), then measures its peak memory in a separate traced run,
+    as tracing the allocations would distort the timings. `setup` runs untimed before every run.
+    """
+    if setup is not None:
+        setup()
+    run()
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - started)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return StageResult(name, samples, items_per_sample, peak_memory)
+
+def extract_pages(pages: list[str], cache: typing.Optional[page_cache_module.PageCache] = None) -> list[typing.Optional[fetch_article.ArticleMetadata]]:
+    """
+    Extracts the metadata of every page
+    """
+    return [fetch_article.extract_article_metadata(page, cache) for page in pages]
+
+def synthetic_page(rng: random.Random, paragraph_count: int, index: int) -> str:
+    """
+    Generates an article page with a navigation bar, a title, `paragraph_count` paragraphs and a footer
+    """
+    topic = rng.sample(VOCABULARY, 3)
+    paragraphs = []
+    for _ in range(paragraph_count):
+        words = [rng.choice(topic if rng.random() < 0.2 else (FILLER if rng.random() < 0.4 else VOCABULARY)) for _ in range(rng.randint(40, 90))]
+        paragraphs.append("<p>" + " ".join(words).capitalize() + ".</p>")
+    title = f"{topic[0].capitalize()} and {topic[1]}: what the {topic[2]} means ({index})"
+    return (f"<html><head><title>{title}</title><meta name=\"author\" content=\"Bench Writer\"></head><body>"
+            f"<nav><a href=\"/\">Home</a> <a href=\"/news\">News</a></nav><article><h1>{title}</h1>{''.join(paragraphs)}</article>"
+            f"<footer>Copyright bench.example</footer></body></html>")
+
+def synthetic_preferences(rng: random.Random, rating_count: int, interest_count: int = 40) -> user_preferences_handler.UserPreferences:
+    """
+    Generates preferences with `rating_count` ratings of a user who likes dry texts and descriptive titles
+    """
+    preferences = user_preferences_handler.UserPreferences.default()
+    for theme in rng.sample(VOCABULARY, min(interest_count, len(VOCABULARY))):
+        preferences.interests[theme] = user_preferences_handler.ScoreInformation(round(rng.uniform(0, 10), 1), rng.randint(1, 20))
+    for _ in range(rating_count):
+        fluffiness = rng.uniform(0, 10)
+        title_descriptiveness = rng.uniform(0, 10)
+        preferences.fluffiness.append(user_preferences_handler.PredicatedActual(fluffiness, max(0.0, min(10.0, 10 - fluffiness + rng.gauss(0, 1)))))
+        preferences.title_descriptiveness.append(user_preferences_handler.PredicatedActual(title_descriptiveness, max(0.0, min(10.0, title_descriptiveness + rng.gauss(0, 1)))))
+    return preferences
+
+def synthetic_analysis(rng: random.Random) -> article_analysis.ArticleAnalysis:
+    """
+    Generates the analysis of an article as the LLM would return it
+    """
+    raw_analysis = {"main_themes": rng.sample(VOCABULARY, 4), "main_themes_alignment": round(rng.uniform(0, 10), 1), "how_fluffy": round(rng.uniform(0, 10), 1), "how_descriptive_title": round(rng.uniform(0, 10), 1)}
+    return article_analysis.ArticleAnalysis(json.dumps(raw_analysis), "Synthetic", "bench.example")
+
+def benchmark_extraction(rng: random.Random, repeat: int, work_dir: str) -> list[StageResult]:
+    """
+    Benchmarks the metadata extraction at every page size and the page cache lookups
+    """
+    results = []
+    for size_name, paragraph_count in PAGE_PARAGRAPHS.items():
+        pages = [synthetic_page(rng, paragraph_count, index) for index in range(5)]
+        results.append(measure(f"extract/{size_name}", functools.partial(extract_pages, pages), repeat, len(pages)))
+    cache = page_cache_module.PageCache(os.path.join(work_dir, "pages"), offline=True)
+    pages = [synthetic_page(rng, PAGE_PARAGRAPHS["medium"], index) for index in range(20)]
+    for index, page in enumerate(pages):
+        cache.put_page(f"https://bench.example/{index}", page)
+        fetch_article.extract_article_metadata(page, cache)
+    results.append(measure("fetch/page-cache-hit", lambda: [fetch_article.fetch_article(f"https://bench.example/{index}", cache) for index in range(len(pages))], repeat, len(pages)))
+    results.append(measure("extract/page-cache-hit", functools.partial(extract_pages, pages, cache), repeat, len(pages)))
+    return results
+
+def benchmark_training(rng: random.Random, repeat: int, history_sizes: list[int]) -> list[StageResult]:
+    """
+    Benchmarks training the calibration models on histories of increasing size, covering every `MODEL_PARAMETRES` tier
+    """
+    results = []
+    for size in history_sizes:
+        preferences = synthetic_preferences(rng, size)
+        results.append(measure(f"train/random-forest/{size}", functools.partial(user_preferences_models.UserPreferencesModels, preferences), repeat))
+        results.append(measure(f"train/online/{size}", functools.partial(user_preferences_models.UserPreferencesModels, preferences, incremental=True), repeat))
+    return results
+
+def benchmark_scoring(rng: random.Random, repeat: int) -> list[StageResult]:
+    """
+    Benchmarks rating analysed articles and combining the scores
+    """
+    models = user_preferences_models.UserPreferencesModels(synthetic_preferences(rng, 100))
+    analyses = [synthetic_analysis(rng) for _ in range(500)]
+    score_lists = [[rng.uniform(0, 10) for _ in range(3)] for _ in range(2000)]
+    return [
+        measure("score/rate_article", lambda: [article_analysis.rate_article(analysis, models) for analysis in analyses], repeat, len(analyses)),
+        measure("score/rate_articles", lambda: article_analysis.rate_articles(analyses, models), repeat, len(analyses)),
+        measure("score/combine_scores", lambda: [article_analysis.combine_scores(scores) for scores in score_lists], repeat, len(score_lists))
+    ]
+
+def benchmark_preferences(rng: random.Random, repeat: int, work_dir: str, history_sizes: list[int]) -> list[StageResult]:
+    """
+    Benchmarks saving and loading preferences with histories of increasing size
+    """
+    results = []
+    for size in history_sizes:
+        preferences = synthetic_preferences(rng, size)
+        path = os.path.join(work_dir, f"preferences-{size}.json")
+        results.append(measure(f"preferences/save/{size}", functools.partial(user_preferences_handler.save, path, preferences), repeat))
+        results.append(measure(f"preferences/load/{size}", functools.partial(user_preferences_handler.load, path), repeat))
+    return results
+
+def benchmark_pipeline(rng: random.Random, repeat: int, work_dir: str, article_count: int) -> list[StageResult]:
+    """
+    Benchmarks the whole batch pipeline over cached pages with the local heuristic backend, so that no network is needed
+    """
+    cache = page_cache_module.PageCache(os.path.join(work_dir, "pipeline-pages"), offline=True)
+    urls = [f"https://bench.example/article/{index}" for index in range(article_count)]
+    for url in urls:
+        cache.put_page(url, synthetic_page(rng, PAGE_PARAGRAPHS["medium"], len(url)))
+    preferences = synthetic_preferences(rng, 100)
+    models = user_preferences_models.UserPreferencesModels(preferences)
+    backend = llm_backend.HeuristicBackend()
+
+    def run():
+        analyser = batch_analysis.BatchAnalyser(article_analysis.AnalysisContext(backend), preferences, models, page_cache=cache)
+        for result in analyser.analyse(urls):
+            if result.error is not None:
+                raise RuntimeError(f"the pipeline failed on '{result.url}': {result.error}")
+
+    # After the warm-up run the extractions come from the page cache, so this measures the steady state of re-analysing known pages
+    return [measure("pipeline/warm-cache", run, repeat, len(urls))]
+
+def benchmark_startup(repeat: int) -> list[StageResult]:
+    """
+    Benchmarks the cold start of the application: a fresh interpreter importing main.py, loading the environment, the profile and its models and importing the LLM client
+    """
+    command = [sys.executable, "-c", STARTUP_SCRIPT]
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    # The warm-up run also writes the bytecode caches, so the timed runs measure a cold process rather than the compilation
+    return [measure(STARTUP_STAGE, lambda: subprocess.run(command, cwd=source_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL), repeat)]
+
+def check_startup_target(results: list[StageResult], target_seconds: float) -> typing.Optional[str]:
+    """
+    Returns the description of the miss if the median cold start is slower than the target, None otherwise
+    """
+    for result in results:
+        p50_ms = result.percentile_ms(0.5)
+        if result.name == STARTUP_STAGE and p50_ms > target_seconds * 1000:
+            return f"{STARTUP_STAGE}: p50_ms {p50_ms:.2f} is over the target of {target_seconds * 1000:.0f}"
+    return None
+
+def run_benchmarks(stages: list[str], repeat: int, quick: bool) -> list[StageResult]:
+    """
+    Runs the benchmarks of the chosen stages with the fixed seed
+    """
+    rng = random.Random(SEED)
+    history_sizes = HISTORY_SIZES[:-1] if quick else HISTORY_SIZES
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        if "startup" in stages:
+            results.extend(benchmark_startup(min(repeat, 5) if quick else repeat))
+        if "extract" in stages:
+            results.extend(benchmark_extraction(rng, repeat, work_dir))
+        if "train" in stages:
+            results.extend(benchmark_training(rng, repeat, history_sizes))
+        if "score" in stages:
+            results.extend(benchmark_scoring(rng, repeat))
+        if "preferences" in stages:
+            results.extend(benchmark_preferences(rng, repeat, work_dir, history_sizes))
+        if "pipeline" in stages:
+            results.extend(benchmark_pipeline(rng, repeat, work_dir, 10 if quick else 50))
+    return results
+
+def compare_to_baseline(results: list[StageResult], baseline: dict[str, dict[str, typing.Any]], tolerance: float) -> list[str]:
+    """
+    Returns the descriptions of the stages whose median latency or peak memory grew by more than `tolerance` over the baseline
+    """
+    regressions = []
+    for result in results:
+        current = {"p50_ms": result.percentile_ms(0.5), "peak_memory_kib": result.peak_memory_kib()}
+        previous = baseline.get(result.name)
+        if previous is None:
+            continue
+        for metric in ("p50_ms", "peak_memory_kib"):
+            if previous[metric] > 0 and current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{result.name}: {metric} {previous[metric]:.2f} -> {current[metric]:.2f} (+{(current[metric] / previous[metric] - 1) * 100:.0f}%)")
+    return regressions
+
+def format_table(results: list[StageResult]) -> str:
+    """
+    Formats the results as a fixed width table
+    """
+    lines = [f"{'stage':<32} {'runs':>5} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} {'items/s':>12} {'peak KiB':>10}"]
+    for result in results:
+        row = result.to_dict()
+        lines.append(f"{row['name']:<32} {row['runs']:>5} {row['p50_ms']:>10.3f} {row['p90_ms']:>10.3f} {row['p99_ms']:>10.3f} {row['items_per_second']:>12.1f} {row['peak_memory_kib']:>10.1f}")
+    return "\n".join(lines)
+
+# pylint: disable=missing-function-docstring
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the analysis and scoring pipeline on synthetic data.")
+    parser.add_argument("--stages", nargs="+", choices=["startup", "extract", "train", "score", "preferences", "pipeline"], default=["startup", "extract", "train", "score", "preferences", "pipeline"], help="the stages to benchmark")
+    parser.add_argument("--repeat", type=int, default=constants.BENCHMARK_REPEAT, help="timed runs per stage")
+    parser.add_argument("--quick", action="store_true", help="skip the largest history and use a smaller pipeline corpus")
+    parser.add_argument("--json", metavar="FILE", help="also write the results as JSON to the file ('-' for stdout)")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the results to the baseline file, exiting with status 1 on regressions")
+    parser.add_argument("--save-baseline", metavar="FILE", help="write the results to the file to be used as the baseline of later runs")
+    parser.add_argument("--startup-target", type=float, default=constants.STARTUP_TARGET_SECONDS, help="maximum median cold start in seconds, exiting with status 1 if it is slower")
+    parser.add_argument("--tolerance", type=float, default=constants.BENCHMARK_TOLERANCE, help="allowed relative growth of the median latency and peak memory over the baseline")
+    return parser.parse_args()
+
+def main():
+    arguments = parse_arguments()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.WARNING)
+    results = run_benchmarks(arguments.stages, max(1, arguments.repeat), arguments.quick)
+    print(format_table(results))
+    results_dict = {result.name: result.to_dict() for result in results}
+    if arguments.json is not None:
+        if arguments.json == "-":
+            print(json.dumps(results_dict, indent=4))
+        else:
+            json_files.write_json_atomically(arguments.json, results_dict, indent=4)
+    if arguments.save_baseline is not None:
+        json_files.write_json_atomically(arguments.save_baseline, results_dict, indent=4)
+    startup_miss = check_startup_target(results, arguments.startup_target)
+    if startup_miss is not None:
+        print(f"Cold start over the target: {startup_miss}")
+        sys.exit(1)
+    if arguments.baseline is not None:
+        baseline = user_preferences_handler.read_json(arguments.baseline)
+        if baseline is None:
+            logging.error(f"Error: Failed to read the baseline file '{arguments.baseline}'")
+            sys.exit(2)
+        regressions = compare_to_baseline(results, baseline, arguments.tolerance)
+        if len(regressions) > 0:
+            print("Regressions against the baseline:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("No regressions against the baseline")
+# pylint: enable=missing-function-docstring
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,55 @@
 Some global constants
 """
 
+import os
+
 MIN_SCORE=0
 MAX_SCORE=10
-PREFERENCES_PATH = ".\\user_preferences.json"
\ No newline at end of file
+PREFERENCES_PATH = ".\\user_preferences.json"
+BATCH_FETCH_WORKERS = 8
+BATCH_LLM_WORKERS = 4
+PAGE_CACHE_PATH = os.path.join(".", "cache", "pages")
+PAGE_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+PAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+PAGE_CACHE_INDEX_COMPACTION_INTERVAL = 1000
+ANALYSIS_CACHE_PATH = os.path.join(".", "cache", "analyses.jsonl")
+LOCAL_ALIGNMENT_MIN_CONFIDENCE = 0.3
+ONLINE_CALIBRATION_BINS = 21
+ONLINE_CALIBRATION_BANDWIDTH = 1.0
+ONLINE_CALIBRATION_PRIOR_WEIGHT = 2.0
+LOOKUP_TABLE_RESOLUTION = 1001
+JOURNAL_COMPACTION_INTERVAL = 50
+PROFILES_PATH = os.path.join(".", "profiles")
+PROFILE_STORE_CAPACITY = 128
+FETCH_MAX_CONNECTIONS = 64
+FETCH_PER_HOST_LIMIT = 4
+FETCH_TIMEOUT_SECONDS = 30
+FETCH_MAX_RETRIES = 3
+FETCH_BACKOFF_SECONDS = 0.5
+FETCH_MAX_RETRY_AFTER_SECONDS = 60
+EXTRACTION_WORKERS = 0
+PROMPT_TOKEN_BUDGET = 8000
+PROMPT_TOP_INTERESTS = 40
+LLM_STRUCTURED_OUTPUT = True
+LLM_STREAM_RESPONSES = True
+LLM_REPAIR_ATTEMPTS = 1
+PACK_TOKEN_BUDGET = 32000
+PACK_CONTEXT_FRACTION = 0.5
+PACK_OUTPUT_TOKENS_PER_ARTICLE = 100
+PACK_MAX_WAIT_SECONDS = 2.0
+MODEL_LIST_CACHE_PATH = os.path.join(".", "cache", "models.json")
+MODEL_LIST_CACHE_TTL_SECONDS = 24 * 60 * 60
+RECORDING_PATH = os.path.join(".", "cache", "recording.jsonl")
+BENCHMARK_REPEAT = 20
+BENCHMARK_TOLERANCE = 0.25
+SEEN_INDEX_PATH = os.path.join(".", "cache", "seen.jsonl")
+READING_LIST_SIZE = 100
+FEED_POLL_INTERVAL_SECONDS = 15 * 60
+NEAR_DUPLICATE_INDEX_PATH = os.path.join(".", "cache", "near_duplicates.jsonl")
+NEAR_DUPLICATE_THRESHOLD = 0.8
+NEAR_DUPLICATE_PERMUTATIONS = 128
+NEAR_DUPLICATE_BAND_ROWS = 4
+NEAR_DUPLICATE_SHINGLE_WORDS = 5
+STARTUP_TARGET_SECONDS = 0.5
+THEME_PRUNE_MAX_ARTICLES = 1
+THEME_PRUNE_AFTER_RATINGS = 200
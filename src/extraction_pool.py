@@ -0,0 +1,96 @@
+"""
+Handling of the article extraction in a pool of worker processes, so that bulk analysis uses all of the cores for the CPU-heavy parsing
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import multiprocessing
+import os
+import typing
+import zlib
+
+import fetch_article
+import metrics
+import page_cache as page_cache_module
+
+Key = typing.TypeVar("Key")
+
+def _extract_compressed(compressed_webpage: bytes) -> typing.Optional[dict[str, typing.Optional[str]]]:
+    # Runs in the worker processes, only the compressed page goes in and only the small metadata dictionary comes back
+    return fetch_article.extract_raw_metadata(zlib.decompress(compressed_webpage).decode("utf-8"))
+
+class ExtractionPool:
+    """
+    Extracts the article metadata in `workers` processes (one per core by default), going through the page cache if one is given.
+    The pages are sent to the workers zlib-compressed at the fastest level, which shrinks the HTML several times for little CPU time.
+    """
+    def __init__(self, workers: typing.Optional[int] = None, page_cache: typing.Optional[page_cache_module.PageCache] = None):
+        self.workers = workers if workers is not None and workers > 0 else (os.cpu_count() or 1)
+        self.page_cache = page_cache
+        # The pool is started while other threads are running, and forking a multi-threaded process can deadlock the child on a lock held by another thread
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self._executor = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(start_method))
+
+    def __enter__(self) -> ExtractionPool:
+        return self
+
+    def __exit__(self, *exception_info: typing.Any):
+        self.close()
+
+    def submit(self, webpage: str) -> concurrent.futures.Future[typing.Optional[fetch_article.ArticleMetadata]]:
+        """
+        Starts extracting the metadata from the page, returning a future for the result
+        """
+        result: concurrent.futures.Future[typing.Optional[fetch_article.ArticleMetadata]] = concurrent.futures.Future()
+        content_hash = None
+        if self.page_cache is not None:
+            content_hash = page_cache_module.hash_content(webpage)
+            is_cached, cached_data = self.page_cache.get_extracted(content_hash)
+            if is_cached:
+                result.set_result(fetch_article.metadata_from_dict(cached_data))
+                return result
+
+        def on_done(extraction: concurrent.futures.Future[typing.Optional[dict[str, typing.Optional[str]]]]):
+            exception = extraction.exception()
+            if exception is not None:
+                result.set_exception(exception)
+                return
+            extracted_data = extraction.result()
+            if self.page_cache is not None and content_hash is not None:
+                self.page_cache.put_extracted(content_hash, extracted_data)
+            result.set_result(fetch_article.metadata_from_dict(extracted_data))
+
+        self._executor.submit(_extract_compressed, zlib.compress(webpage.encode("utf-8"), 1)).add_done_callback(on_done)
+        return result
+
+    def extract(self, webpage: typing.Optional[str]) -> typing.Optional[fetch_article.ArticleMetadata]:
+        """
+        Extracts the metadata from the page, blocking until it is done
+        """
+        if webpage is None:
+            return None
+        with metrics.span("extract"):
+            return self.submit(webpage).result()
+
+    def extract_many(self, webpages: typing.Iterable[typing.Tuple[Key, str]], max_in_flight: typing.Optional[int] = None) -> typing.Iterator[typing.Tuple[Key, typing.Optional[fetch_article.ArticleMetadata]]]:
+        """
+        Extracts the metadata from (key, page) pairs, yielding (key, metadata) as soon as each page finishes (not in the input order).
+        At most `max_in_flight` pages (twice the number of workers by default) are held in memory at once.
+        """
+        max_in_flight = max_in_flight if max_in_flight is not None else 2 * self.workers
+        in_flight: dict[concurrent.futures.Future[typing.Optional[fetch_article.ArticleMetadata]], Key] = {}
+        for key, webpage in webpages:
+            if len(in_flight) >= max_in_flight:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield in_flight.pop(future), future.result()
+            in_flight[self.submit(webpage)] = key
+        for future in concurrent.futures.as_completed(list(in_flight)):
+            yield in_flight.pop(future), future.result()
+
+    def close(self):
+        """
+        Shuts the worker processes down
+        """
+        self._executor.shutdown()
@@ -0,0 +1,315 @@
+"""
+Handling of the service mode that polls feeds and sitemaps for new articles and analyses them in the background for all users
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import queue
+import threading
+import time
+import typing
+import urllib.parse
+
+import analysis_cache as analysis_cache_module
+import article_analysis
+import fetch_article
+import json_files
+import llm_backend
+import llm_response
+import metrics
+import page_cache as page_cache_module
+import profile_store as profile_store_module
+import prompt_builder as prompt_builder_module
+import reading_list
+import constants
+
+def is_sitemap(source_url: str) -> bool:
+    """
+    Returns whether the source is a sitemap rather than a feed or a page linking to feeds
+    """
+    return "sitemap" in urllib.parse.urlsplit(source_url).path.lower()
+
+def discover_urls(source_url: str) -> list[str]:
+    """
+    Returns the article URLs currently listed by the feed or sitemap, feeds are also discovered from the links of a homepage
+    """
+    import trafilatura.feeds # pylint: disable=import-outside-toplevel
+    import trafilatura.sitemaps # pylint: disable=import-outside-toplevel
+    try:
+        if is_sitemap(source_url):
+            return trafilatura.sitemaps.sitemap_search(source_url)
+        return trafilatura.feeds.find_feed_urls(source_url)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        logging.error(f"Error: Failed to read the article list of '{source_url}': {e}")
+        return []
+
+def fingerprint_text(text: str) -> str:
+    """
+    Returns the fingerprint of the article text, equal for copies differing only in case and whitespace
+    """
+    return hashlib.sha256(" ".join(text.casefold().split()).encode("utf-8")).hexdigest()
+
+class SeenIndex:
+    """
+    A persistent index of the processed articles, keyed by the normalized URL and by the fingerprint of the extracted text,
+    so that neither a URL nor a republished copy of a text is analysed twice.
+    The index is stored as an append-only JSON lines file.
+    """
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._urls: set[str] = set()
+        self._fingerprints: dict[str, str] = {}
+        self._load()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._urls)
+
+    def contains(self, url: str) -> bool:
+        """
+        Returns whether the article at the URL was already processed
+        """
+        with self._lock:
+            return page_cache_module.normalize_url(url) in self._urls
+
+    def find_duplicate(self, fingerprint: str) -> typing.Optional[str]:
+        """
+        Returns the URL of the first processed article with the same text, or None if there is none
+        """
+        with self._lock:
+            return self._fingerprints.get(fingerprint)
+
+    def recent(self, count: int) -> list[str]:
+        """
+        Returns the URLs of the `count` most recently processed articles with a text, without the copies of the same text
+        """
+        with self._lock:
+            return list(self._fingerprints.values())[-count:]
+
+    def add(self, url: str, fingerprint: typing.Optional[str]):
+        """
+        Marks the article as processed, the fingerprint is None for articles without any extracted text
+        """
+        normalized_url = page_cache_module.normalize_url(url)
+        with self._lock:
+            self._urls.add(normalized_url)
+            if fingerprint is not None:
+                self._fingerprints.setdefault(fingerprint, url)
+            try:
+                json_files.append_json_line(self.index_path, {"url": url, "fingerprint": fingerprint})
+            except OSError as e:
+                logging.error(f"Error: Failed to save the processed article to '{self.index_path}': {e}")
+
+    def _load(self):
+        for record in json_files.read_json_lines(self.index_path, "processed article index"):
+            self._urls.add(page_cache_module.normalize_url(record["url"]))
+            if record.get("fingerprint") is not None:
+                self._fingerprints.setdefault(record["fingerprint"], record["url"])
+
+class FeedDaemon:
+    """
+    Polls the sources every `poll_interval_seconds` and queues the articles that were not processed yet.
+    `workers` threads take the articles off the queue, analyse each one once for all of the users of the profile store
+    (sharing the preference-independent part of the analysis) and add it to the reading list of each user.
+    Articles that fail to be fetched or analysed are not marked as processed, so they are tried again on the next poll,
+    and no articles are processed while there are no users, so that the users created later get them too.
+    The users and their profiles are resolved once per poll, reloading the profiles another process (an interactive session rating articles) changed,
+    but never writing them. A user seen for the first time with an empty reading list gets the recently processed articles added to it.
+    """
+    def __init__(self, backend: llm_backend.LLMBackend, profiles: profile_store_module.ProfileStore, reading_lists: reading_list.ReadingListStore, sources: list[str], seen: SeenIndex,
+                 page_cache: typing.Optional[page_cache_module.PageCache] = None, analysis_cache: typing.Optional[analysis_cache_module.AnalysisCache] = None,
+                 prompt_builder: typing.Optional[prompt_builder_module.PromptBuilder] = None, response_reader: typing.Optional[llm_response.ResponseReader] = None,
+                 workers: int = constants.BATCH_LLM_WORKERS, poll_interval_seconds: float = constants.FEED_POLL_INTERVAL_SECONDS):
+        self.context = article_analysis.AnalysisContext(backend, analysis_cache, prompt_builder, response_reader)
+        self.profiles = profiles
+        self.reading_lists = reading_lists
+        self.sources = sources
+        self.seen = seen
+        self.page_cache = page_cache
+        self.workers = max(1, workers)
+        self.poll_interval_seconds = poll_interval_seconds
+        self.analysed = 0
+        self.duplicates = 0
+        self.failed = 0
+        # The queued articles with the users to add them for, None for all users of the current poll
+        self._queue: queue.Queue[typing.Optional[typing.Tuple[str, typing.Optional[list[profile_store_module.UserProfile]]]]] = queue.Queue()
+        self._queued: set[str] = set()
+        # Fingerprints of the texts being analysed, so that two copies arriving at the same time are not both analysed
+        self._in_progress: dict[str, str] = {}
+        self._users: typing.Optional[list[profile_store_module.UserProfile]] = None
+        self._known_user_ids: set[str] = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def poll(self) -> int:
+        """
+        Queues the new articles of all sources, returning how many were queued
+        """
+        if len(self.refresh_users()) == 0:
+            logging.info(f"There are no users under '{self.profiles.base_dir}' yet, the sources are not polled")
+            return 0
+        queued = 0
+        for source_url in self.sources:
+            for url in discover_urls(source_url):
+                normalized_url = page_cache_module.normalize_url(url)
+                with self._lock:
+                    if normalized_url in self._queued or self.seen.contains(url):
+                        continue
+                    self._queued.add(normalized_url)
+                self._queue.put((url, None))
+                queued += 1
+        metrics.increment("feed_articles_queued_total", queued)
+        logging.info(f"Queued {queued} new articles from {len(self.sources)} sources, {self._queue.qsize()} waiting")
+        return queued
+
+    def refresh_users(self) -> list[profile_store_module.UserProfile]:
+        """
+        Resolves the users and their (reloaded if changed) profiles for the articles of the next poll,
+        queueing the recently processed articles for the new users with an empty reading list
+        """
+        profiles = [self.profiles.get(user_id, reload_changed=True) for user_id in self.profiles.user_ids()]
+        with self._lock:
+            self._users = profiles
+            new_profiles = [profile for profile in profiles if profile.user_id not in self._known_user_ids]
+            self._known_user_ids.update(profile.user_id for profile in new_profiles)
+        new_profiles = [profile for profile in new_profiles if len(self.reading_lists.get(profile.user_id, 1)) == 0]
+        if len(new_profiles) > 0:
+            recent_urls = self.seen.recent(self.reading_lists.max_entries)
+            logging.info(f"Adding {len(recent_urls)} recent articles to the reading lists of {len(new_profiles)} new users")
+            for url in recent_urls:
+                self._queue.put((url, new_profiles))
+        return profiles
+
+    def process(self, url: str):
+        """
+        Fetches and analyses a single article and adds it to the reading lists, skipping copies of already processed texts
+        """
+        with self._lock:
+            profiles = self._users
+        if profiles is None:
+            profiles = self.refresh_users()
+        if len(profiles) == 0:
+            # Left unprocessed, so that it is polled again once there are users
+            return
+        metadata = fetch_article.extract_article_metadata(fetch_article.fetch_article(url, self.page_cache), self.page_cache)
+        if metadata is None:
+            with self._lock:
+                self.failed += 1
+            return
+        fingerprint = fingerprint_text(metadata.text)
+        with self._lock:
+            original_url = self.seen.find_duplicate(fingerprint) or self._in_progress.get(fingerprint)
+            if original_url is None:
+                self._in_progress[fingerprint] = url
+        if original_url is not None:
+            logging.info(f"Skipping '{url}', the same text as '{original_url}'")
+            metrics.increment("feed_duplicates_total")
+            with self._lock:
+                self.duplicates += 1
+            self.seen.add(url, fingerprint)
+            return
+        try:
+            self._add_to_reading_lists(url, metadata, profiles)
+            self.seen.add(url, fingerprint)
+            with self._lock:
+                self.analysed += 1
+        finally:
+            with self._lock:
+                self._in_progress.pop(fingerprint, None)
+
+    def backfill(self, url: str, profiles: list[profile_store_module.UserProfile]):
+        """
+        Adds an already processed article to the reading lists of the given users, reusing its cached analysis
+        """
+        metadata = fetch_article.extract_article_metadata(fetch_article.fetch_article(url, self.page_cache), self.page_cache)
+        if metadata is None:
+            logging.warning(f"Warning: Failed to fetch the processed article '{url}' again for the new users")
+            return
+        self._add_to_reading_lists(url, metadata, profiles)
+
+    def rescore(self):
+        """
+        Re-ranks the reading lists of the users of the last poll with their current calibration models, which change as they rate articles
+        """
+        with self._lock:
+            profiles = self._users
+        for profile in profiles if profiles is not None else self.refresh_users():
+            self.reading_lists.rescore(profile.user_id, profile.models)
+
+    def start(self):
+        """
+        Starts the worker threads
+        """
+        self._stopping.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"feed-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def run(self):
+        """
+        Starts the workers and polls the sources until `stop` is called
+        """
+        self.start()
+        while not self._stopping.is_set():
+            self.poll()
+            self.rescore()
+            self._stopping.wait(self.poll_interval_seconds)
+
+    def wait_until_idle(self):
+        """
+        Blocks until every queued article has been processed
+        """
+        self._queue.join()
+
+    def stop(self):
+        """
+        Stops polling and waits for the workers to finish the article they are processing, the rest of the queue is dropped
+        """
+        self._stopping.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+                self._queue.task_done()
+            except queue.Empty:
+                break
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        with self._lock:
+            self._queued.clear()
+        logging.info(f"Stopped after analysing {self.analysed} articles, skipping {self.duplicates} duplicates, {self.failed} failed")
+
+    def _add_to_reading_lists(self, url: str, metadata: fetch_article.ArticleMetadata, profiles: list[profile_store_module.UserProfile]):
+        analyses = article_analysis.analyse_metadata_for_users(self.context, metadata, [profile.preferences for profile in profiles])
+        for profile, analysis in zip(profiles, analyses):
+            scores = article_analysis.rate_article(analysis, profile.models)
+            self.reading_lists.add(profile.user_id, reading_list.ReadingListEntry(url, analysis, scores, time.time()))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            url, profiles = item
+            try:
+                if profiles is None:
+                    self.process(url)
+                else:
+                    self.backfill(url, profiles)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                logging.error(f"Error: Failed to analyse '{url}': {e}")
+                with self._lock:
+                    self.failed += 1
+            finally:
+                if profiles is None:
+                    with self._lock:
+                        self._queued.discard(page_cache_module.normalize_url(url))
+                self._queue.task_done()
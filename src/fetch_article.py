@@ -6,8 +6,10 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 import json
+import logging
 import typing
-import trafilatura
+import metrics
+import page_cache as page_cache_module
 
 @dataclass
 class ArticleMetadata:
@@ -28,19 +30,73 @@ class ArticleMetadata:
         """
         return f"Title: {self.title}\nSource: {self.hostname}\nText: {self.text}"
 
-def fetch_article(url: str) -> typing.Optional[str]:
+    def to_dict(self) -> dict[str, typing.Optional[str]]:
+        """
+        Converts the class to a JSON serializable dictionary
+        """
+        return {
+            "title": self.title,
+            "text": self.text,
+            "hostname": self.hostname
+        }
+
+def fetch_article(url: str, page_cache: typing.Optional[page_cache_module.PageCache] = None) -> typing.Optional[str]:
     """
-    Fetches the article text from the url provided
+    Fetches the article text from the url provided, going through the page cache if one is given
     """
-    downloaded_page = trafilatura.fetch_url(url)
+    if page_cache is not None:
+        cached_page = page_cache.get_page(url)
+        if cached_page is not None:
+            return cached_page
+        if page_cache.offline:
+            logging.warning(f"Warning: '{url}' is not in the page cache and the cache is in offline mode.")
+            return None
+    # trafilatura is only imported once something is fetched or extracted, to keep the startup fast
+    import trafilatura # pylint: disable=import-outside-toplevel
+    with metrics.span("fetch"):
+        downloaded_page = trafilatura.fetch_url(url)
+    if downloaded_page is not None and page_cache is not None:
+        page_cache.put_page(url, downloaded_page)
     return downloaded_page
 
-def extract_article_metadata(webpage: str) -> typing.Optional[ArticleMetadata]:
+def extract_article_metadata(webpage: typing.Optional[str], page_cache: typing.Optional[page_cache_module.PageCache] = None) -> typing.Optional[ArticleMetadata]:
+    """
+    Extracts the metadata from the article text, reusing the cached extraction of identical pages if a page cache is given
+    """
+    if webpage is None:
+        return None
+    content_hash = None
+    if page_cache is not None:
+        content_hash = page_cache_module.hash_content(webpage)
+        is_cached, cached_data = page_cache.get_extracted(content_hash)
+        if is_cached:
+            return metadata_from_dict(cached_data)
+    with metrics.span("extract"):
+        extracted_data = extract_raw_metadata(webpage)
+    if page_cache is not None and content_hash is not None:
+        page_cache.put_extracted(content_hash, extracted_data)
+    return metadata_from_dict(extracted_data)
+
+def extract_raw_metadata(webpage: str) -> typing.Optional[dict[str, typing.Optional[str]]]:
     """
-    Extracts the metadata from the article text
+    Runs the extraction itself, returning the metadata as a dictionary (or None if the extraction failed)
     """
+    import trafilatura # pylint: disable=import-outside-toplevel
     extracted_raw = trafilatura.extract(webpage, output_format="json", with_metadata=True)
     if extracted_raw is None:
         return None
     extracted_data = json.loads(extracted_raw)
-    return ArticleMetadata(extracted_data.get("title"), extracted_data.get("text"), extracted_data.get("hostname"))
\ No newline at end of file
+    return ArticleMetadata(extracted_data.get("title"), extracted_data.get("text"), extracted_data.get("hostname")).to_dict()
+
+def metadata_from_dict(extracted_data: typing.Optional[dict[str, typing.Optional[str]]]) -> typing.Optional[ArticleMetadata]:
+    """
+    Creates the metadata from the dictionary produced by `extract_raw_metadata`
+    """
+    if extracted_data is None:
+        return None
+    title = extracted_data.get("title")
+    text = extracted_data.get("text")
+    if text is None:
+        # Nothing to analyse, the same as a failed extraction
+        return None
+    return ArticleMetadata(title if title is not None else "", text, extracted_data.get("hostname"))
\ No newline at end of file
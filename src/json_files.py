@@ -0,0 +1,55 @@
+"""
+Reading and writing the JSON and append-only JSON lines files of the caches, indexes and journals
+"""
+
+import json
+import logging
+import os
+import tempfile
+import typing
+
+def read_json_lines(path: str, description: str) -> typing.Iterator[dict[str, typing.Any]]:
+    """
+    Yields the records of an append-only JSON lines file, none if it does not exist yet.
+    Malformed lines are skipped with a warning, as a line cut short by a crash while appending leaves the rest of the file usable.
+    """
+    try:
+        with open(path, 'r', encoding = "utf-8") as file:
+            for line_number, line in enumerate(file, start=1):
+                if len(line.strip()) == 0:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"Warning: Skipping the malformed line {line_number} of the {description} '{path}'.")
+    except FileNotFoundError:
+        pass
+
+def append_json_line(path: str, record: typing.Any, durable: bool = False):
+    """
+    Appends the record as one line to a JSON lines file, creating its directory first.
+    With `durable` the line is synced to the disk before returning.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a', encoding = "utf-8") as file:
+        file.write(json.dumps(record) + "\n")
+        if durable:
+            file.flush()
+            os.fsync(file.fileno())
+
+def write_json_atomically(path: str, data: typing.Any, indent: typing.Optional[int] = None):
+    """
+    Writes the JSON to a temporary file first and then replaces the target with it, so a crash never leaves a truncated file behind
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, 'w', encoding = "utf-8") as file:
+            json.dump(data, file, indent=indent)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
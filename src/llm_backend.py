@@ -0,0 +1,309 @@
+"""
+Handling of the LLM backends the articles are analysed with
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import abc
+import ast
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import types
+import typing
+
+import json_files
+import prompts
+import theme_alignment
+import user_preferences_handler
+import constants
+
+if typing.TYPE_CHECKING:
+    import google.generativeai
+    import google.generativeai.types
+
+BACKEND_NAMES = ["gemini", "local", "record", "replay"]
+ResponseSchema: typing.TypeAlias = typing.Optional[dict[str, typing.Any]]
+
+@dataclass
+class ModelInfo:
+    """
+    A data structure class for storing the name and the context limits of a model
+    """
+    name: str
+    input_token_limit: int
+    output_token_limit: int
+    def __init__(self, name: str, input_token_limit: int, output_token_limit: int):
+        self.name = name
+        self.input_token_limit = input_token_limit
+        self.output_token_limit = output_token_limit
+
+    def to_dict(self) -> dict[str, typing.Union[str, int]]:
+        """
+        Converts the class to a JSON serializable dictionary
+        """
+        return {
+            "name": self.name,
+            "input_token_limit": self.input_token_limit,
+            "output_token_limit": self.output_token_limit
+        }
+
+def read_model_list_cache(cache_path: str) -> typing.Optional[typing.Tuple[float, list[ModelInfo]]]:
+    """
+    Reads the cached model list, returning when it was fetched and the models, or None if there is no usable cache (a missing one is not an error)
+    """
+    try:
+        with open(cache_path, 'r', encoding = "utf-8") as file:
+            cached = json.load(file)
+        models = [ModelInfo(str(model["name"]), int(model["input_token_limit"]), int(model["output_token_limit"])) for model in cached["models"]]
+        return float(cached["fetched_at"]), models
+    except FileNotFoundError:
+        return None
+    except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        logging.warning(f"Warning: Ignoring the unreadable model list cache '{cache_path}': {e}")
+        return None
+
+class LLMBackend(abc.ABC):
+    """
+    The interface of the LLM backends, generating text for a prompt under a system instruction,
+    optionally constrained to a JSON response schema
+    """
+    model_name: str
+
+    @abc.abstractmethod
+    def generate_text(self, prompt: str, system_instruction: str, response_schema: ResponseSchema = None) -> str:
+        """
+        Generates the whole response to the prompt
+        """
+
+    def stream_text(self, prompt: str, system_instruction: str, response_schema: ResponseSchema = None) -> typing.Iterator[str]:
+        """
+        Generates the response to the prompt in chunks, backends without streaming return it in a single chunk
+        """
+        yield self.generate_text(prompt, system_instruction, response_schema)
+
+class GeminiBackend(LLMBackend):
+    """
+    Generates the responses with a Gemini model, the API key must already be set with `configure`.
+    The client library takes seconds to import, so it is only imported on first use.
+    """
+    api_key: typing.Optional[str] = None
+    _client: typing.Optional[types.ModuleType] = None
+    _client_lock = threading.Lock()
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self._models: dict[str, google.generativeai.GenerativeModel] = {}
+        self._lock = threading.Lock()
+
+    def generate_text(self, prompt: str, system_instruction: str, response_schema: ResponseSchema = None) -> str:
+        return self._model(system_instruction).generate_content(prompt, generation_config=GeminiBackend._generation_config(response_schema)).text
+
+    def stream_text(self, prompt: str, system_instruction: str, response_schema: ResponseSchema = None) -> typing.Iterator[str]:
+        for chunk in self._model(system_instruction).generate_content(prompt, generation_config=GeminiBackend._generation_config(response_schema), stream=True):
+            yield chunk.text
+
+    @staticmethod
+    def configure(api_key: str):
+        """
+        Sets the API key of the Gemini API, it is passed to the client library once it is imported
+        """
+        GeminiBackend.api_key = api_key
+
+    @staticmethod
+    def client() -> types.ModuleType:
+        """
+        Returns the configured client library, importing it on first use
+        """
+        with GeminiBackend._client_lock:
+            if GeminiBackend._client is None:
+                import google.generativeai # pylint: disable=import-outside-toplevel,redefined-outer-name
+                if GeminiBackend.api_key is not None:
+                    google.generativeai.configure(api_key=GeminiBackend.api_key)
+                GeminiBackend._client = google.generativeai
+            return GeminiBackend._client
+
+    def _model(self, system_instruction: str) -> google.generativeai.GenerativeModel:
+        with self._lock:
+            if system_instruction not in self._models:
+                self._models[system_instruction] = GeminiBackend.client().GenerativeModel(self.model_name, system_instruction=system_instruction)
+            return self._models[system_instruction]
+
+    @staticmethod
+    def _generation_config(response_schema: ResponseSchema) -> typing.Optional[google.generativeai.types.GenerationConfigDict]:
+        if response_schema is None:
+            return None
+        return {"response_mime_type": "application/json", "response_schema": response_schema}
+
+    @staticmethod
+    def list_models(cache_path: str = constants.MODEL_LIST_CACHE_PATH, max_age_seconds: float = constants.MODEL_LIST_CACHE_TTL_SECONDS, refresh: bool = False) -> list[ModelInfo]:
+        """
+        Returns the models that can generate content, from the on-disk cache if it is recent enough and from the API otherwise
+        """
+        cached = None if refresh else read_model_list_cache(cache_path)
+        if cached is not None and time.time() - cached[0] <= max_age_seconds:
+            return cached[1]
+        models = [ModelInfo(model.name, model.input_token_limit, model.output_token_limit) for model in GeminiBackend.client().list_models() if "generateContent" in model.supported_generation_methods]
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            json_files.write_json_atomically(cache_path, {"fetched_at": time.time(), "models": [model.to_dict() for model in models]})
+        except OSError as e:
+            logging.warning(f"Warning: Failed to cache the model list to '{cache_path}': {e}")
+        return models
+
+WORD_PATTERN = re.compile(r"[^\W\d_]+(?:['-][^\W\d_]+)*")
+STOPWORDS = frozenset("""a about above after again against all also am an and any are as at be because been before being below between both but by can could did do does doing down during each
+few for from further had has have having he her here hers herself him himself his how i if in into is it its itself just let me more most my myself no nor not now of off on once only or other
+our ours ourselves out over own same she should so some such than that the their theirs them themselves then there these they this those through to too under until up very was we were what
+when where which while who whom why will with would you your yours yourself yourselves""".split())
+FILLER_WORDS = frozenset("""actually absolutely amazing arguably basically certainly clearly completely definitely essentially extremely fairly honestly incredibly indeed just literally
+maybe perhaps pretty quite rather really seemingly simply somehow somewhat sort totally truly ultimately utterly various very virtually""".split())
+LOCAL_MODEL_INFO = ModelInfo("local-heuristic", 1_000_000, 65_536)
+
+class HeuristicBackend(LLMBackend):
+    """
+    A local, deterministic stand-in for the LLM that answers the analysis prompts from word statistics, for benchmarking the pipeline offline.
+    The main themes are the most frequent content words (title words counted three times), the fluffiness grows with the share of stopwords and filler words,
+    the title descriptiveness is the share of title words found in the text and the alignment is computed from the themes with `theme_alignment`.
+    """
+    def __init__(self, model_name: str = LOCAL_MODEL_INFO.name):
+        self.model_name = model_name
+
+    def generate_text(self, prompt: str, system_instruction: str, response_schema: ResponseSchema = None) -> str:
+        if system_instruction == prompts.PACKED_SYSTEM_INSTRUCTION:
+            interests: typing.Optional[dict[str, float]] = HeuristicBackend._parse_interests(prompt)
+            articles = re.split(r"^Article (\d+):\n", prompt.split("\n\nUser interests: ")[0], flags=re.MULTILINE)
+            item_schema = None if response_schema is None else response_schema.get("items")
+            analyses = [{"article": int(number), **self._analyse(article, interests, item_schema)} for number, article in zip(articles[1::2], articles[2::2])]
+            return json.dumps(analyses)
+        if system_instruction == prompts.ALIGNMENT_SYSTEM_INSTRUCTION:
+            themes_match = re.search(r"^Main themes: (.*)$", prompt, re.MULTILINE)
+            main_themes = [] if themes_match is None else [theme.strip() for theme in themes_match.group(1).split(",") if len(theme.strip()) > 0]
+            return json.dumps(HeuristicBackend._select({"main_themes_alignment": HeuristicBackend._alignment(main_themes, HeuristicBackend._parse_interests(prompt))}, response_schema))
+        interests = None if system_instruction == prompts.INTRINSIC_SYSTEM_INSTRUCTION else HeuristicBackend._parse_interests(prompt)
+        return json.dumps(self._analyse(prompt, interests, response_schema))
+
+    def _analyse(self, article: str, interests: typing.Optional[dict[str, float]], response_schema: ResponseSchema) -> dict[str, typing.Any]:
+        title_match = re.search(r"^Title: (.*)$", article, re.MULTILINE)
+        title = "" if title_match is None else title_match.group(1)
+        text = article.split("\nText: ", 1)[1] if "\nText: " in article else article
+        if interests is not None and "\n{" in text:
+            text = text[:text.rindex("\n{")]
+        words = [word.casefold() for word in WORD_PATTERN.findall(text)]
+        title_words = [word.casefold() for word in WORD_PATTERN.findall(title) if word.casefold() not in STOPWORDS]
+        content_words = [word for word in words if word not in STOPWORDS and len(word) > 3]
+
+        counts = collections.Counter(content_words)
+        for word in title_words:
+            counts[word] += 3
+        # Sorting by the word as well keeps the ties deterministic
+        main_themes = [word for word, _ in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:5]]
+        filler_share = sum(1 for word in words if word in STOPWORDS or word in FILLER_WORDS) / max(1, len(words))
+        how_fluffy = round(min(constants.MAX_SCORE, max(constants.MIN_SCORE, (filler_share - 0.35) / 0.3 * constants.MAX_SCORE)), 1)
+        text_words = set(words)
+        how_descriptive_title = round(constants.MAX_SCORE * sum(1 for word in title_words if word in text_words) / max(1, len(title_words)), 1)
+        analysis: dict[str, typing.Any] = {"main_themes": main_themes, "how_fluffy": how_fluffy, "how_descriptive_title": how_descriptive_title}
+        if interests is not None:
+            analysis["main_themes_alignment"] = HeuristicBackend._alignment(main_themes, interests)
+        return HeuristicBackend._select(analysis, response_schema)
+
+    @staticmethod
+    def _alignment(main_themes: list[str], interests: dict[str, float]) -> float:
+        user_preferences = user_preferences_handler.UserPreferences(typing.cast(user_preferences_handler.RawJsonDict, {"interests": {theme: {"score": score, "articles_analysed": 1} for theme, score in interests.items()}}))
+        return round(theme_alignment.align_themes_with_confidence(main_themes, user_preferences)[0], 1)
+
+    @staticmethod
+    def _parse_interests(prompt: str) -> dict[str, float]:
+        start = prompt.rfind("{")
+        if start < 0:
+            return {}
+        try:
+            interests = ast.literal_eval(prompt[start:].strip())
+        except (ValueError, SyntaxError):
+            return {}
+        return {str(theme): float(score) for theme, score in interests.items()} if isinstance(interests, dict) else {}
+
+    @staticmethod
+    def _select(analysis: dict[str, typing.Any], response_schema: ResponseSchema) -> dict[str, typing.Any]:
+        # Repair requests only ask for the missing fields
+        if response_schema is None or "properties" not in response_schema:
+            return analysis
+        return {field: value for field, value in analysis.items() if field in response_schema["properties"]}
+
+class ReplayMissError(LookupError):
+    """
+    Raised when a replayed prompt was never recorded
+    """
+
+class RecordReplayBackend(LLMBackend):
+    """
+    Records the responses of another backend to a JSON lines file (when `backend` is given) or replays them from it (when it is not),
+    so that a pipeline run can be repeated offline with exactly the same responses.
+    The responses are keyed by the hash of the model name, the system instruction, the prompt and the response schema.
+    """
+    def __init__(self, recording_path: str, backend: typing.Optional[LLMBackend] = None, model_name: typing.Optional[str] = None):
+        self.recording_path = recording_path
+        self.backend = backend
+        self.model_name = backend.model_name if backend is not None else (model_name or "")
+        self._responses: dict[str, str] = {}
+        self._models: set[str] = set()
+        self._lock = threading.Lock()
+        self._load()
+
+    def generate_text(self, prompt: str, system_instruction: str, response_schema: ResponseSchema = None) -> str:
+        key = self._key(prompt, system_instruction, response_schema)
+        with self._lock:
+            recorded = self._responses.get(key)
+        if self.backend is None:
+            if recorded is None:
+                raise ReplayMissError(f"no response recorded in '{self.recording_path}' for this {self.model_name} prompt")
+            return recorded
+        response_text = self.backend.generate_text(prompt, system_instruction, response_schema)
+        with self._lock:
+            self._responses[key] = response_text
+            json_files.append_json_line(self.recording_path, {"key": key, "model": self.model_name, "response": response_text})
+        return response_text
+
+    def list_models(self) -> list[ModelInfo]:
+        """
+        Returns the models that have responses in the recording
+        """
+        return [ModelInfo(name, LOCAL_MODEL_INFO.input_token_limit, LOCAL_MODEL_INFO.output_token_limit) for name in sorted(self._models)]
+
+    def _key(self, prompt: str, system_instruction: str, response_schema: ResponseSchema) -> str:
+        return hashlib.sha256(json.dumps([self.model_name, system_instruction, prompt, response_schema], sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _load(self):
+        for record in json_files.read_json_lines(self.recording_path, "recording"):
+            self._responses[record["key"]] = record["response"]
+            self._models.add(record["model"])
+
+def available_models(backend_name: str, recording_path: str = constants.RECORDING_PATH) -> dict[str, ModelInfo]:
+    """
+    Returns the models the backend can use by name
+    """
+    if backend_name == "local":
+        models = [LOCAL_MODEL_INFO]
+    elif backend_name == "replay":
+        models = RecordReplayBackend(recording_path).list_models()
+    else:
+        models = GeminiBackend.list_models()
+    return {model.name: model for model in models}
+
+def create_backend(backend_name: str, model_name: str, recording_path: str = constants.RECORDING_PATH) -> LLMBackend:
+    """
+    Creates the backend of the given name for the model
+    """
+    if backend_name == "local":
+        return HeuristicBackend(model_name)
+    if backend_name == "record":
+        return RecordReplayBackend(recording_path, GeminiBackend(model_name))
+    if backend_name == "replay":
+        return RecordReplayBackend(recording_path, model_name=model_name)
+    return GeminiBackend(model_name)
@@ -0,0 +1,214 @@
+"""
+Handling of the generation and validation of the JSON responses of the LLM
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import math
+import re
+import typing
+import llm_backend
+import metrics
+import prompt_builder
+import constants
+
+FieldValue: typing.TypeAlias = typing.Union[float, list[str]]
+FIELD_TYPES: dict[str, str] = {
+    "article": "index",
+    "main_themes": "themes",
+    "main_themes_alignment": "score",
+    "how_fluffy": "score",
+    "how_descriptive_title": "score"
+}
+ANALYSIS_FIELDS = ["main_themes", "main_themes_alignment", "how_fluffy", "how_descriptive_title"]
+INTRINSIC_FIELDS = ["main_themes", "how_fluffy", "how_descriptive_title"]
+ALIGNMENT_FIELDS = ["main_themes_alignment"]
+# A number only counts as complete once something follows it, a streamed "7" may still turn into "7.5"
+NUMBER_PATTERN = r"(-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)\s*[,}\n]"
+STRING_LIST_PATTERN = r"\[((?:\s*(?:\"(?:[^\"\\]|\\.)*\"|'[^']*')\s*,?)*)\s*\]"
+OBJECT_PATTERN = re.compile(r"\{[^{}]*\}")
+
+class MalformedResponseError(ValueError):
+    """
+    Raised when the LLM keeps responding without some of the requested fields
+    """
+    def __init__(self, missing_fields: list[str], response_text: str):
+        super().__init__(f"the LLM response is missing valid values for {', '.join(missing_fields)}: {response_text[:200]!r}")
+        self.missing_fields = missing_fields
+        self.response_text = response_text
+
+def response_schema(fields: list[str]) -> dict[str, typing.Any]:
+    """
+    Returns the JSON schema constraining the response to the given fields
+    """
+    properties: dict[str, typing.Any] = {}
+    for field in fields:
+        if FIELD_TYPES[field] == "themes":
+            properties[field] = {"type": "array", "items": {"type": "string"}}
+        elif FIELD_TYPES[field] == "index":
+            properties[field] = {"type": "integer"}
+        else:
+            properties[field] = {"type": "number"}
+    return {"type": "object", "properties": properties, "required": list(fields)}
+
+def clean_response_text(response_text: str) -> str:
+    """
+    Strips the markdown formatting the LLM sometimes wraps its JSON response in
+    """
+    return response_text.strip().removeprefix("```json").removeprefix("```").removeprefix("`").removesuffix("```").removesuffix("`").strip()
+
+def validate_field(field: str, value: typing.Any) -> typing.Optional[FieldValue]:
+    """
+    Returns the value if it is valid for the field (coerced to its type, scores clamped to the score range), or None otherwise
+    """
+    if FIELD_TYPES[field] == "themes":
+        if not isinstance(value, list):
+            return None
+        themes = [theme.strip() for theme in value if isinstance(theme, str) and len(theme.strip()) > 0]
+        return themes if len(themes) > 0 else None
+    if isinstance(value, bool):
+        return None
+    try:
+        score = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(score):
+        return None
+    if FIELD_TYPES[field] == "index":
+        return score if score.is_integer() and score >= 1 else None
+    return float(min(constants.MAX_SCORE, max(constants.MIN_SCORE, score)))
+
+def scan_fields(response_text: str, fields: list[str]) -> dict[str, FieldValue]:
+    """
+    Extracts the valid, complete fields from a possibly truncated or malformed JSON response
+    """
+    values: dict[str, FieldValue] = {}
+    for field in fields:
+        if FIELD_TYPES[field] == "themes":
+            match = re.search(rf"[\"']{field}[\"']\s*:\s*{STRING_LIST_PATTERN}", response_text)
+            if match is None:
+                continue
+            raw_themes = re.findall(r"\"((?:[^\"\\]|\\.)*)\"|'([^']*)'", match.group(1))
+            value: typing.Optional[FieldValue] = validate_field(field, [double_quoted if len(double_quoted) > 0 else single_quoted for double_quoted, single_quoted in raw_themes])
+        else:
+            match = re.search(rf"[\"']{field}[\"']\s*:\s*{NUMBER_PATTERN}", response_text)
+            if match is None:
+                continue
+            value = validate_field(field, match.group(1))
+        if value is not None:
+            values[field] = value
+    return values
+
+def parse_response(response_text: str, fields: list[str]) -> typing.Tuple[dict[str, FieldValue], list[str]]:
+    """
+    Parses and validates the response, returning the valid fields and the names of the missing or invalid ones
+    """
+    with metrics.span("parse_response"):
+        cleaned = clean_response_text(response_text)
+        try:
+            parsed = json.loads(cleaned)
+        except json.JSONDecodeError:
+            parsed = None
+        if isinstance(parsed, dict):
+            values = {field: value for field, value in ((field, validate_field(field, parsed.get(field))) for field in fields) if value is not None}
+        else:
+            # The backends do not report whether a response ended on its own or was cut off by the output limit,
+            # so a number at the very end of an unparseable response is not trusted and the field is asked for again
+            values = scan_fields(cleaned, fields)
+    return values, [field for field in fields if field not in values]
+
+def parse_array_response(response_text: str, fields: list[str], count: int) -> list[typing.Optional[dict[str, FieldValue]]]:
+    """
+    Parses and validates a response with one object per item, each carrying the 1-based index of its item in the "article" field.
+    Returns the fields of each of the `count` items in order, None for the items missing from the response or with invalid fields.
+    """
+    cleaned = clean_response_text(response_text)
+    try:
+        parsed = json.loads(cleaned)
+    except json.JSONDecodeError:
+        parsed = None
+    if isinstance(parsed, list):
+        items = [json.dumps(item) for item in parsed]
+    else:
+        # Salvage the complete objects of a malformed or truncated array
+        items = [match.group(0) for match in OBJECT_PATTERN.finditer(cleaned)]
+    results: list[typing.Optional[dict[str, FieldValue]]] = [None] * count
+    for item in items:
+        values, missing_fields = parse_response(item, ["article", *fields])
+        if len(missing_fields) > 0:
+            continue
+        index = int(typing.cast(float, values.pop("article"))) - 1
+        if index < count and results[index] is None:
+            results[index] = values
+    return results
+
+class ResponseReader:
+    """
+    Asks the LLM for JSON responses with the given fields.
+    With `structured_output` the generation is constrained to the response schema, with `stream` a streamed single-object response is parsed as it arrives
+    and the generation stops as soon as all of the fields are complete.
+    Fields that are still missing or invalid are re-requested on their own up to `repair_attempts` times.
+    """
+    def __init__(self, structured_output: bool = constants.LLM_STRUCTURED_OUTPUT, stream: bool = constants.LLM_STREAM_RESPONSES, repair_attempts: int = constants.LLM_REPAIR_ATTEMPTS):
+        self.structured_output = structured_output
+        self.stream = stream
+        self.repair_attempts = max(0, repair_attempts)
+
+    def generate(self, backend: llm_backend.LLMBackend, prompt: str, fields: list[str], system_instruction: str) -> dict[str, FieldValue]:
+        """
+        Generates the response to the prompt, returning the validated fields or raising `MalformedResponseError` if some of them are still missing after the repairs
+        """
+        response_text = self._generate_text(backend, prompt, fields, system_instruction)
+        values, missing_fields = parse_response(response_text, fields)
+        for _ in range(self.repair_attempts):
+            if len(missing_fields) == 0:
+                break
+            logging.warning(f"Warning: The LLM response is missing valid values for {', '.join(missing_fields)}, asking for them again")
+            metrics.increment("llm_repairs_total")
+            repair_prompt = prompt + f"\n\nRespond only with JSON containing exactly the fields {', '.join(missing_fields)}."
+            response_text = self._generate_text(backend, repair_prompt, missing_fields, system_instruction)
+            repaired_values, missing_fields = parse_response(response_text, missing_fields)
+            values.update(repaired_values)
+        if len(missing_fields) > 0:
+            metrics.increment("llm_malformed_responses_total")
+            raise MalformedResponseError(missing_fields, response_text)
+        return values
+
+    def generate_many(self, backend: llm_backend.LLMBackend, prompt: str, fields: list[str], count: int, system_instruction: str) -> list[typing.Optional[dict[str, FieldValue]]]:
+        """
+        Generates a response with the fields for each of the `count` items described in the prompt, returning None for the items the response is missing.
+        The missing items are not repaired here, the caller is expected to ask for them one by one.
+        """
+        response_text = self._generate_text(backend, prompt, ["article", *fields], system_instruction, as_array=True)
+        return parse_array_response(response_text, fields, count)
+
+    def _generate_text(self, backend: llm_backend.LLMBackend, prompt: str, fields: list[str], system_instruction: str, as_array: bool = False) -> str:
+        metrics.increment("llm_requests_total")
+        # Estimated the same way as the prompt budget, the backends do not report the exact token counts
+        metrics.increment("llm_prompt_tokens_total", prompt_builder.estimate_tokens(system_instruction + prompt))
+        with metrics.span("llm_generate"):
+            response_text = self._request_text(backend, prompt, fields, system_instruction, as_array)
+        metrics.increment("llm_response_tokens_total", prompt_builder.estimate_tokens(response_text))
+        return response_text
+
+    def _request_text(self, backend: llm_backend.LLMBackend, prompt: str, fields: list[str], system_instruction: str, as_array: bool) -> str:
+        schema = None
+        if self.structured_output:
+            schema = response_schema(fields)
+            schema = {"type": "array", "items": schema} if as_array else schema
+        try:
+            if not self.stream or as_array:
+                return backend.generate_text(prompt, system_instruction, schema)
+            response_text = ""
+            for chunk in backend.stream_text(prompt, system_instruction, schema):
+                response_text += chunk
+                if len(scan_fields(response_text, fields)) == len(fields):
+                    break
+            return response_text
+        except ValueError as e:
+            # Raised by the client for responses without any text, e.g. ones blocked by the safety filters
+            logging.warning(f"Warning: The LLM returned no usable text: {e}")
+            metrics.increment("llm_empty_responses_total")
+            return ""
@@ -5,51 +5,33 @@ Only the interests of the user, their preference for how dry/fluffy the text is,
 
 import os
 import sys
+import argparse
+import concurrent.futures
+import contextlib
 import logging
 import time
+import typing
 import dotenv
-import google.generativeai
 import user_preferences_models
+import analysis_cache
 import article_analysis
+import async_fetch
+import batch_analysis
+import extraction_pool
+import feed_daemon
+import llm_backend
+import llm_response
+import near_duplicates
+import metrics
+import page_cache
+import preferences_journal
+import profile_store
+import prompt_builder
+import prompts
+import reading_list
 import user_preferences_handler
 import constants
 
-SYSTEM_INSTRUCTION = """You are a model tasked with analyzing articles and rating certain qualities objectively. You will receive:
-- The article title
-- The article text
-- A dictionary of user interests as theme-score pairs (scores range from 0 = not interested to 10 = main interest)
-Your job is to:
-1. Rate fluffiness of the article text:
-- Rate how "fluffy" the article text is on a scale from 0 to 10:
-- 0 = very raw, factual, concise, informative, only facts are presented (like a scientific paper or straightforward report)
-- 5 = Some filler or vague language, but contains substantial information
-- 10 = extremely fluffy, verbose, filled with filler or vague language, where the reader gains little meaningful information despite article length
-- Consider the density of meaningful, concrete information versus vague, filler, or redundant content.
-
-2. Rate how descriptive the title is:
-- Rate how well the title describes the article content on a scale from 0 to 10:
-- 0 = very clickbait, misleading, or unrelated to the article
-- 10 = fully descriptive, accurately reflects the article content
-
-3. Rate theme alignment with user interests:
-- Carefully read the entire article and infer the overall themes and subjects, even if these themes are not explicitly mentioned as keywords.
-- Consider which themes from the user's interests dictionary best describe the article's main topics, either directly or by close semantic relation.
-- Use your best judgment to estimate how strongly each theme from the user's interests is present or relevant in the article.
-- Assign an alignment score from 0 to 10, reflecting how likely it is that the user would find the article interesting based on their interests.
-- A score of 0 means the article's content is almost completely unrelated or uninteresting to the user's interests.
-- A score of 10 means the article perfectly matches the user's main interests.
-- The alignment score must be independent of fluffiness or title descriptiveness scores.
-- If the article focuses mainly on themes the user rates low, the alignment score should be low. If it matches themes rated high, the score should be high.
-- If the article's content is ambiguous or neutral regarding user interests, assign a score near the middle (around 5).
-- For example, if the user interest dictionary is {'fun': 8, 'sports': 9, politics: '2'} and the article is about upcoming elections, a reasonable score would be around 2. If, however, the article was about a new sports centre opening, a good score would be around 8-9.
-
-4. Extract main themes:
-- Extract 3 to 7 main themes from the article. Each theme should be very short (1-2 words), general, and in English (translate if necessary). These themes should act like tags that summarize the article's core topics.
-
-You must respond only with JSON in plain text, without any markdown or formatting such as ```json and similar. The JSON format is the following:
-{"main_themes": ['theme1', 'theme2, ...], "main_themes_alignment": float, "how_fluffy": float, "how_descriptive_title": float}
-"""
-
 logging.Formatter.converter = time.gmtime
 logging.basicConfig(
     format="%(asctime)s.%(msecs)03dZ %(levelname)s [%(name)s] %(message)s",
@@ -58,24 +40,131 @@ logging.basicConfig(
 )
 
 # pylint: disable=missing-function-docstring
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Predicts if an article is worth reading based on your previous ratings.")
+    parser.add_argument("--batch", metavar="URLS_FILE", help="analyse all URLs from the file (one per line, '-' for stdin) instead of starting the interactive session")
+    parser.add_argument("--output", default="-", help="where to write the batch results as JSON lines ('-' for stdout, the default)")
+    parser.add_argument("--user", help=f"the id of the user whose preferences (stored under '{constants.PROFILES_PATH}') to use instead of the single-user '{constants.PREFERENCES_PATH}'")
+    parser.add_argument("--model", help="the model name to use, skipping the interactive choice")
+    parser.add_argument("--backend", choices=llm_backend.BACKEND_NAMES, default="gemini", help="what analyses the articles: the Gemini API, a local deterministic heuristic (no network, for benchmarking), or the Gemini API with its responses recorded to / replayed from --recording")
+    parser.add_argument("--recording", default=constants.RECORDING_PATH, help="the file the LLM responses are recorded to with '--backend record' and replayed from with '--backend replay'")
+    parser.add_argument("--fetch-workers", type=int, default=constants.BATCH_FETCH_WORKERS, help="maximum number of articles fetched at the same time in batch mode")
+    parser.add_argument("--offline", action="store_true", help="only analyse articles already in the page cache, never fetching anything from the network")
+    parser.add_argument("--no-page-cache", action="store_true", help="always fetch and extract the articles again instead of using the page cache")
+    parser.add_argument("--no-analysis-cache", action="store_true", help="always ask the LLM for a new analysis instead of reusing the cached ones")
+    parser.add_argument("--no-near-duplicates", action="store_true", help="analyse near-duplicate texts (e.g. the same story republished on several sites) again instead of reusing the cached analysis of the first copy")
+    parser.add_argument("--split-analysis", action="store_true", help="analyse the articles without your interests and compute the theme alignment separately, so cached article analyses can be shared between users")
+    parser.add_argument("--calibration", choices=["random-forest", "online"], default="online", help="the models predicting your ratings from the LLM ones, 'online' models are updated with each rating while 'random-forest' models are retrained at startup and after every rating")
+    parser.add_argument("--async-fetch", action="store_true", help="fetch the articles in batch mode over pooled connections with per-host limits, conditional requests and retries instead of one-shot requests")
+    parser.add_argument("--extraction-workers", type=int, default=constants.EXTRACTION_WORKERS, help="number of processes extracting the article text in batch mode (0 to extract on the fetching threads, -1 for one per core)")
+    parser.add_argument("--prompt-token-budget", type=int, default=constants.PROMPT_TOKEN_BUDGET, help="maximum estimated size of a prompt in tokens, longer article texts are trimmed to fit (0 for no limit)")
+    parser.add_argument("--top-interests", type=int, default=constants.PROMPT_TOP_INTERESTS, help="number of your interests most relevant to the article sent to the LLM (0 to send all of them)")
+    parser.add_argument("--plain-output", action="store_true", help="let the LLM answer in free-form text instead of constraining it to the response schema, for models without structured output support")
+    parser.add_argument("--no-stream", action="store_true", help="wait for the whole LLM response instead of parsing it while it streams in")
+    parser.add_argument("--repair-attempts", type=int, default=constants.LLM_REPAIR_ATTEMPTS, help="how many times the fields missing from an LLM response are asked for again before the analysis fails")
+    parser.add_argument("--pack-articles", type=int, default=1, help="maximum number of short articles analysed together in a single LLM request in batch mode, sized down to the context of the model (1 to analyse each article on its own)")
+    parser.add_argument("--llm-workers", type=int, default=constants.BATCH_LLM_WORKERS, help="maximum number of LLM requests running at the same time in batch mode")
+    parser.add_argument("--serve", metavar="SOURCES_FILE", help="run as a service polling the feeds, sitemaps or homepages listed in the file (one per line) and keeping a ranked reading list for every user under '" + constants.PROFILES_PATH + "'")
+    parser.add_argument("--poll-interval", type=float, default=constants.FEED_POLL_INTERVAL_SECONDS, help="seconds between two polls of the sources in service mode")
+    parser.add_argument("--reading-list", type=int, metavar="COUNT", help="print the COUNT best articles of the reading list of --user precomputed by the service mode and exit")
+    parser.add_argument("--metrics", metavar="FILE", help="write the stage timings and counters to the file after every analysis and at exit, in the Prometheus text format for '.prom' and '.txt' files and as JSON otherwise")
+    parser.add_argument("--profile", metavar="FILE", help="profile the first article analysis of the interactive session with cProfile and save the statistics to the file")
+    return parser.parse_args()
+
+def load_profile(arguments: argparse.Namespace) -> typing.Tuple[preferences_journal.PreferencesJournal, user_preferences_handler.UserPreferences, user_preferences_models.UserPreferencesModels]:
+    if arguments.user is None:
+        preferences_store = preferences_journal.PreferencesJournal(constants.PREFERENCES_PATH)
+        preferences = preferences_store.load()
+        return preferences_store, preferences, user_preferences_models.UserPreferencesModels(preferences, arguments.calibration == "online", user_preferences_models.calibration_path(constants.PREFERENCES_PATH))
+    profile = profile_store.ProfileStore(constants.PROFILES_PATH, incremental_models=arguments.calibration == "online").get(arguments.user)
+    return profile.journal, profile.preferences, profile.models
+
 def main():
-    logging.debug(SYSTEM_INSTRUCTION)
+    arguments = parse_arguments()
+    logging.debug(prompts.SYSTEM_INSTRUCTION)
+    if arguments.reading_list is not None:
+        if arguments.user is None:
+            logging.error("The reading list is kept for the users of the service mode, pass the user with --user")
+            sys.exit(1)
+        reading_lists = reading_list.ReadingListStore(profile_store.ProfileStore(constants.PROFILES_PATH))
+        for rank, entry in enumerate(reading_lists.get(arguments.user, arguments.reading_list), 1):
+            print(f"{rank}. {article_analysis.format_score(entry.scores.overall)}/10 {entry.analysis.title} ({entry.analysis.hostname}): {entry.url}")
+        return
     dotenv.load_dotenv()
-    preferences = user_preferences_handler.load(constants.PREFERENCES_PATH)
-    preferences_prediction_models = user_preferences_models.UserPreferencesModels(preferences)
-    GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-    if GOOGLE_API_KEY is None:
-        logging.error("The Google API key must be set to the GOOGLE_API_KEY environment variable")
+    # The models train (and the LLM client imports) while the user is still choosing the model and the action, they are only waited for on first use
+    background = concurrent.futures.ThreadPoolExecutor(2, thread_name_prefix="startup")
+    profile_loading = background.submit(load_profile, arguments)
+    if arguments.offline and arguments.no_page_cache:
+        logging.error("The offline mode requires the page cache, --offline and --no-page-cache can not be used together")
         sys.exit(1)
+    if arguments.profile is not None and (arguments.batch is not None or arguments.serve is not None):
+        # cProfile only sees the calling thread, while the batch and service modes work on pools of other threads
+        logging.error("Only the interactive session can be profiled, --profile can not be used with --batch or --serve")
+        sys.exit(1)
+    pages = None if arguments.no_page_cache else page_cache.PageCache(constants.PAGE_CACHE_PATH, offline=arguments.offline)
+    analyses = None if arguments.no_analysis_cache else analysis_cache.AnalysisCache(constants.ANALYSIS_CACHE_PATH, None if arguments.no_near_duplicates else near_duplicates.NearDuplicateIndex(constants.NEAR_DUPLICATE_INDEX_PATH))
+    builder = prompt_builder.PromptBuilder(arguments.prompt_token_budget, arguments.top_interests)
+    reader = llm_response.ResponseReader(not arguments.plain_output, not arguments.no_stream, arguments.repair_attempts)
+    uses_gemini = arguments.backend in ("gemini", "record")
+    if uses_gemini:
+        GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+        if GOOGLE_API_KEY is None:
+            logging.error("The Google API key must be set to the GOOGLE_API_KEY environment variable")
+            sys.exit(1)
+        llm_backend.GeminiBackend.configure(GOOGLE_API_KEY)
+        background.submit(llm_backend.GeminiBackend.client)
+    background.shutdown(wait=False)
 
-    google.generativeai.configure(api_key=GOOGLE_API_KEY)
-    available_model_names_list = [model.name for model in google.generativeai.list_models()]
-    available_model_names_list.sort()
+    available_models = llm_backend.available_models(arguments.backend, arguments.recording)
+    model_name = "" if arguments.model is None else arguments.model
+    if uses_gemini and model_name != "" and not model_name in available_models:
+        # The cached model list may be older than the model
+        available_models = {model.name: model for model in llm_backend.GeminiBackend.list_models(refresh=True)}
+    available_model_names_list = sorted(available_models.keys())
     available_model_names = ", ".join(available_model_names_list)
-    model_name = ""
+    if model_name == "" and len(available_model_names_list) == 1:
+        model_name = available_model_names_list[0]
+    if (arguments.batch is not None or arguments.serve is not None) and not model_name in available_model_names_list:
+        logging.error(f"The batch and service modes require a valid model name passed with --model, choose one from the following list: {available_model_names}")
+        sys.exit(1)
     while not model_name in available_model_names_list:
         model_name = input(f"Please choose a model name from the following list: {available_model_names}\n")
-    model = google.generativeai.GenerativeModel(model_name, system_instruction=SYSTEM_INSTRUCTION)
+    backend = llm_backend.create_backend(arguments.backend, model_name, arguments.recording)
+    context = article_analysis.AnalysisContext(backend, analyses, builder, reader)
+
+    if arguments.serve is not None:
+        with open(arguments.serve, 'r', encoding = "utf-8") as sources_file:
+            sources = list(batch_analysis.read_urls(sources_file))
+        # The service only reads the profiles, compacting them is left to the sessions rating articles
+        profiles = profile_store.ProfileStore(constants.PROFILES_PATH, incremental_models=arguments.calibration == "online", compact_journals=False)
+        daemon = feed_daemon.FeedDaemon(backend, profiles, reading_list.ReadingListStore(profiles), sources, feed_daemon.SeenIndex(constants.SEEN_INDEX_PATH), pages, analyses, builder, reader, arguments.llm_workers, arguments.poll_interval)
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            logging.info("Stopping the service")
+        finally:
+            daemon.stop()
+            if arguments.metrics is not None:
+                metrics.METRICS.write(arguments.metrics)
+        return
+
+    if arguments.batch is not None:
+        preferences_store, preferences, preferences_prediction_models = profile_loading.result()
+        fetcher = async_fetch.BackgroundFetcher(pages) if arguments.async_fetch else None
+        extractors = None if arguments.extraction_workers == 0 else extraction_pool.ExtractionPool(arguments.extraction_workers, pages)
+        pack_token_budget, pack_max_articles = batch_analysis.pack_limits(available_models[model_name].input_token_limit, available_models[model_name].output_token_limit, arguments.pack_articles)
+        analyser = batch_analysis.BatchAnalyser(context, preferences, preferences_prediction_models, arguments.fetch_workers, arguments.llm_workers, pages, arguments.split_analysis, fetcher, extractors, pack_token_budget, pack_max_articles)
+        try:
+            batch_analysis.run_batch(analyser, arguments.batch, arguments.output)
+        finally:
+            if fetcher is not None:
+                fetcher.close()
+            if extractors is not None:
+                extractors.close()
+            logging.debug(f"Metrics:\n{metrics.METRICS.format_summary()}")
+            if arguments.metrics is not None:
+                metrics.METRICS.write(arguments.metrics)
+        return
 
     VALID_ACTIONS_FULL = ["analyse article", "rate article", "change model", "exit"]
     ALIASES = {"analyse article": ["a"], "rate article": ["r"], "change model": ["c"], "exit": ["e"]}
@@ -88,6 +177,7 @@ def main():
         all_valid_actions.extend(ALIASES[valid_action])
         actions_with_aliases.append(f"{valid_action} ({", ".join(ALIASES[valid_action])})")
     actions_with_aliases_str = ", ".join(actions_with_aliases)
+    profile_path = arguments.profile
 
     while True:
         action = ""
@@ -101,29 +191,39 @@ def main():
                     if action in ALIASES[a]:
                         action = a
                         break
+        preferences_store, preferences, preferences_prediction_models = profile_loading.result()
         if action == "exit":
+            preferences_store.compact(preferences)
+            if arguments.metrics is not None:
+                metrics.METRICS.write(arguments.metrics)
             break
 
         if action == "analyse article":
             url = input("URL to analyse: ")
-            article_analysis_result = article_analysis.analyse_article(model, url, preferences)
-            if article_analysis_result is None:
+            # Only the first analysis is profiled, the later ones hit warm caches
+            with metrics.profiled(profile_path) if profile_path is not None else contextlib.nullcontext(), metrics.METRICS.collect_spans() as collected_spans:
+                profile_path = None
+                article_analysis_result = article_analysis.analyse_article(context, url, preferences, pages, arguments.split_analysis)
+                article_scores = None if article_analysis_result is None else article_analysis.rate_article(article_analysis_result, preferences_prediction_models)
+            logging.info(f"Timings: {metrics.format_spans(collected_spans)}")
+            if arguments.metrics is not None:
+                metrics.METRICS.write(arguments.metrics)
+            if article_analysis_result is None or article_scores is None:
                 print("Error: The article analysis failed unexpectedly. Please try again later.")
                 continue
-            article_scores = article_analysis.rate_article(article_analysis_result, preferences_prediction_models)
             print(f"Article title: {article_analysis_result.title}\n" +
                   f"Article source: {article_analysis_result.hostname}\n" +
                   f"Main themes: {", ".join(article_analysis_result.main_themes)}\n" +
-                  f"Main themes alignment: {article_scores.main_themes_alignment:.1f}/10\n" +
-                  f"Fluffiness: {article_scores.fluffiness_alignment:.1f}/10 (absolute score: {article_analysis_result.how_fluffy:.1f})\n" +
-                  f"Title descriptiveness: {article_scores.title_descriptiveness:.1f}/10 (absolute score: {article_analysis_result.how_descriptive_title:.1f})\n" +
-                  f"Overall score: {article_scores.overall:.1f}/10")
+                  f"Main themes alignment: {article_analysis.format_score(article_scores.main_themes_alignment)}/10\n" +
+                  f"Fluffiness: {article_analysis.format_score(article_scores.fluffiness_alignment)}/10 (absolute score: {article_analysis.format_score(article_analysis_result.how_fluffy)})\n" +
+                  f"Title descriptiveness: {article_analysis.format_score(article_scores.title_descriptiveness)}/10 (absolute score: {article_analysis.format_score(article_analysis_result.how_descriptive_title)})\n" +
+                  f"Overall score: {article_analysis.format_score(article_scores.overall)}/10")
 
         if action == "change model":
             model_name = ""
             while not model_name in available_model_names_list:
                 model_name = input(f"Please choose a model name from the following list: {available_model_names}\n")
-            model = google.generativeai.GenerativeModel(model_name, system_instruction=SYSTEM_INSTRUCTION)
+            context.backend = llm_backend.create_backend(arguments.backend, model_name, arguments.recording)
 
         STOP_SEQUENCE = ":done"
         if action == "rate article":
@@ -208,21 +308,14 @@ def main():
             if submission_action == "cancel":
                 continue
             if submission_action == "submit":
-                article_analysis_result = article_analysis.analyse_article(model, url, preferences)
+                article_analysis_result = article_analysis.analyse_article(context, url, preferences, pages, arguments.split_analysis)
                 if article_analysis_result is None:
                     print("Error: The article analysis failed unexpectedly. Please try again later.")
                     continue
-                for theme_info in theme_ratings:
-                    theme = theme_info["theme"]
-                    theme_rating = theme_info["rating"]
-                    if theme in preferences.interests.keys():
-                        preferences.interests[theme].score = (preferences.interests[theme].score * preferences.interests[theme].articles_analysed + theme_rating) / (preferences.interests[theme].articles_analysed + 1)
-                        preferences.interests[theme].articles_analysed += 1
-                    else:
-                        preferences.interests[theme] = user_preferences_handler.ScoreInformation(theme_rating, 1)
-                preferences.fluffiness.append(user_preferences_handler.PredicatedActual(article_analysis_result.how_fluffy, fluffiness))
-                preferences.title_descriptiveness.append(user_preferences_handler.PredicatedActual(article_analysis_result.how_descriptive_title, title_descriptiveness))
-                user_preferences_handler.save(constants.PREFERENCES_PATH, preferences)
+                fluffiness_point = user_preferences_handler.PredicatedActual(article_analysis_result.how_fluffy, fluffiness)
+                title_descriptiveness_point = user_preferences_handler.PredicatedActual(article_analysis_result.how_descriptive_title, title_descriptiveness)
+                preferences_store.record_rating(preferences, theme_ratings, fluffiness_point, title_descriptiveness_point)
+                preferences_prediction_models.update()
 
 # pylint: enable=missing-function-docstring
 
@@ -0,0 +1,203 @@
+"""
+Handling of the timing spans and counters of the application, exportable as a Prometheus text file or a JSON snapshot
+"""
+
+from __future__ import annotations
+
+import bisect
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+import typing
+
+METRIC_PREFIX = "article_recommender"
+SPAN_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+class SpanStatistics:
+    """
+    The duration histogram of a single span
+    """
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.bucket_counts = [0] * len(SPAN_BUCKETS)
+
+    def record(self, duration: float):
+        """
+        Adds a single duration to the histogram
+        """
+        self.count += 1
+        self.total_seconds += duration
+        self.max_seconds = max(self.max_seconds, duration)
+        index = bisect.bisect_left(SPAN_BUCKETS, duration)
+        if index < len(SPAN_BUCKETS):
+            self.bucket_counts[index] += 1
+
+    def to_dict(self) -> dict[str, typing.Union[int, float, dict[str, int]]]:
+        """
+        Converts the class to a JSON serializable dictionary
+        """
+        cumulative = 0
+        buckets = {}
+        for upper_bound, bucket_count in zip(SPAN_BUCKETS, self.bucket_counts):
+            cumulative += bucket_count
+            buckets[str(upper_bound)] = cumulative
+        return {
+            "count": self.count,
+            "total_seconds": self.total_seconds,
+            "max_seconds": self.max_seconds,
+            "buckets": buckets
+        }
+
+class Metrics:
+    """
+    A thread-safe registry of span duration histograms and counters
+    """
+    def __init__(self):
+        self.spans: dict[str, SpanStatistics] = {}
+        self.counters: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> typing.Iterator[None]:
+        """
+        Times the block as the span of the given name
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            with self._lock:
+                self.spans.setdefault(name, SpanStatistics()).record(duration)
+            for collected in getattr(self._local, "collectors", []):
+                collected.append((name, duration))
+
+    def increment(self, name: str, amount: float = 1):
+        """
+        Increments the counter of the given name
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextlib.contextmanager
+    def collect_spans(self) -> typing.Iterator[list[typing.Tuple[str, float]]]:
+        """
+        Collects the (name, duration) pairs of the spans finishing in the current thread within the block, e.g. for the breakdown of a single request
+        """
+        collected: list[typing.Tuple[str, float]] = []
+        collectors = getattr(self._local, "collectors", None)
+        if collectors is None:
+            collectors = self._local.collectors = []
+        collectors.append(collected)
+        try:
+            yield collected
+        finally:
+            collectors.remove(collected)
+
+    def reset(self):
+        """
+        Drops all of the recorded spans and counters
+        """
+        with self._lock:
+            self.spans = {}
+            self.counters = {}
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        """
+        Converts the recorded metrics to a JSON serializable snapshot
+        """
+        with self._lock:
+            return {
+                "timestamp": time.time(),
+                "spans": {name: statistics.to_dict() for name, statistics in sorted(self.spans.items())},
+                "counters": dict(sorted(self.counters.items()))
+            }
+
+    def to_prometheus(self) -> str:
+        """
+        Formats the recorded metrics in the Prometheus text exposition format
+        """
+        snapshot = self.to_dict()
+        lines = [f"# TYPE {METRIC_PREFIX}_span_seconds histogram"]
+        for name, statistics in snapshot["spans"].items():
+            for upper_bound, cumulative in statistics["buckets"].items():
+                lines.append(f"{METRIC_PREFIX}_span_seconds_bucket{{span=\"{name}\",le=\"{upper_bound}\"}} {cumulative}")
+            lines.append(f"{METRIC_PREFIX}_span_seconds_bucket{{span=\"{name}\",le=\"+Inf\"}} {statistics['count']}")
+            lines.append(f"{METRIC_PREFIX}_span_seconds_sum{{span=\"{name}\"}} {statistics['total_seconds']}")
+            lines.append(f"{METRIC_PREFIX}_span_seconds_count{{span=\"{name}\"}} {statistics['count']}")
+        for name, value in snapshot["counters"].items():
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} counter")
+            lines.append(f"{METRIC_PREFIX}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """
+        Writes the metrics to the file, in the Prometheus text format for '.prom' and '.txt' files and as a JSON snapshot otherwise
+        """
+        content = self.to_prometheus() if path.endswith((".prom", ".txt")) else json.dumps(self.to_dict(), indent=4)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(file_descriptor, 'w', encoding = "utf-8") as file:
+            file.write(content)
+        # Replaced atomically so that a scraper never reads a half written file
+        os.replace(temporary_path, path)
+
+    def format_summary(self) -> str:
+        """
+        Formats the span totals and the counters for the logs
+        """
+        snapshot = self.to_dict()
+        lines = [f"{name}: {statistics['count']} x, {statistics['total_seconds']:.3f} s total, {statistics['max_seconds']:.3f} s max" for name, statistics in snapshot["spans"].items()]
+        lines.extend(f"{name}: {value:g}" for name, value in snapshot["counters"].items())
+        return "\n".join(lines)
+
+METRICS = Metrics()
+
+def span(name: str) -> typing.ContextManager[None]:
+    """
+    Times the block as the span of the given name in the application metrics
+    """
+    return METRICS.span(name)
+
+def increment(name: str, amount: float = 1):
+    """
+    Increments the counter of the given name in the application metrics
+    """
+    METRICS.increment(name, amount)
+
+def format_spans(collected: list[typing.Tuple[str, float]]) -> str:
+    """
+    Formats the collected spans as a one line breakdown, summing the repeated ones
+    """
+    totals: dict[str, float] = {}
+    for name, duration in collected:
+        totals[name] = totals.get(name, 0.0) + duration
+    return ", ".join(f"{name} {duration:.3f} s" for name, duration in totals.items())
+
+@contextlib.contextmanager
+def profiled(output_path: str, top_functions: int = 25) -> typing.Iterator[None]:
+    """
+    Profiles the block with cProfile (in the current thread only), saving the statistics to `output_path` for pstats/snakeviz
+    and logging the functions with the highest cumulative time
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(output_path)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top_functions)
+        logging.info(f"Profile saved to '{output_path}':\n{report.getvalue()}")
@@ -0,0 +1,125 @@
+"""
+Handling of the detection of near-duplicate article texts with MinHash signatures and locality-sensitive hashing
+"""
+
+from __future__ import annotations
+
+import base64
+import logging
+import re
+import threading
+import typing
+import zlib
+import numpy
+
+import json_files
+import constants
+
+# Signatures are only comparable if they were made with the same permutations, so the seed is fixed
+PERMUTATION_SEED = 20240611
+HASH_PRIME = 4294967311
+WORD_PATTERN = re.compile(r"\w+")
+
+def shingles(text: str, size: int = constants.NEAR_DUPLICATE_SHINGLE_WORDS) -> set[str]:
+    """
+    Returns the set of the overlapping word sequences of the text, casefolded so that formatting differences do not matter
+    """
+    words = WORD_PATTERN.findall(text.casefold())
+    if len(words) <= size:
+        return set() if len(words) == 0 else {" ".join(words)}
+    return {" ".join(words[index:index + size]) for index in range(len(words) - size + 1)}
+
+class MinHasher:
+    """
+    Computes MinHash signatures, whose share of equal values estimates the Jaccard similarity of the shingle sets of two texts
+    """
+    def __init__(self, permutations: int = constants.NEAR_DUPLICATE_PERMUTATIONS):
+        generator = numpy.random.default_rng(PERMUTATION_SEED)
+        # Multipliers below 2^32 keep a*x + b of the 32 bit shingle hashes within 64 bits
+        self.multipliers = generator.integers(1, 1 << 32, size=permutations, dtype=numpy.uint64)
+        self.increments = generator.integers(0, 1 << 32, size=permutations, dtype=numpy.uint64)
+
+    def signature(self, text: str) -> typing.Optional[numpy.ndarray]:
+        """
+        Returns the signature of the text, or None for a text without any words
+        """
+        text_shingles = shingles(text)
+        if len(text_shingles) == 0:
+            return None
+        hashes = numpy.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in text_shingles), dtype=numpy.uint64, count=len(text_shingles))
+        permuted = (numpy.outer(hashes, self.multipliers) + self.increments) % numpy.uint64(HASH_PRIME)
+        return (permuted.min(axis=0) & numpy.uint64(0xFFFFFFFF)).astype(numpy.uint32)
+
+class NearDuplicateIndex:
+    """
+    A persistent index of the signatures of the analysed articles, keyed by the article hash.
+    The signatures are split into bands of `rows` values and only the articles sharing a whole band with the queried one are compared,
+    so a lookup takes time proportional to the number of similar articles instead of the size of the index.
+    With the default 128 values in 32 bands of 4 the texts at least `threshold` similar are found with a probability of over 99.9 %.
+    The index is stored as an append-only JSON lines file.
+    """
+    def __init__(self, index_path: str, threshold: float = constants.NEAR_DUPLICATE_THRESHOLD, permutations: int = constants.NEAR_DUPLICATE_PERMUTATIONS, rows: int = constants.NEAR_DUPLICATE_BAND_ROWS):
+        self.index_path = index_path
+        self.threshold = threshold
+        self.rows = rows
+        self.hasher = MinHasher(permutations)
+        self._lock = threading.Lock()
+        self._signatures: dict[str, numpy.ndarray] = {}
+        self._buckets: dict[typing.Tuple[int, bytes], list[str]] = {}
+        self._load()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._signatures)
+
+    def signature(self, text: str) -> typing.Optional[numpy.ndarray]:
+        """
+        Returns the signature of the text, or None for a text without any words
+        """
+        return self.hasher.signature(text)
+
+    def find(self, signature: numpy.ndarray) -> list[typing.Tuple[str, float]]:
+        """
+        Returns the keys of the indexed articles at least `threshold` similar to the signature with their estimated similarity, the most similar first
+        """
+        with self._lock:
+            candidates = set()
+            for bucket in self._bands(signature):
+                candidates.update(self._buckets.get(bucket, []))
+            matches = [(key, float(numpy.mean(self._signatures[key] == signature))) for key in candidates]
+        matches = [(key, similarity) for key, similarity in matches if similarity >= self.threshold]
+        matches.sort(key=lambda match: match[1], reverse=True)
+        return matches
+
+    def add(self, key: str, signature: numpy.ndarray):
+        """
+        Adds the signature of an article to the index
+        """
+        with self._lock:
+            if key in self._signatures:
+                return
+            self._insert(key, signature)
+            try:
+                json_files.append_json_line(self.index_path, {"key": key, "signature": base64.b64encode(signature.astype("<u4").tobytes()).decode("ascii")})
+            except OSError as e:
+                logging.error(f"Error: Failed to save the signature to the near-duplicate index '{self.index_path}': {e}")
+
+    def _bands(self, signature: numpy.ndarray) -> list[typing.Tuple[int, bytes]]:
+        return [(band, signature[start:start + self.rows].tobytes()) for band, start in enumerate(range(0, len(signature) - self.rows + 1, self.rows))]
+
+    def _insert(self, key: str, signature: numpy.ndarray):
+        self._signatures[key] = signature
+        for bucket in self._bands(signature):
+            self._buckets.setdefault(bucket, []).append(key)
+
+    def _load(self):
+        for record in json_files.read_json_lines(self.index_path, "near-duplicate index"):
+            try:
+                signature = numpy.frombuffer(base64.b64decode(record["signature"]), dtype="<u4").astype(numpy.uint32)
+            except (KeyError, ValueError):
+                logging.warning(f"Warning: Skipping a record without a valid signature in the near-duplicate index '{self.index_path}'.")
+                continue
+            if len(signature) != len(self.hasher.multipliers):
+                continue
+            if record["key"] not in self._signatures:
+                self._insert(record["key"], signature)
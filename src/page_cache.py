@@ -0,0 +1,295 @@
+"""
+Handling of the on-disk cache of fetched pages and their extracted metadata
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import typing
+import urllib.parse
+
+import json_files
+import metrics
+import constants
+
+TRACKING_QUERY_PREFIXES = ("utm_", "fbclid", "gclid", "mc_cid", "mc_eid")
+CachedExtraction: typing.TypeAlias = typing.Optional[dict[str, typing.Optional[str]]]
+
+def normalize_url(url: str) -> str:
+    """
+    Normalizes the URL so that trivially different spellings of the same page share a cache entry
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    hostname = (parts.hostname or "").lower()
+    port = parts.port
+    if port is not None and not (scheme == "http" and port == 80) and not (scheme == "https" and port == 443):
+        hostname = f"{hostname}:{port}"
+    query = [(key, value) for key, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if not key.lower().startswith(TRACKING_QUERY_PREFIXES)]
+    query.sort()
+    path = parts.path if len(parts.path) > 0 else "/"
+    if len(path) > 1:
+        path = path.rstrip("/")
+    return urllib.parse.urlunsplit((scheme, hostname, path, urllib.parse.urlencode(query), ""))
+
+def hash_content(content: str) -> str:
+    """
+    Returns the content hash used as the cache key of a page
+    """
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+class PageCache:
+    """
+    A content-addressed on-disk cache of raw pages (keyed by the normalized URL) and of their extracted metadata (keyed by the page content hash)
+
+    The URL -> page mapping expires after `ttl_seconds`, the stored files are evicted least recently used first once they take up more than `max_size_bytes`.
+    Expired pages that have an ETag or a Last-Modified validator are kept until they are evicted, so that they can be revalidated with a conditional request.
+    In offline mode expired pages are still served and nothing is ever fetched from the network.
+
+    The index is a snapshot plus an append-only journal of the changes since, compacted into the snapshot every `compaction_interval` changes,
+    so that storing a page does not rewrite the whole index. The last accesses of the cache hits are only saved with the next compaction.
+    """
+    def __init__(self, cache_dir: str, ttl_seconds: float = constants.PAGE_CACHE_TTL_SECONDS, max_size_bytes: int = constants.PAGE_CACHE_MAX_BYTES, offline: bool = False,
+                 compaction_interval: int = constants.PAGE_CACHE_INDEX_COMPACTION_INTERVAL):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_size_bytes = max_size_bytes
+        self.offline = offline
+        self.compaction_interval = compaction_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, "pages"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "extracted"), exist_ok=True)
+        self._index_path = os.path.join(cache_dir, "index.json")
+        self._journal_path = os.path.join(cache_dir, "index.journal.jsonl")
+        self._urls: dict[str, dict[str, typing.Union[str, float]]] = {}
+        self._entries: dict[str, dict[str, typing.Union[int, float]]] = {}
+        self._total_size = 0
+        self._journal_length = 0
+        self._load_index()
+
+    def get_page(self, url: str) -> typing.Optional[str]:
+        """
+        Returns the cached page for the URL, or None if it is missing or expired
+        """
+        return self._get_page(url, self.offline)
+
+    def get_stale_page(self, url: str) -> typing.Optional[str]:
+        """
+        Returns the cached page for the URL even if it is expired, or None if it is missing
+        """
+        return self._get_page(url, True)
+
+    def get_page_entry(self, url: str) -> typing.Optional[dict[str, typing.Union[str, float]]]:
+        """
+        Returns the index entry of the URL even if it is expired, or None if the URL was never cached
+        """
+        with self._lock:
+            url_entry = self._urls.get(normalize_url(url))
+            return None if url_entry is None else dict(url_entry)
+
+    def put_page(self, url: str, page: str, etag: typing.Optional[str] = None, last_modified: typing.Optional[str] = None) -> str:
+        """
+        Stores the page fetched from the URL along with the validators for conditional requests, returning its content hash
+        """
+        content_hash = hash_content(page)
+        with self._lock:
+            page_path = self._page_path(content_hash)
+            if not os.path.exists(page_path):
+                self._write_file(page_path, page)
+            url_entry: dict[str, typing.Union[str, float]] = {"content_hash": content_hash, "fetched_at": time.time()}
+            if etag is not None:
+                url_entry["etag"] = etag
+            if last_modified is not None:
+                url_entry["last_modified"] = last_modified
+            self._change({"url": normalize_url(url), "url_entry": url_entry})
+            self._touch(content_hash, save=True)
+            self._evict()
+        return content_hash
+
+    def refresh_page(self, url: str):
+        """
+        Marks the cached page as fresh again, after the server confirmed it has not been modified
+        """
+        with self._lock:
+            url_entry = self._urls.get(normalize_url(url))
+            if url_entry is None:
+                return
+            self._change({"url": normalize_url(url), "url_entry": {**url_entry, "fetched_at": time.time()}})
+
+    def get_extracted(self, content_hash: str) -> typing.Tuple[bool, CachedExtraction]:
+        """
+        Returns whether the extraction result for the page content is cached and the cached result (None for pages the extraction failed on)
+        """
+        with self._lock:
+            raw = self._read_file(self._extracted_path(content_hash))
+            if raw is None:
+                self.misses += 1
+                metrics.increment("page_cache_misses_total")
+                return False, None
+            self._touch(content_hash)
+            self.hits += 1
+            metrics.increment("page_cache_hits_total")
+            return True, json.loads(raw)
+
+    def put_extracted(self, content_hash: str, extracted: CachedExtraction):
+        """
+        Stores the extraction result for the page content
+        """
+        with self._lock:
+            self._write_file(self._extracted_path(content_hash), json.dumps(extracted))
+            self._touch(content_hash, save=True)
+            self._evict()
+
+    def clear_expired(self):
+        """
+        Drops the expired URL entries that can not be revalidated and the files no URL refers to anymore
+        """
+        with self._lock:
+            self._drop_expired_urls()
+
+    def _get_page(self, url: str, allow_expired: bool) -> typing.Optional[str]:
+        with self._lock:
+            url_entry = self._urls.get(normalize_url(url))
+            if url_entry is None or (not allow_expired and self._is_expired(url_entry)):
+                self.misses += 1
+                metrics.increment("page_cache_misses_total")
+                return None
+            content_hash = typing.cast(str, url_entry["content_hash"])
+            page = self._read_file(self._page_path(content_hash))
+            if page is None:
+                self.misses += 1
+                metrics.increment("page_cache_misses_total")
+                return None
+            self._touch(content_hash)
+            self.hits += 1
+            metrics.increment("page_cache_hits_total")
+            return page
+
+    def _is_expired(self, url_entry: dict[str, typing.Union[str, float]]) -> bool:
+        return time.time() - typing.cast(float, url_entry["fetched_at"]) > self.ttl_seconds
+
+    def _page_path(self, content_hash: str) -> str:
+        return os.path.join(self.cache_dir, "pages", f"{content_hash}.html")
+
+    def _extracted_path(self, content_hash: str) -> str:
+        return os.path.join(self.cache_dir, "extracted", f"{content_hash}.json")
+
+    def _entry_size(self, content_hash: str) -> int:
+        size = 0
+        for path in (self._page_path(content_hash), self._extracted_path(content_hash)):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def _touch(self, content_hash: str, save: bool = False):
+        entry = {"size": self._entry_size(content_hash), "last_access": time.time()}
+        if save:
+            self._change({"content_hash": content_hash, "entry": entry})
+        else:
+            self._apply({"content_hash": content_hash, "entry": entry})
+
+    def _remove_entry(self, content_hash: str):
+        for path in (self._page_path(content_hash), self._extracted_path(content_hash)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._change({"removed": content_hash})
+
+    def _drop_expired_urls(self):
+        if self.offline:
+            return
+        for url in [url for url, url_entry in self._urls.items() if self._is_expired(url_entry) and "etag" not in url_entry and "last_modified" not in url_entry]:
+            self._change({"dropped_url": url})
+        referenced = {url_entry["content_hash"] for url_entry in self._urls.values()}
+        for content_hash in [content_hash for content_hash in self._entries if content_hash not in referenced]:
+            self._remove_entry(content_hash)
+
+    def _evict(self):
+        if self._total_size <= self.max_size_bytes:
+            return
+        self._drop_expired_urls()
+        by_last_access = sorted(self._entries.items(), key=lambda item: item[1]["last_access"])
+        for content_hash, _ in by_last_access:
+            if self._total_size <= self.max_size_bytes:
+                break
+            self._remove_entry(content_hash)
+
+    def _change(self, change: dict[str, typing.Any]):
+        """
+        Applies the change to the index and journals it, compacting the journal into the snapshot once it has grown long enough
+        """
+        self._apply(change)
+        try:
+            json_files.append_json_line(self._journal_path, change)
+        except OSError as e:
+            logging.error(f"Error: Failed to save the change to the page cache index journal '{self._journal_path}': {e}")
+            return
+        self._journal_length += 1
+        if self._journal_length >= self.compaction_interval:
+            self._save_index()
+
+    def _apply(self, change: dict[str, typing.Any]):
+        # Applying a change twice has no further effect, so the changes of a journal that was compacted but not emptied can be replayed
+        if "url" in change:
+            self._urls[change["url"]] = change["url_entry"]
+        elif "dropped_url" in change:
+            self._urls.pop(change["dropped_url"], None)
+        elif "content_hash" in change:
+            previous = self._entries.get(change["content_hash"])
+            self._total_size += typing.cast(int, change["entry"]["size"]) - (0 if previous is None else typing.cast(int, previous["size"]))
+            self._entries[change["content_hash"]] = change["entry"]
+        elif "removed" in change:
+            removed = self._entries.pop(change["removed"], None)
+            if removed is not None:
+                self._total_size -= typing.cast(int, removed["size"])
+            for url in [url for url, url_entry in self._urls.items() if url_entry["content_hash"] == change["removed"]]:
+                del self._urls[url]
+
+    def _read_file(self, path: str) -> typing.Optional[str]:
+        try:
+            with open(path, 'r', encoding = "utf-8") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_file(self, path: str, content: str):
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(file_descriptor, 'w', encoding = "utf-8") as file:
+            file.write(content)
+        os.replace(temporary_path, path)
+
+    def _load_index(self):
+        raw = self._read_file(self._index_path)
+        if raw is not None:
+            try:
+                index = json.loads(raw)
+                self._urls = index.get("urls", {})
+                self._entries = index.get("entries", {})
+            except json.JSONDecodeError as e:
+                logging.error(f"Error: Failed to decode the page cache index '{self._index_path}', starting from the journal alone: {e}")
+        self._total_size = sum(typing.cast(int, entry["size"]) for entry in self._entries.values())
+        for change in json_files.read_json_lines(self._journal_path, "page cache index journal"):
+            self._apply(change)
+            self._journal_length += 1
+
+    def _save_index(self):
+        try:
+            json_files.write_json_atomically(self._index_path, {"urls": self._urls, "entries": self._entries})
+            # The snapshot contains every journaled change, so the journal can be emptied even if this is interrupted
+            with open(self._journal_path, 'w', encoding = "utf-8"):
+                pass
+        except OSError as e:
+            logging.error(f"Error: Failed to save the page cache index to '{self._index_path}': {e}")
+            return
+        self._journal_length = 0
@@ -0,0 +1,181 @@
+"""
+Handling of the journaled storage of user preferences
+
+Every submitted rating is appended to a JSON lines journal next to the preferences file instead of rewriting the whole file.
+The preferences file itself serves as a snapshot that the journal is periodically compacted into.
+Several processes (an interactive session next to the service mode) may use the same files, so every change to them is made under a file lock
+after catching up with what the other processes wrote.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import logging
+import os
+import sys
+import threading
+import typing
+
+import json_files
+import metrics
+import user_preferences_handler
+import constants
+
+DiskState: typing.TypeAlias = typing.Tuple[typing.Optional[typing.Tuple[int, int, int]], ...]
+
+def file_state(path: str) -> typing.Optional[typing.Tuple[int, int, int]]:
+    """
+    Returns the inode, modification time and size of the file, which change whenever it is replaced or written to, or None if it is missing
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+class PreferencesJournal:
+    """
+    Stores the user preferences as a snapshot plus an append-only journal of the ratings submitted since the snapshot was written
+
+    Each journal entry carries a sequence number and the snapshot records the last one it contains,
+    so a crash between writing the snapshot and truncating the journal never applies a rating twice.
+    Before appending or compacting, the entries other processes appended are replayed (or the preferences are reloaded if another process compacted the journal),
+    so that neither the sequence numbers collide nor a compaction drops their ratings.
+    The replayed ratings only reach the calibration models with the next `UserPreferencesModels.update`, which picks up every rating added to the history since the last one.
+    """
+    def __init__(self, preferences_path: str, compaction_interval: int = constants.JOURNAL_COMPACTION_INTERVAL):
+        self.preferences_path = preferences_path
+        self.journal_path = f"{os.path.splitext(preferences_path)[0]}.journal.jsonl"
+        self.lock_path = f"{os.path.splitext(preferences_path)[0]}.lock"
+        self.compaction_interval = compaction_interval
+        self.sequence = 0
+        self.entries_since_snapshot = 0
+        # Only the entries appended by this process make a compaction necessary, the others are compacted by the process that wrote them
+        self.entries_written = 0
+        self._lock = threading.Lock()
+        self._disk_state = self._current_disk_state()
+
+    def load(self) -> user_preferences_handler.UserPreferences:
+        """
+        Loads the snapshot and replays the journal entries written after it
+        """
+        with self._lock, self._file_lock():
+            return self._load()
+
+    def changed_on_disk(self) -> bool:
+        """
+        Returns whether another process wrote to the snapshot or the journal since they were last loaded or written by this one
+        """
+        return self._current_disk_state() != self._disk_state
+
+    def record_rating(self, preferences: user_preferences_handler.UserPreferences, theme_ratings: list[user_preferences_handler.ThemeRatingDict], fluffiness: user_preferences_handler.PredicatedActual, title_descriptiveness: user_preferences_handler.PredicatedActual):
+        """
+        Adds the rating to the preferences and appends it to the journal, compacting the journal once it has grown long enough
+        """
+        with self._lock, self._file_lock():
+            self._catch_up(preferences)
+            entry = {
+                "sequence": self.sequence + 1,
+                "theme_ratings": theme_ratings,
+                "fluffiness": fluffiness.to_dict(),
+                "title_descriptiveness": title_descriptiveness.to_dict()
+            }
+            try:
+                json_files.append_json_line(self.journal_path, entry, durable=True)
+            except OSError as e:
+                logging.error(f"Error: Failed to append the rating to the journal '{self.journal_path}': {e}")
+                return
+            self.sequence += 1
+            self.entries_since_snapshot += 1
+            self.entries_written += 1
+            self._disk_state = self._current_disk_state()
+            preferences.add_rating(theme_ratings, fluffiness, title_descriptiveness)
+            should_compact = self.entries_since_snapshot >= self.compaction_interval
+        if should_compact:
+            self.compact(preferences)
+
+    def compact(self, preferences: user_preferences_handler.UserPreferences):
+        """
+        Writes the preferences as a new snapshot and empties the journal, if this process appended any entries to it
+        """
+        with self._lock, self._file_lock():
+            if self.entries_written == 0:
+                return
+            self._catch_up(preferences)
+            try:
+                with metrics.span("save_preferences"):
+                    snapshot = {**preferences.to_dicts(), "journal_sequence": self.sequence}
+                    json_files.write_json_atomically(self.preferences_path, snapshot, indent=4)
+                    # The snapshot already contains every journal entry, so the journal can be emptied even if this is interrupted
+                    with open(self.journal_path, 'w', encoding = "utf-8"):
+                        pass
+            except OSError as e:
+                logging.error(f"Error: Failed to compact the journal into '{self.preferences_path}': {e}")
+                return
+            self.entries_since_snapshot = 0
+            self.entries_written = 0
+            self._disk_state = self._current_disk_state()
+
+    def _load(self) -> user_preferences_handler.UserPreferences:
+        data = user_preferences_handler.read_json(self.preferences_path)
+        preferences = user_preferences_handler.UserPreferences.default() if data is None else user_preferences_handler.UserPreferences(data)
+        snapshot_sequence = 0 if data is None else typing.cast(int, data.get("journal_sequence", 0))
+        self.sequence = snapshot_sequence
+        self.entries_since_snapshot = 0
+        for entry in self._read_entries():
+            if entry["sequence"] <= snapshot_sequence:
+                continue
+            PreferencesJournal._apply(preferences, entry)
+            self.sequence = entry["sequence"]
+            self.entries_since_snapshot += 1
+        self._disk_state = self._current_disk_state()
+        return preferences
+
+    def _catch_up(self, preferences: user_preferences_handler.UserPreferences):
+        if not self.changed_on_disk():
+            return
+        if file_state(self.preferences_path) != self._disk_state[0]:
+            # Another process compacted the journal, so the entries this process has not seen yet are only in the new snapshot
+            entries_written = self.entries_written
+            # The callers hold on to the preferences object, so it is updated in place
+            preferences.replace_with(self._load())
+            self.entries_written = entries_written
+            return
+        for entry in self._read_entries():
+            if entry["sequence"] <= self.sequence:
+                continue
+            PreferencesJournal._apply(preferences, entry)
+            self.sequence = entry["sequence"]
+            self.entries_since_snapshot += 1
+        self._disk_state = self._current_disk_state()
+
+    def _current_disk_state(self) -> DiskState:
+        return (file_state(self.preferences_path), file_state(self.journal_path))
+
+    @contextlib.contextmanager
+    def _file_lock(self) -> typing.Iterator[None]:
+        if sys.platform == "win32":
+            # Without flock only the threads of this process are synchronized
+            yield
+            return
+        import fcntl # pylint: disable=import-outside-toplevel
+        with open(self.lock_path, 'a', encoding = "utf-8") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _read_entries(self) -> typing.Iterator[dict[str, typing.Any]]:
+        # Only the last line can be cut short by a crash while appending, and its rating was never confirmed to the user
+        return json_files.read_json_lines(self.journal_path, "journal")
+
+    @staticmethod
+    def _apply(preferences: user_preferences_handler.UserPreferences, entry: dict[str, typing.Any]):
+        fluffiness = entry["fluffiness"]
+        title_descriptiveness = entry["title_descriptiveness"]
+        preferences.add_rating(
+            entry["theme_ratings"],
+            user_preferences_handler.PredicatedActual(fluffiness["machine_rating"], fluffiness["user_rating"]),
+            user_preferences_handler.PredicatedActual(title_descriptiveness["machine_rating"], title_descriptiveness["user_rating"])
+        )
@@ -0,0 +1,132 @@
+"""
+Handling of the preferences of many users served from a single process
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import collections
+import glob
+import hashlib
+import os
+import threading
+import urllib.parse
+
+import preferences_journal
+import user_preferences_handler
+import user_preferences_models
+import constants
+
+@dataclass
+class UserProfile:
+    """
+    A data structure class for storing everything loaded for a single user
+    """
+    user_id: str
+    journal: preferences_journal.PreferencesJournal
+    preferences: user_preferences_handler.UserPreferences
+    models: user_preferences_models.UserPreferencesModels
+    def __init__(self, user_id: str, journal: preferences_journal.PreferencesJournal, preferences: user_preferences_handler.UserPreferences, models: user_preferences_models.UserPreferencesModels):
+        self.user_id = user_id
+        self.journal = journal
+        self.preferences = preferences
+        self.models = models
+
+class ProfileStore:
+    """
+    Stores the preferences of each user in their own journaled file, sharded into subdirectories by the hash of the user id.
+    Profiles are loaded (and their models trained) on first access and kept in a least recently used cache of `capacity` profiles,
+    the journals of evicted profiles are compacted unless `compact_journals` is off (for processes that only read the profiles).
+    """
+    def __init__(self, base_dir: str, capacity: int = constants.PROFILE_STORE_CAPACITY, incremental_models: bool = True, compact_journals: bool = True):
+        self.base_dir = base_dir
+        self.capacity = max(1, capacity)
+        self.incremental_models = incremental_models
+        self.compact_journals = compact_journals
+        self.loads = 0
+        self.evictions = 0
+        self._profiles: collections.OrderedDict[str, UserProfile] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._user_locks: dict[str, threading.Lock] = {}
+
+    def preferences_path(self, user_id: str) -> str:
+        """
+        Returns the path of the preferences file of the user
+        """
+        shard = hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:2]
+        return os.path.join(self.base_dir, shard, f"{urllib.parse.quote(user_id, safe='')}.json")
+
+    def user_ids(self) -> list[str]:
+        """
+        Returns the ids of all users with stored preferences
+        """
+        user_ids = set()
+        for suffix in (".json", ".journal.jsonl"):
+            for path in glob.glob(os.path.join(glob.escape(self.base_dir), "*", f"*{suffix}")):
+                if path.endswith((".calibration.json", ".reading_list.json")):
+                    continue
+                user_ids.add(urllib.parse.unquote(os.path.basename(path)[:-len(suffix)]))
+        return sorted(user_ids)
+
+    def get(self, user_id: str, reload_changed: bool = False) -> UserProfile:
+        """
+        Returns the profile of the user, loading it if it is not loaded yet (new users start with the default preferences).
+        With `reload_changed` a loaded profile is loaded again if another process changed its preferences since.
+        """
+        with self._lock:
+            profile = self._profiles.get(user_id)
+            if profile is not None and not (reload_changed and profile.journal.changed_on_disk()):
+                self._profiles.move_to_end(user_id)
+                return profile
+            user_lock = self._user_locks.setdefault(user_id, threading.Lock())
+        # Loading happens outside of the store lock so that the hot users are not blocked by a cold one being loaded
+        with user_lock:
+            with self._lock:
+                profile = self._profiles.get(user_id)
+                if profile is not None and not (reload_changed and profile.journal.changed_on_disk()):
+                    self._profiles.move_to_end(user_id)
+                    return profile
+            profile = self._load(user_id)
+            with self._lock:
+                self._profiles[user_id] = profile
+                self._profiles.move_to_end(user_id)
+                self._user_locks.pop(user_id, None)
+                evicted = []
+                while len(self._profiles) > self.capacity:
+                    evicted.append(self._profiles.popitem(last=False)[1])
+                    self.evictions += 1
+        if self.compact_journals:
+            for evicted_profile in evicted:
+                evicted_profile.journal.compact(evicted_profile.preferences)
+        return profile
+
+    def record_rating(self, user_id: str, theme_ratings: list[user_preferences_handler.ThemeRatingDict], fluffiness: user_preferences_handler.PredicatedActual, title_descriptiveness: user_preferences_handler.PredicatedActual):
+        """
+        Adds the rating to the user's preferences and updates their models
+        """
+        profile = self.get(user_id)
+        profile.journal.record_rating(profile.preferences, theme_ratings, fluffiness, title_descriptiveness)
+        profile.models.update()
+
+    def close(self):
+        """
+        Compacts the journals of all loaded profiles
+        """
+        if not self.compact_journals:
+            return
+        with self._lock:
+            profiles = list(self._profiles.values())
+        for profile in profiles:
+            profile.journal.compact(profile.preferences)
+
+    def _load(self, user_id: str) -> UserProfile:
+        preferences_path = self.preferences_path(user_id)
+        os.makedirs(os.path.dirname(preferences_path), exist_ok=True)
+        journal = preferences_journal.PreferencesJournal(preferences_path)
+        if os.path.exists(preferences_path) or os.path.exists(journal.journal_path):
+            preferences = journal.load()
+        else:
+            preferences = user_preferences_handler.UserPreferences.default()
+        models = user_preferences_models.UserPreferencesModels(preferences, self.incremental_models, user_preferences_models.calibration_path(preferences_path))
+        self.loads += 1
+        return UserProfile(user_id, journal, preferences, models)
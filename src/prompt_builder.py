@@ -0,0 +1,189 @@
+"""
+Handling of the construction of the LLM prompts within a token budget
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import math
+import re
+import typing
+
+import fetch_article
+import theme_alignment
+import user_preferences_handler
+import constants
+
+CHARS_PER_TOKEN = 4
+OMISSION_MARKER = "[...]"
+WORD_PATTERN = re.compile(r"\w+")
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens of the text (about four characters per token for English text)
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def cut_at_word(text: str, max_chars: int) -> str:
+    """
+    Cuts the text to at most `max_chars` characters, at the last whitespace before the limit if there is one
+    """
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    last_space = cut.rfind(" ")
+    return cut[:last_space] if last_space > max_chars // 2 else cut
+
+def trim_text(text: str, max_tokens: int) -> typing.Tuple[str, bool]:
+    """
+    Trims the text to the token budget deterministically, keeping the opening paragraphs (half of the budget), the closing ones (a fifth)
+    and evenly spaced paragraphs from the middle, with the omitted parts marked. Returns the text and whether it was trimmed.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text, False
+    max_chars = max(0, max_tokens * CHARS_PER_TOKEN)
+    paragraphs = [paragraph.strip() for paragraph in text.split("\n") if len(paragraph.strip()) > 0]
+    selected: dict[int, str] = {}
+    used_chars = 0
+
+    def add(index: int, limit: int) -> bool:
+        nonlocal used_chars
+        cost = len(paragraphs[index]) + len(OMISSION_MARKER) + 2
+        if used_chars + cost > limit:
+            return False
+        selected[index] = paragraphs[index]
+        used_chars += cost
+        return True
+
+    head_limit = max_chars // 2
+    for index in range(len(paragraphs)):
+        if not add(index, head_limit):
+            break
+    if len(selected) == 0 and len(paragraphs) > 0:
+        # Even the first paragraph does not fit, so it is cut instead of being left out (to the whole budget if nothing else could be kept)
+        cut_limit = head_limit if len(paragraphs) > 1 else max_chars
+        selected[0] = cut_at_word(paragraphs[0], max(0, cut_limit - len(OMISSION_MARKER) - 2))
+        used_chars += len(selected[0]) + len(OMISSION_MARKER) + 2
+
+    tail_limit = used_chars + max_chars // 5
+    for index in reversed(range(len(paragraphs))):
+        if index in selected or not add(index, tail_limit):
+            break
+
+    middle = [index for index in range(len(paragraphs)) if index not in selected and min(selected, default=0) < index < max(selected, default=0)]
+    if len(middle) > 0:
+        average_cost = sum(len(paragraphs[index]) for index in middle) / len(middle) + len(OMISSION_MARKER) + 2
+        sample_size = min(len(middle), max(1, int((max_chars - used_chars) // average_cost)))
+        for sample in range(sample_size):
+            add(middle[sample * len(middle) // sample_size], max_chars)
+
+    parts = []
+    previous_index = -1
+    for index in sorted(selected):
+        if index != previous_index + 1:
+            parts.append(OMISSION_MARKER)
+        parts.append(selected[index])
+        previous_index = index
+    if previous_index != len(paragraphs) - 1:
+        parts.append(OMISSION_MARKER)
+    return "\n".join(parts), True
+
+@dataclass
+class BuiltPrompt:
+    """
+    A data structure class for storing the parts of a prompt and the report of its size
+    """
+    article: str
+    interests: str
+    article_truncated: bool
+    interests_included: int
+    interests_total: int
+    def __init__(self, article: str, interests: str, article_truncated: bool, interests_included: int, interests_total: int):
+        self.article = article
+        self.interests = interests
+        self.article_truncated = article_truncated
+        self.interests_included = interests_included
+        self.interests_total = interests_total
+
+    @property
+    def text(self) -> str:
+        """
+        The full prompt with both the article and the interests
+        """
+        if len(self.interests) == 0:
+            return self.article
+        if len(self.article) == 0:
+            return self.interests
+        return self.article + "\n" + self.interests
+
+    @property
+    def estimated_tokens(self) -> int:
+        """
+        The estimated size of the full prompt in tokens
+        """
+        return estimate_tokens(self.text)
+
+    def describe(self) -> str:
+        """
+        Formats the size report of the prompt for the logs
+        """
+        truncated = ", article text trimmed" if self.article_truncated else ""
+        return f"Prompt of ~{self.estimated_tokens} tokens ({self.interests_included}/{self.interests_total} interests{truncated})"
+
+class PromptBuilder:
+    """
+    Builds the prompts within `token_budget` tokens (None for no limit), sending only the `top_interests` interests most relevant to the article (None for all of them)
+    """
+    def __init__(self, token_budget: typing.Optional[int] = constants.PROMPT_TOKEN_BUDGET, top_interests: typing.Optional[int] = constants.PROMPT_TOP_INTERESTS):
+        self.token_budget = token_budget if token_budget is not None and token_budget > 0 else None
+        self.top_interests = top_interests if top_interests is not None and top_interests > 0 else None
+
+    def build(self, metadata: fetch_article.ArticleMetadata, user_preferences: typing.Optional[user_preferences_handler.UserPreferences] = None) -> BuiltPrompt:
+        """
+        Builds the prompt with the article and, if preferences are given, the user interests most relevant to it
+        """
+        interests = ""
+        interests_included = 0
+        interests_total = 0
+        if user_preferences is not None:
+            interests, interests_included = self.format_interests(user_preferences, f"{metadata.title}\n{metadata.text}")
+            interests_total = len(user_preferences.interests)
+        text = metadata.text if metadata.text is not None else ""
+        truncated = False
+        if self.token_budget is not None:
+            header_tokens = estimate_tokens(fetch_article.ArticleMetadata(metadata.title, "", metadata.hostname).format_for_llm())
+            text, truncated = trim_text(text, max(0, self.token_budget - header_tokens - estimate_tokens(interests) - 1))
+        return BuiltPrompt(fetch_article.ArticleMetadata(metadata.title, text, metadata.hostname).format_for_llm(), interests, truncated, interests_included, interests_total)
+
+    def build_alignment(self, title: str, main_themes: list[str], user_preferences: user_preferences_handler.UserPreferences) -> BuiltPrompt:
+        """
+        Builds the alignment-only prompt with the title, the main themes and the user interests most relevant to them
+        """
+        article = f"Title: {title}\nMain themes: {', '.join(main_themes)}"
+        interests, interests_included = self.format_interests(user_preferences, f"{title}\n{' '.join(main_themes)}")
+        return BuiltPrompt(article, interests, False, interests_included, len(user_preferences.interests))
+
+    def format_interests(self, user_preferences: user_preferences_handler.UserPreferences, article_text: str) -> typing.Tuple[str, int]:
+        """
+        Formats the interests most relevant to the article for the prompt, returning them with their count.
+        Interests whose words appear in the article come first, then the ones the user feels strongest about, then the most rated ones.
+        If the budget is set, the interests never take more than half of it.
+        """
+        if self.top_interests is None and self.token_budget is None:
+            return user_preferences.format_for_llm(), len(user_preferences.interests)
+        article_words = set(WORD_PATTERN.findall(article_text.casefold()))
+
+        def relevance(theme: str) -> float:
+            theme_words = WORD_PATTERN.findall(theme.casefold())
+            if len(theme_words) == 0:
+                return 0.0
+            return sum(1 for word in theme_words if word in article_words) / len(theme_words)
+
+        ranked = sorted(user_preferences.interests.items(), key=lambda item: (-relevance(item[0]), -abs(item[1].score - theme_alignment.NEUTRAL_ALIGNMENT), -item[1].articles_analysed, item[0]))
+        if self.top_interests is not None:
+            ranked = ranked[:self.top_interests]
+        selected = {theme: score_information.score for theme, score_information in ranked}
+        if self.token_budget is not None:
+            while len(selected) > 0 and estimate_tokens(str(selected)) > self.token_budget // 2:
+                selected.pop(next(reversed(selected)))
+        return str(selected), len(selected)
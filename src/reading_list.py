@@ -0,0 +1,133 @@
+"""
+Handling of the precomputed, ranked reading lists of the users
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import json
+import logging
+import os
+import threading
+import typing
+
+import article_analysis
+import json_files
+import profile_store as profile_store_module
+import user_preferences_models
+import constants
+
+def reading_list_path(preferences_path: str) -> str:
+    """
+    Returns the path the reading list of the preferences file is stored at
+    """
+    return f"{os.path.splitext(preferences_path)[0]}.reading_list.json"
+
+@dataclass
+class ReadingListEntry:
+    """
+    A data structure class for storing an analysed article in the reading list of a user
+    """
+    url: str
+    analysis: article_analysis.ArticleAnalysis
+    scores: article_analysis.ArticleScores
+    added_at: float
+    def __init__(self, url: str, analysis: article_analysis.ArticleAnalysis, scores: article_analysis.ArticleScores, added_at: float):
+        self.url = url
+        self.analysis = analysis
+        self.scores = scores
+        self.added_at = added_at
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        """
+        Converts the class to a JSON serializable dictionary
+        """
+        return {
+            "url": self.url,
+            "analysis": self.analysis.to_dict(),
+            "scores": self.scores.to_dict(),
+            "added_at": self.added_at
+        }
+
+    @staticmethod
+    def from_dict(entry_dict: dict[str, typing.Any]) -> ReadingListEntry:
+        """
+        Creates the entry from its dictionary representation
+        """
+        analysis_dict = entry_dict["analysis"]
+        analysis = article_analysis.ArticleAnalysis(json.dumps(analysis_dict), analysis_dict.get("title"), analysis_dict.get("hostname"), analysis_dict.get("prompt_tokens"))
+        scores_dict = entry_dict["scores"]
+        scores = article_analysis.ArticleScores(scores_dict["main_themes_alignment"], scores_dict["fluffiness_alignment"], scores_dict["title_descriptiveness"], scores_dict["overall"])
+        return ReadingListEntry(entry_dict["url"], analysis, scores, entry_dict["added_at"])
+
+def overall_score(entry: ReadingListEntry) -> float:
+    """
+    Returns the score the reading list is ranked by, entries without one rank last
+    """
+    return -1.0 if entry.scores.overall is None else entry.scores.overall
+
+class ReadingListStore:
+    """
+    Keeps the `max_entries` best scored articles of each user ranked from the best to the worst,
+    stored next to the preferences of the user so that reading them is a file read instead of an LLM call.
+    """
+    def __init__(self, profiles: profile_store_module.ProfileStore, max_entries: int = constants.READING_LIST_SIZE):
+        self.profiles = profiles
+        self.max_entries = max(1, max_entries)
+        self._lists: dict[str, list[ReadingListEntry]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str, limit: typing.Optional[int] = None) -> list[ReadingListEntry]:
+        """
+        Returns the ranked reading list of the user, the `limit` best entries only if a limit is given
+        """
+        with self._lock:
+            entries = list(self._load(user_id))
+        return entries if limit is None else entries[:limit]
+
+    def add(self, user_id: str, entry: ReadingListEntry):
+        """
+        Adds the article to the reading list of the user (replacing an earlier entry for the same URL), dropping the worst entries over the limit
+        """
+        with self._lock:
+            entries = [existing for existing in self._load(user_id) if existing.url != entry.url]
+            entries.append(entry)
+            entries.sort(key=overall_score, reverse=True)
+            self._lists[user_id] = entries[:self.max_entries]
+            self._save(user_id)
+
+    def rescore(self, user_id: str, user_preference_models: user_preferences_models.UserPreferencesModels):
+        """
+        Re-rates the whole reading list of the user with their current calibration models and ranks it again
+        """
+        with self._lock:
+            entries = self._load(user_id)
+            if len(entries) == 0:
+                return
+            ranked = article_analysis.rate_articles([entry.analysis for entry in entries], user_preference_models)
+            self._lists[user_id] = [ReadingListEntry(entries[ranked_article.index].url, ranked_article.analysis, ranked_article.scores, entries[ranked_article.index].added_at) for ranked_article in ranked]
+            self._save(user_id)
+
+    def _load(self, user_id: str) -> list[ReadingListEntry]:
+        entries = self._lists.get(user_id)
+        if entries is not None:
+            return entries
+        path = reading_list_path(self.profiles.preferences_path(user_id))
+        entries = []
+        try:
+            with open(path, 'r', encoding = "utf-8") as file:
+                entries = [ReadingListEntry.from_dict(entry_dict) for entry_dict in json.load(file)]
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, KeyError, TypeError) as e:
+            logging.error(f"Error: Failed to read the reading list '{path}', starting a new one: {e}")
+        self._lists[user_id] = entries
+        return entries
+
+    def _save(self, user_id: str):
+        path = reading_list_path(self.profiles.preferences_path(user_id))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            json_files.write_json_atomically(path, [entry.to_dict() for entry in self._lists[user_id]])
+        except OSError as e:
+            logging.error(f"Error: Failed to save the reading list '{path}': {e}")
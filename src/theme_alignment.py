@@ -0,0 +1,85 @@
+"""
+Handling of the theme alignment computed locally from the main themes of an article, without the LLM
+
+The themes are mapped into a vector space by hashing their words and character trigrams, so similar spellings ("sport" and "sports", "AI" and "ai")
+end up close to each other. The alignment is then computed from the cosine similarities of the article themes to all of the user's interests at once.
+"""
+
+from __future__ import annotations
+
+import functools
+import typing
+import zlib
+import numpy
+
+import user_preferences_handler
+import constants
+
+NEUTRAL_ALIGNMENT = (constants.MIN_SCORE + constants.MAX_SCORE) / 2
+EMBEDDING_DIMENSIONS = 1024
+NGRAM_SIZE = 3
+# Similarities below this are treated as unrelated themes, the hashed trigrams of unrelated words still overlap a little
+SIMILARITY_FLOOR = 0.4
+
+def normalize_theme(theme: str) -> str:
+    """
+    Normalizes the theme so that trivially different spellings match
+    """
+    return " ".join(theme.casefold().split())
+
+def theme_features(theme: str) -> list[str]:
+    """
+    Returns the words and character trigrams of the theme
+    """
+    normalized = normalize_theme(theme)
+    features = [f"w:{word}" for word in normalized.split()]
+    padded = f" {normalized} "
+    features.extend(f"c:{padded[i:i + NGRAM_SIZE]}" for i in range(len(padded) - NGRAM_SIZE + 1))
+    return features
+
+def embed_themes(themes: typing.Sequence[str]) -> numpy.ndarray:
+    """
+    Maps the themes into the hashed feature space, returning a matrix with one L2 normalized row per theme
+    """
+    embeddings = numpy.zeros((len(themes), EMBEDDING_DIMENSIONS))
+    for row, theme in enumerate(themes):
+        for feature in theme_features(theme):
+            # crc32 rather than hash() so that the embeddings are the same in every process
+            embeddings[row, zlib.crc32(feature.encode("utf-8")) % EMBEDDING_DIMENSIONS] += 1.0
+    norms = numpy.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / numpy.where(norms == 0, 1.0, norms)
+
+@functools.lru_cache(maxsize=64)
+def _interest_matrix(interests: typing.Tuple[typing.Tuple[str, float], ...]) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    return embed_themes([theme for theme, _ in interests]), numpy.array([score for _, score in interests])
+
+def interest_matrix(user_preferences: user_preferences_handler.UserPreferences) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Returns the embeddings of all of the user's interests and their scores, reusing them while the interests do not change
+    """
+    return _interest_matrix(tuple((theme, score_information.score) for theme, score_information in user_preferences.interests.items()))
+
+def align_themes_with_confidence(main_themes: list[str], user_preferences: user_preferences_handler.UserPreferences) -> typing.Tuple[float, float]:
+    """
+    Computes the theme alignment and the confidence in it (from 0 when no theme resembles any interest to 1 when all themes were rated by the user).
+    Each article theme gets the similarity-weighted average score of the interests resembling it, blended towards neutral the less they resemble it.
+    """
+    if len(main_themes) == 0 or len(user_preferences.interests) == 0:
+        return NEUTRAL_ALIGNMENT, 0.0
+    interest_embeddings, interest_scores = interest_matrix(user_preferences)
+    similarities = embed_themes(main_themes) @ interest_embeddings.T
+    weights = numpy.clip((similarities - SIMILARITY_FLOOR) / (1 - SIMILARITY_FLOOR), 0.0, 1.0)
+    weight_sums = weights.sum(axis=1)
+    theme_scores = numpy.divide(weights @ interest_scores, weight_sums, out=numpy.full(len(main_themes), NEUTRAL_ALIGNMENT), where=weight_sums > 0)
+    coverage = weights.max(axis=1)
+    alignment = float(numpy.mean(coverage * theme_scores + (1 - coverage) * NEUTRAL_ALIGNMENT))
+    return alignment, float(numpy.mean(coverage))
+
+def align_themes(main_themes: list[str], user_preferences: user_preferences_handler.UserPreferences, min_confidence: float = constants.LOCAL_ALIGNMENT_MIN_CONFIDENCE) -> typing.Optional[float]:
+    """
+    Computes the theme alignment locally, returning None if the confidence is too low and the LLM should be asked instead
+    """
+    alignment, confidence = align_themes_with_confidence(main_themes, user_preferences)
+    if confidence < min_confidence:
+        return None
+    return alignment
@@ -0,0 +1,122 @@
+"""
+Handling of the canonical forms of the themes, so that differently spelled themes ("AI", "ai" and "Artificial Intelligence") are stored as one interest
+"""
+
+from __future__ import annotations
+
+import re
+import typing
+
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+# Apostrophes and dots inside words are dropped ("U.S." is "us"), the other punctuation separates words ("machine-learning" is "machine learning")
+JOINING_PATTERN = re.compile(r"(?<=\w)['’.](?=\w)|(?<=\w)\.(?!\w)")
+# Words ending in "s" that are not plurals
+INVARIANT_WORDS = frozenset("""always analysis basis bias chaos crisis diabetes ethics gas genesis lens linux news physics politics series species status thesis
+economics electronics mathematics statistics logistics aerodynamics genetics graphics robotics esports""".split())
+# Plurals the suffix rules get wrong
+IRREGULAR_PLURALS = {
+    "analyses": "analysis",
+    "crises": "crisis",
+    "diagnoses": "diagnosis",
+    "hypotheses": "hypothesis",
+    "theses": "thesis",
+    "quizzes": "quiz"
+}
+# Singulars ending in "e" after a sibilant, whose plural only adds an "s" ("niches" is "niche", but "churches" is "church")
+SIBILANT_E_SINGULARS = frozenset("""niche cache headache avalanche moustache mustache psyche quiche cliche tranche creche""".split())
+DEFAULT_ALIASES = {
+    "ai": "artificial intelligence",
+    "ml": "machine learning",
+    "llm": "large language model",
+    "nlp": "natural language processing",
+    "vr": "virtual reality",
+    "ar": "augmented reality",
+    "ev": "electric vehicle",
+    "crypto": "cryptocurrency",
+    "usa": "united states",
+    "uk": "united kingdom",
+    "eu": "european union",
+    "un": "united nations",
+    "covid": "covid 19",
+    "covid19": "covid 19",
+    "coronavirus": "covid 19",
+    "e sports": "esports",
+    "f1": "formula 1",
+    "formula one": "formula 1",
+    "js": "javascript",
+    "os": "operating system"
+}
+# Aliases that only apply to the exact spelling, as their casefolded form is also a common word ("us")
+CASE_SENSITIVE_ALIASES = {
+    "US": "united states",
+    "U.S.": "united states",
+    "U.S": "united states"
+}
+
+def lemmatize_word(word: str) -> str:
+    """
+    Reduces an (already casefolded) English word to a singular base form with a few suffix rules.
+    The result is only used as a key, so it only has to be the same for the singular and the plural ("movie" and "movies" both become "movy").
+    """
+    if len(word) <= 3 or word in INVARIANT_WORDS or not word.isalpha():
+        return word
+    if word in IRREGULAR_PLURALS:
+        return IRREGULAR_PLURALS[word]
+    if word.endswith(("ies", "ie")):
+        return word[:word.rindex("ie")] + "y"
+    if word.endswith(("sses", "shes", "ches", "xes", "zes")):
+        # Nearly all the singulars of "-zes" end in "ze" ("sizes", "prizes"), except the ones that double the "z" ("buzzes") or follow a "t" ("waltzes")
+        ends_in_ze = word.endswith("zes") and not word.endswith(("zzes", "tzes"))
+        return word[:-1] if ends_in_ze or word[:-1] in SIBILANT_E_SINGULARS else word[:-2]
+    if word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+def canonical_words(theme: str) -> str:
+    """
+    Returns the casefolded, lemmatized words of the theme without punctuation ("Sports!" and "sport" both become "sport")
+    """
+    joined = JOINING_PATTERN.sub("", theme.casefold())
+    return " ".join(lemmatize_word(word) for word in PUNCTUATION_PATTERN.sub(" ", joined).split())
+
+CANONICAL_ALIASES = {canonical_words(alias): canonical_words(target) for alias, target in DEFAULT_ALIASES.items()}
+
+class ThemeIndex:
+    """
+    Maps the canonical form of each theme (its casefolded, lemmatized words with the aliases resolved) to the name the theme is stored under,
+    which is the spelling it was first seen with
+    """
+    def __init__(self, aliases: typing.Optional[dict[str, str]] = None):
+        self.aliases = CANONICAL_ALIASES if aliases is None else {canonical_words(alias): canonical_words(target) for alias, target in aliases.items()}
+        self._names: dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def canonical(self, theme: str) -> str:
+        """
+        Returns the canonical form of the theme
+        """
+        spelling = " ".join(theme.split())
+        if spelling in CASE_SENSITIVE_ALIASES:
+            return canonical_words(CASE_SENSITIVE_ALIASES[spelling])
+        words = canonical_words(theme)
+        return self.aliases.get(words, words)
+
+    def lookup(self, theme: str) -> typing.Optional[str]:
+        """
+        Returns the name the theme is stored under, or None if no spelling of it is known
+        """
+        return self._names.get(self.canonical(theme))
+
+    def resolve(self, theme: str) -> str:
+        """
+        Returns the name the theme is stored under, registering the theme under its own (whitespace normalized) spelling if it is new
+        """
+        return self._names.setdefault(self.canonical(theme), " ".join(theme.split()))
+
+    def remove(self, theme: str):
+        """
+        Forgets the theme, so that it is registered again under the next spelling it is seen with
+        """
+        self._names.pop(self.canonical(theme), None)
@@ -5,33 +5,50 @@ Handling of user preferences
 from __future__ import annotations
 
 from dataclasses import dataclass
+import array
+import base64
+import hashlib
 import json
 import logging
+import math
+import sys
 import typing
+import numpy
+import json_files
+import metrics
+import theme_index as theme_index_module
+import constants
 
 RawJsonDict: typing.TypeAlias = dict[str, typing.Union["ScoreInformation", dict[str, "ScoreInformation"]]]
-ScoreInformationDict: typing.TypeAlias = dict[str, typing.Union[float, int]]
-PredicatedActualDict: typing.TypeAlias = dict[str, float]
+ScoreInformationDict: typing.TypeAlias = dict[str, typing.Union[float, int, None]]
+PredicatedActualDict: typing.TypeAlias = dict[str, typing.Optional[float]]
+CompactHistoryDict: typing.TypeAlias = dict[str, typing.Union[str, int]]
+ThemeRatingDict: typing.TypeAlias = dict[str, typing.Union[str, float]]
 
 @dataclass
 class UserPreferences:
     """
     Stores the user preferences
+
+    Interests are keyed by theme, with differently spelled themes ("AI" and "Artificial Intelligence") merged into one interest through the theme index.
+    Interests rated only a few times that have not been rated for a long time are pruned, so that the profile and the prompts stay compact.
     """
     interests: dict[str, ScoreInformation]
-    fluffiness: list[PredicatedActual]
-    title_descriptiveness: list[PredicatedActual]
+    fluffiness: RatingHistory
+    title_descriptiveness: RatingHistory
     def __init__(self, json_dict: RawJsonDict):
         default_preferences = UserPreferences.default_raw()
         interests = json_dict["interests"] if "interests" in json_dict.keys() else default_preferences["interests"]
-        fluffiness = json_dict["fluffiness"] if "fluffiness" in json_dict.keys() else default_preferences["flufiness"]
+        fluffiness = json_dict["fluffiness"] if "fluffiness" in json_dict.keys() else default_preferences["fluffiness"]
         title_descriptiveness = json_dict["title_descriptiveness"] if "title_descriptiveness" in json_dict.keys() else default_preferences["title_descriptiveness"]
-        interests = {theme: ScoreInformation(information["score"], information["articles_analysed"]) for theme, information in interests.items()}
-        fluffiness = [PredicatedActual(point["machine_rating"], point["user_rating"]) for point in fluffiness]
-        title_descriptiveness = [PredicatedActual(point["machine_rating"], point["user_rating"]) for point in title_descriptiveness]
+        interests = {theme: ScoreInformation(information["score"], information["articles_analysed"], information.get("last_rated")) for theme, information in interests.items()}
+        fluffiness = RatingHistory.from_json(fluffiness)
+        title_descriptiveness = RatingHistory.from_json(title_descriptiveness)
         self.interests = interests
         self.fluffiness = fluffiness
         self.title_descriptiveness = title_descriptiveness
+        self.theme_index = theme_index_module.ThemeIndex()
+        self.merge_duplicate_interests()
 
     def format_for_llm(self) -> str:
         """
@@ -40,14 +57,69 @@ class UserPreferences:
         res = {interest: score_information.score for interest, score_information in self.interests.items()}
         return str(res)
 
-    def to_dicts(self) -> dict[str, typing.Union[dict[str, ScoreInformationDict], list[PredicatedActualDict]]]:
+    def add_rating(self, theme_ratings: list[ThemeRatingDict], fluffiness: PredicatedActual, title_descriptiveness: PredicatedActual):
         """
-        Converts the class to a JSON serializable dictionary
+        Adds the user's rating of an article, updating the running averages of the rated themes
+        """
+        if len(self.theme_index) != len(self.interests):
+            # The interests were changed directly instead of through the ratings
+            self.merge_duplicate_interests()
+        rating_number = len(self.fluffiness)
+        for theme_info in theme_ratings:
+            theme = self.theme_index.resolve(typing.cast(str, theme_info["theme"]))
+            theme_rating = typing.cast(float, theme_info["rating"])
+            if theme in self.interests.keys():
+                self.interests[theme].score = (self.interests[theme].score * self.interests[theme].articles_analysed + theme_rating) / (self.interests[theme].articles_analysed + 1)
+                self.interests[theme].articles_analysed += 1
+                self.interests[theme].last_rated = rating_number
+            else:
+                self.interests[theme] = ScoreInformation(theme_rating, 1, rating_number)
+        self.fluffiness.append(fluffiness)
+        self.title_descriptiveness.append(title_descriptiveness)
+        self.prune_stale_interests()
+
+    def replace_with(self, other: UserPreferences):
+        """
+        Replaces the stored data with the data of the other preferences, for updating an object that is referenced elsewhere in place
+        """
+        self.interests = other.interests
+        self.fluffiness = other.fluffiness
+        self.title_descriptiveness = other.title_descriptiveness
+        self.theme_index = other.theme_index
+
+    def merge_duplicate_interests(self):
+        """
+        Rebuilds the theme index, merging the interests whose themes have the same canonical form into the first one of them
+        """
+        self.theme_index = theme_index_module.ThemeIndex()
+        rating_number = len(self.fluffiness)
+        merged: dict[str, ScoreInformation] = {}
+        for theme, score_information in self.interests.items():
+            if score_information.last_rated is None:
+                # Interests from before the ratings were numbered count as just rated, so they are not pruned right away
+                score_information.last_rated = rating_number
+            name = self.theme_index.resolve(theme)
+            merged[name] = score_information if name not in merged else merged[name].merge(score_information)
+        self.interests = merged
+
+    def prune_stale_interests(self, max_articles: int = constants.THEME_PRUNE_MAX_ARTICLES, after_ratings: int = constants.THEME_PRUNE_AFTER_RATINGS):
+        """
+        Removes the interests rated at most `max_articles` times whose last rating is at least `after_ratings` ratings old
+        """
+        rating_number = len(self.fluffiness)
+        stale_themes = [theme for theme, score_information in self.interests.items() if score_information.articles_analysed <= max_articles and rating_number - typing.cast(int, score_information.last_rated) >= after_ratings]
+        for theme in stale_themes:
+            del self.interests[theme]
+            self.theme_index.remove(theme)
+
+    def to_dicts(self) -> dict[str, typing.Union[dict[str, ScoreInformationDict], CompactHistoryDict]]:
+        """
+        Converts the class to a JSON serializable dictionary, with the rating histories in their compact form
         """
         return {
             "interests": {key: interest.to_dict() for key, interest in self.interests.items()},
-            "fluffiness": [predicted_actual.to_dict() for predicted_actual in self.fluffiness],
-            "title_descriptiveness": [predicted_actual.to_dict() for predicted_actual in self.title_descriptiveness]
+            "fluffiness": self.fluffiness.to_compact_dict(),
+            "title_descriptiveness": self.title_descriptiveness.to_compact_dict()
         }
 
     @staticmethod
@@ -71,13 +143,25 @@ class UserPreferences:
 @dataclass
 class ScoreInformation:
     """
-    A data structure class for storing the average score and number of articles the score is derived from
+    A data structure class for storing the average score and number of articles the score is derived from,
+    along with the number of ratings the user had given before the last one of the theme
     """
     score: float
     articles_analysed: int
-    def __init__(self, score: float, articles_analysed: int):
+    last_rated: typing.Optional[int]
+    def __init__(self, score: float, articles_analysed: int, last_rated: typing.Optional[int] = None):
         self.score = score
         self.articles_analysed = articles_analysed
+        self.last_rated = last_rated
+
+    def merge(self, other: ScoreInformation) -> ScoreInformation:
+        """
+        Returns the combined running average of both scores, weighted by the number of articles each is derived from
+        """
+        articles_analysed = self.articles_analysed + other.articles_analysed
+        score = (self.score + other.score) / 2 if articles_analysed == 0 else (self.score * self.articles_analysed + other.score * other.articles_analysed) / articles_analysed
+        last_rated = max((rating_number for rating_number in (self.last_rated, other.last_rated) if rating_number is not None), default=None)
+        return ScoreInformation(score, articles_analysed, last_rated)
 
     def to_dict(self) -> ScoreInformationDict:
         """
@@ -85,17 +169,18 @@ class ScoreInformation:
         """
         return {
             "score": self.score,
-            "articles_analysed": self.articles_analysed
+            "articles_analysed": self.articles_analysed,
+            "last_rated": self.last_rated
         }
 
 @dataclass
 class PredicatedActual:
     """
-    A data structure class for storing pairs of scores given by the LLM and the user
+    A data structure class for storing pairs of scores given by the LLM and the user, the LLM score is None if the LLM did not provide one
     """
-    machine_rating: float
+    machine_rating: typing.Optional[float]
     user_rating: float
-    def __init__(self, machine_rating: float, user_rating: float):
+    def __init__(self, machine_rating: typing.Optional[float], user_rating: float):
         self.machine_rating = machine_rating
         self.user_rating = user_rating
 
@@ -108,38 +193,231 @@ class PredicatedActual:
             "user_rating": self.user_rating
         }
 
-def load(preferences_path: str) -> UserPreferences:
+def chain_hash(previous_hash: str, point: typing.Union[PredicatedActual, RatingView]) -> str:
     """
-    Loads the user preferences JSON file, handling the case of a missing/empty file
+    Extends the hash of a rating history by one point, so the hash of a growing history can be kept up to date in O(1) per point
+    """
+    machine_rating = math.nan if point.machine_rating is None else float(point.machine_rating)
+    return hashlib.sha256(f"{previous_hash}|{machine_rating!r}|{float(point.user_rating)!r}".encode("utf-8")).hexdigest()
+
+class RatingView:
+    """
+    A view of a single point of a rating history, reading from and writing to the history's arrays
+    """
+    __slots__ = ("_history", "_index")
+    def __init__(self, history: RatingHistory, index: int):
+        self._history = history
+        self._index = index
+
+    @property
+    def machine_rating(self) -> float:
+        """
+        The score given by the LLM
+        """
+        return self._history.machine_ratings[self._index]
+
+    @machine_rating.setter
+    def machine_rating(self, value: float):
+        self._history.machine_ratings[self._index] = value
+        self._history.forget_hash()
+
+    @property
+    def user_rating(self) -> float:
+        """
+        The score given by the user
+        """
+        return self._history.user_ratings[self._index]
+
+    @user_rating.setter
+    def user_rating(self, value: float):
+        self._history.user_ratings[self._index] = value
+        self._history.forget_hash()
+
+    def to_dict(self) -> PredicatedActualDict:
+        """
+        Converts the class to a JSON serializable dictionary, with a missing LLM score as None
+        """
+        return {
+            "machine_rating": None if math.isnan(self.machine_rating) else self.machine_rating,
+            "user_rating": self.user_rating
+        }
+
+    def __repr__(self) -> str:
+        return f"RatingView(machine_rating={self.machine_rating!r}, user_rating={self.user_rating!r})"
+
+class RatingHistory:
+    """
+    A history of pairs of scores given by the LLM and the user, stored as two contiguous arrays of doubles instead of a list of objects.
+    Missing LLM scores are stored as NaN.
+    The hash of the history is computed on first use and then only extended by the points appended since.
+    """
+    __slots__ = ("machine_ratings", "user_ratings", "_hash", "_hashed_points")
+    def __init__(self, points: typing.Iterable[typing.Union[PredicatedActual, RatingView]] = ()):
+        self.machine_ratings = array.array('d')
+        self.user_ratings = array.array('d')
+        self._hash = ""
+        self._hashed_points = 0
+        for point in points:
+            self.append(point)
+
+    def append(self, point: typing.Union[PredicatedActual, RatingView]):
+        """
+        Adds a point to the end of the history
+        """
+        self.machine_ratings.append(math.nan if point.machine_rating is None else point.machine_rating)
+        self.user_ratings.append(point.user_rating)
+
+    def __len__(self) -> int:
+        return len(self.machine_ratings)
+
+    def data_hash(self) -> str:
+        """
+        Returns the hash of the whole history, the one `chain_hash` gives when applied to each point in order
+        """
+        for index in range(self._hashed_points, len(self)):
+            self._hash = chain_hash(self._hash, RatingView(self, index))
+        self._hashed_points = len(self)
+        return self._hash
+
+    def forget_hash(self):
+        """
+        Drops the cached hash after a point was changed in place
+        """
+        self._hash = ""
+        self._hashed_points = 0
+
+    @typing.overload
+    def __getitem__(self, index: int) -> RatingView: ...
+    @typing.overload
+    def __getitem__(self, index: slice) -> RatingHistory: ...
+    def __getitem__(self, index: typing.Union[int, slice]) -> typing.Union[RatingView, RatingHistory]:
+        if isinstance(index, slice):
+            history = RatingHistory()
+            history.machine_ratings = self.machine_ratings[index]
+            history.user_ratings = self.user_ratings[index]
+            return history
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("rating history index out of range")
+        return RatingView(self, index)
+
+    def __iter__(self) -> typing.Iterator[RatingView]:
+        for index in range(len(self)):
+            yield RatingView(self, index)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, RatingHistory):
+            return NotImplemented
+        return self.to_bytes() == other.to_bytes()
+
+    def __repr__(self) -> str:
+        return f"RatingHistory({len(self)} points)"
+
+    def machine_ratings_array(self) -> numpy.ndarray:
+        """
+        Returns a copy of the LLM scores as a NumPy array
+        """
+        return numpy.frombuffer(self.machine_ratings, dtype=numpy.float64).copy()
+
+    def user_ratings_array(self) -> numpy.ndarray:
+        """
+        Returns a copy of the user scores as a NumPy array
+        """
+        return numpy.frombuffer(self.user_ratings, dtype=numpy.float64).copy()
+
+    def to_bytes(self) -> bytes:
+        """
+        Serializes the history as the little-endian LLM scores followed by the user scores
+        """
+        machine_ratings = array.array('d', self.machine_ratings)
+        user_ratings = array.array('d', self.user_ratings)
+        if sys.byteorder == "big":
+            machine_ratings.byteswap()
+            user_ratings.byteswap()
+        return machine_ratings.tobytes() + user_ratings.tobytes()
+
+    @staticmethod
+    def from_bytes(data: bytes) -> RatingHistory:
+        """
+        Creates the history from the output of `to_bytes`
+        """
+        history = RatingHistory()
+        half = len(data) // 2
+        history.machine_ratings.frombytes(data[:half])
+        history.user_ratings.frombytes(data[half:])
+        if sys.byteorder == "big":
+            history.machine_ratings.byteswap()
+            history.user_ratings.byteswap()
+        return history
+
+    def to_dicts(self) -> list[PredicatedActualDict]:
+        """
+        Converts the class to a list of JSON serializable dictionaries, one per point
+        """
+        return [point.to_dict() for point in self]
+
+    def to_compact_dict(self) -> CompactHistoryDict:
+        """
+        Converts the class to a JSON serializable dictionary holding the base64 encoded output of `to_bytes`
+        """
+        return {
+            "encoding": "float64-le-base64",
+            "length": len(self),
+            "data": base64.b64encode(self.to_bytes()).decode("ascii")
+        }
+
+    @staticmethod
+    def from_json(json_value: typing.Union[list[PredicatedActualDict], CompactHistoryDict]) -> RatingHistory:
+        """
+        Creates the history from either its compact form or the list of dictionaries (the original format of the preferences file)
+        """
+        if isinstance(json_value, dict):
+            history = RatingHistory.from_bytes(base64.b64decode(typing.cast(str, json_value["data"])))
+            if len(history) != json_value["length"]:
+                raise ValueError(f"the rating history should have {json_value['length']} points, but {len(history)} were decoded")
+            return history
+        return RatingHistory(PredicatedActual(point["machine_rating"], typing.cast(float, point["user_rating"])) for point in json_value)
+
+def read_json(preferences_path: str) -> typing.Optional[RawJsonDict]:
+    """
+    Reads the user preferences JSON file, returning None (and logging why) if it is missing, empty or malformed
     """
     try:
         with open(preferences_path, 'r', encoding = "utf-8") as file:
             content = file.read().strip()
             is_empty = len(content) == 0
             if not is_empty:
-                data = json.loads(content)
-                user_preferences = UserPreferences(data)
-                return user_preferences
+                return json.loads(content)
             logging.warning(f"Warning: '{preferences_path}' is empty. Returning an empty dictionary.")
-            return UserPreferences.default()
+            return None
     except FileNotFoundError:
         logging.error(f"Error: The file '{preferences_path}' was not found.")
-        return UserPreferences.default()
+        return None
     except json.JSONDecodeError as e:
         logging.error(f"Error: Failed to decode JSON from '{preferences_path}': {e}")
+        return None
+
+def load(preferences_path: str) -> UserPreferences:
+    """
+    Loads the user preferences JSON file, handling the case of a missing/empty file
+    """
+    data = read_json(preferences_path)
+    if data is None:
         return UserPreferences.default()
+    return UserPreferences(data)
 
 def save(preferences_path: str, preferences: UserPreferences):
     """
     Saves the user preferences to a JSON file
     """
     try:
-        with open(preferences_path, 'w', encoding = "utf-8") as file:
-            logging.debug("Preferences to save:")
-            logging.debug(preferences)
+        logging.debug("Preferences to save:")
+        logging.debug(preferences)
+        with metrics.span("save_preferences"):
             preferences_dict = preferences.to_dicts()
             logging.debug("Preferences as a dictionary:")
             logging.debug(preferences_dict)
-            json.dump(preferences_dict, file, indent=4)
+            json_files.write_json_atomically(preferences_path, preferences_dict, indent=4)
     except Exception as e: # pylint: disable=broad-exception-caught
         logging.error(f"Error: Failed to save user preferences to '{preferences_path}': {e}")
\ No newline at end of file
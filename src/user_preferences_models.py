@@ -5,10 +5,20 @@ Handling of the models used for predicting the user value from the LLM provided
 from __future__ import annotations
 
 from dataclasses import dataclass
-import sklearn.ensemble
+import json
+import logging
+import math
+import os
+import typing
 import numpy
 
+import json_files
+import metrics
 import user_preferences_handler
+import constants
+
+if typing.TYPE_CHECKING:
+    import sklearn.ensemble
 
 # Chat-GPTed, hopefully works 😅
 MODEL_PARAMETRES = {
@@ -29,39 +39,261 @@ MODEL_PARAMETRES = {
     }
 }
 RANDOM_STATE = 42
+CalibrationModel: typing.TypeAlias = typing.Union["sklearn.ensemble.RandomForestRegressor", "OnlineCalibrationModel"]
+
+def history_hash(data: user_preferences_handler.RatingHistory) -> str:
+    """
+    Returns the hash of the whole rating history, which the history keeps up to date as it grows
+    """
+    return data.data_hash()
+
+class OnlineCalibrationModel:
+    """
+    Predicts the user value from the LLM provided one from running per-bin sums, so that a new rating is added in O(1) without retraining.
+
+    The prediction is a Gaussian kernel-weighted average of the bin means, pulled towards a least-squares line (kept as running sums too)
+    where there are few ratings nearby. Without any ratings the middle of the scale is predicted.
+    """
+    def __init__(self, bin_count: int = constants.ONLINE_CALIBRATION_BINS):
+        self.bin_centres = numpy.linspace(constants.MIN_SCORE, constants.MAX_SCORE, bin_count)
+        self.bin_counts = numpy.zeros(bin_count)
+        self.bin_sums = numpy.zeros(bin_count)
+        self.count = 0
+        self.sum_x = 0.0
+        self.sum_y = 0.0
+        self.sum_xx = 0.0
+        self.sum_xy = 0.0
+        self.data_hash = ""
+
+    def update(self, point: typing.Union[user_preferences_handler.PredicatedActual, user_preferences_handler.RatingView]):
+        """
+        Adds a single rating to the model, ratings without an LLM score only extend the data hash
+        """
+        self.data_hash = user_preferences_handler.chain_hash(self.data_hash, point)
+        if point.machine_rating is None or math.isnan(point.machine_rating):
+            return
+        x = min(constants.MAX_SCORE, max(constants.MIN_SCORE, point.machine_rating))
+        y = point.user_rating
+        bin_index = int(numpy.argmin(numpy.abs(self.bin_centres - x)))
+        self.bin_counts[bin_index] += 1
+        self.bin_sums[bin_index] += y
+        self.count += 1
+        self.sum_x += x
+        self.sum_y += y
+        self.sum_xx += x * x
+        self.sum_xy += x * y
+
+    def predict(self, x_data: typing.Any) -> numpy.ndarray:
+        """
+        Predicts the user values for the LLM provided ones, accepting the same (n_samples, 1) input as the scikit-learn models
+        """
+        x_values = numpy.asarray(x_data, dtype=float).reshape(-1)
+        if self.count == 0:
+            return numpy.full(x_values.shape, (constants.MIN_SCORE + constants.MAX_SCORE) / 2)
+        weights = self.bin_counts[numpy.newaxis, :] * numpy.exp(-0.5 * ((x_values[:, numpy.newaxis] - self.bin_centres[numpy.newaxis, :]) / constants.ONLINE_CALIBRATION_BANDWIDTH) ** 2)
+        bin_means = numpy.divide(self.bin_sums, self.bin_counts, out=numpy.zeros_like(self.bin_sums), where=self.bin_counts > 0)
+        prior_weight = constants.ONLINE_CALIBRATION_PRIOR_WEIGHT
+        return (weights @ bin_means + prior_weight * self._linear_prediction(x_values)) / (weights.sum(axis=1) + prior_weight)
+
+    def _linear_prediction(self, x_values: numpy.ndarray) -> numpy.ndarray:
+        mean_x = self.sum_x / self.count
+        mean_y = self.sum_y / self.count
+        variance_x = self.sum_xx / self.count - mean_x * mean_x
+        if self.count < 2 or variance_x < 1e-9:
+            return numpy.full(x_values.shape, mean_y)
+        slope = (self.sum_xy / self.count - mean_x * mean_y) / variance_x
+        return mean_y + slope * (x_values - mean_x)
+
+    def to_dict(self) -> dict[str, typing.Any]:
+        """
+        Converts the class to a JSON serializable dictionary
+        """
+        return {
+            "bin_counts": self.bin_counts.tolist(),
+            "bin_sums": self.bin_sums.tolist(),
+            "count": self.count,
+            "sum_x": self.sum_x,
+            "sum_y": self.sum_y,
+            "sum_xx": self.sum_xx,
+            "sum_xy": self.sum_xy,
+            "data_hash": self.data_hash
+        }
+
+    @staticmethod
+    def from_dict(model_dict: dict[str, typing.Any]) -> OnlineCalibrationModel:
+        """
+        Creates the model from the dictionary produced by `to_dict`
+        """
+        model = OnlineCalibrationModel(len(model_dict["bin_counts"]))
+        model.bin_counts = numpy.array(model_dict["bin_counts"], dtype=float)
+        model.bin_sums = numpy.array(model_dict["bin_sums"], dtype=float)
+        model.count = model_dict["count"]
+        model.sum_x = model_dict["sum_x"]
+        model.sum_y = model_dict["sum_y"]
+        model.sum_xx = model_dict["sum_xx"]
+        model.sum_xy = model_dict["sum_xy"]
+        model.data_hash = model_dict["data_hash"]
+        return model
+
+    @staticmethod
+    def from_history(data: user_preferences_handler.RatingHistory) -> OnlineCalibrationModel:
+        """
+        Builds the model from a whole rating history
+        """
+        model = OnlineCalibrationModel()
+        for point in data:
+            model.update(point)
+        return model
+
+class LookupTableModel:
+    """
+    A calibration model compiled into a dense table over the LLM score range, so predicting is a single interpolation instead of walking the trees
+    """
+    def __init__(self, model: CalibrationModel, resolution: int = constants.LOOKUP_TABLE_RESOLUTION):
+        self.grid = numpy.linspace(constants.MIN_SCORE, constants.MAX_SCORE, resolution)
+        self.table = numpy.asarray(model.predict(self.grid.reshape((-1, 1))), dtype=float)
+
+    def predict_many(self, x_values: typing.Any) -> numpy.ndarray:
+        """
+        Predicts the user values for an array of LLM provided ones, clamped to the score range
+        """
+        return numpy.interp(numpy.clip(numpy.asarray(x_values, dtype=float), constants.MIN_SCORE, constants.MAX_SCORE), self.grid, self.table)
+
+    def predict(self, x_data: typing.Any) -> numpy.ndarray:
+        """
+        Predicts the user values for the LLM provided ones, accepting the same (n_samples, 1) input as the scikit-learn models
+        """
+        return self.predict_many(numpy.asarray(x_data, dtype=float).reshape(-1))
+
+def calibration_path(preferences_path: str) -> str:
+    """
+    Returns the path the incremental models of the preferences file are stored at
+    """
+    return f"{os.path.splitext(preferences_path)[0]}.calibration.json"
 
 @dataclass
 class UserPreferencesModels:
     """
     A class for storing models used for predicting the user value from the LLM provided one
+
+    By default random forests are trained over the whole rating history. With `incremental` the online calibration models are used instead,
+    loaded from `models_path` if they were built from the same history and updated with every new rating.
     """
-    fluffiness_model: sklearn.ensemble.RandomForestRegressor
-    title_descriptiveness_model: sklearn.ensemble.RandomForestRegressor
-    def __init__(self, user_preferences: user_preferences_handler.UserPreferences):
-        self.fluffiness_model = UserPreferencesModels.get_model(user_preferences.fluffiness)
-        self.title_descriptiveness_model = UserPreferencesModels.get_model(user_preferences.title_descriptiveness)
+    fluffiness_model: CalibrationModel
+    title_descriptiveness_model: CalibrationModel
+    fluffiness_table: LookupTableModel
+    title_descriptiveness_table: LookupTableModel
+    def __init__(self, user_preferences: user_preferences_handler.UserPreferences, incremental: bool = False, models_path: typing.Optional[str] = None):
+        self.user_preferences = user_preferences
+        self.incremental = incremental
+        self.models_path = models_path
+        # Every rating adds one point to both histories, so the number of points the models were built from is the same for both
+        self.ratings_seen = len(user_preferences.fluffiness)
+        if not incremental:
+            self.fluffiness_model = UserPreferencesModels.get_model(user_preferences.fluffiness)
+            self.title_descriptiveness_model = UserPreferencesModels.get_model(user_preferences.title_descriptiveness)
+            self.compile()
+            return
+        stored_models = UserPreferencesModels.load_online_models(models_path)
+        self.fluffiness_model = UserPreferencesModels.get_online_model(user_preferences.fluffiness, stored_models.get("fluffiness"))
+        self.title_descriptiveness_model = UserPreferencesModels.get_online_model(user_preferences.title_descriptiveness, stored_models.get("title_descriptiveness"))
+        self.compile()
+
+    def update(self):
+        """
+        Updates the models with the ratings added to the user preferences since the last update,
+        including the ones another process recorded that were replayed from the journal
+        """
+        if len(self.user_preferences.fluffiness) == self.ratings_seen:
+            return
+        if not self.incremental:
+            self.fluffiness_model = UserPreferencesModels.get_model(self.user_preferences.fluffiness)
+            self.title_descriptiveness_model = UserPreferencesModels.get_model(self.user_preferences.title_descriptiveness)
+        else:
+            for point in self.user_preferences.fluffiness[self.ratings_seen:]:
+                typing.cast(OnlineCalibrationModel, self.fluffiness_model).update(point)
+            for point in self.user_preferences.title_descriptiveness[self.ratings_seen:]:
+                typing.cast(OnlineCalibrationModel, self.title_descriptiveness_model).update(point)
+        self.ratings_seen = len(self.user_preferences.fluffiness)
+        self.compile()
+        self.save()
+
+    def compile(self):
+        """
+        Compiles the current models into the lookup tables used for predicting
+        """
+        self.fluffiness_table = LookupTableModel(self.fluffiness_model)
+        self.title_descriptiveness_table = LookupTableModel(self.title_descriptiveness_model)
+
+    def save(self):
+        """
+        Saves the incremental models, if there are any and a path to save them to was given
+        """
+        if not self.incremental or self.models_path is None:
+            return
+        models_dict = {
+            "fluffiness": typing.cast(OnlineCalibrationModel, self.fluffiness_model).to_dict(),
+            "title_descriptiveness": typing.cast(OnlineCalibrationModel, self.title_descriptiveness_model).to_dict()
+        }
+        try:
+            json_files.write_json_atomically(self.models_path, models_dict)
+        except OSError as e:
+            logging.error(f"Error: Failed to save the calibration models to '{self.models_path}': {e}")
+
+    @staticmethod
+    def load_online_models(models_path: typing.Optional[str]) -> dict[str, dict[str, typing.Any]]:
+        """
+        Loads the stored incremental models, returning an empty dictionary if there are none
+        """
+        if models_path is None:
+            return {}
+        try:
+            with open(models_path, 'r', encoding = "utf-8") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError as e:
+            logging.error(f"Error: Failed to decode the calibration models from '{models_path}', they will be rebuilt: {e}")
+            return {}
+
+    @staticmethod
+    def get_online_model(data: user_preferences_handler.RatingHistory, stored_model: typing.Optional[dict[str, typing.Any]]) -> OnlineCalibrationModel:
+        """
+        Returns the stored incremental model if it was built from the same rating history, rebuilding it from the history otherwise
+        """
+        if stored_model is not None and stored_model.get("data_hash") == history_hash(data):
+            return OnlineCalibrationModel.from_dict(stored_model)
+        with metrics.span("train_model"):
+            return OnlineCalibrationModel.from_history(data)
 
     @staticmethod
-    def get_model(data: list[user_preferences_handler.PredicatedActual]) -> sklearn.ensemble.RandomForestRegressor:
+    def get_model(data: user_preferences_handler.RatingHistory) -> CalibrationModel:
         """
         Trains a model to predict the user value from the LLM provided one
         """
-        x_data = numpy.array([point.machine_rating for point in data]).reshape((-1, 1))
-        y_data = numpy.array([point.user_rating for point in data])
+        x_data = data.machine_ratings_array()
+        y_data = data.user_ratings_array()
+        has_machine_rating = ~numpy.isnan(x_data)
+        x_data = x_data[has_machine_rating].reshape((-1, 1))
+        y_data = y_data[has_machine_rating]
+        if len(x_data) == 0:
+            # A random forest can not be fitted on no data, the empty online model predicts the middle of the scale instead
+            return OnlineCalibrationModel()
+        # scikit-learn takes over a second to import, so it is only imported once a forest is actually trained
+        import sklearn.ensemble # pylint: disable=import-outside-toplevel,redefined-outer-name
         data_size = len(x_data)
         lower_limits = list(MODEL_PARAMETRES.keys())
         lower_limits.sort()
         parametres = MODEL_PARAMETRES[0]
-        for i, value in enumerate(lower_limits):
-            if value > data_size:
-                if i > 0:
-                    parametres = MODEL_PARAMETRES[i-1]
-                break
+        for lower_limit in lower_limits:
+            if lower_limit <= data_size:
+                parametres = MODEL_PARAMETRES[lower_limit]
         model = sklearn.ensemble.RandomForestRegressor(
             n_estimators=parametres["n_estimators"],       # Fewer trees to prevent overfitting + faster
             max_depth=parametres["max_depth"],           # Limit depth to avoid memorizing
             min_samples_leaf=parametres["min_samples_leaf"],    # Forces each leaf to have at least 2 samples
             random_state=RANDOM_STATE
         )
-        model.fit(x_data, y_data)
-        return model
\ No newline at end of file
+        with metrics.span("train_model"):
+            model.fit(x_data, y_data)
+        return model
@@ -0,0 +1,42 @@
+"""
+Tests of the canonical forms of the themes
+"""
+
+import pytest
+
+import theme_index
+
+@pytest.mark.parametrize("plural, singular", [
+    ("niches", "niche"),
+    ("caches", "cache"),
+    ("sizes", "size"),
+    ("churches", "church"),
+    ("boxes", "box"),
+    ("classes", "class"),
+    ("dishes", "dish"),
+    ("quizzes", "quiz"),
+    ("buzzes", "buzz"),
+    ("waltzes", "waltz"),
+    ("movies", "movie"),
+    ("analyses", "analysis"),
+    ("crises", "crisis")
+])
+def test_plural_and_singular_have_the_same_canonical_form(plural: str, singular: str):
+    index = theme_index.ThemeIndex()
+    assert index.canonical(plural) == index.canonical(singular)
+
+@pytest.mark.parametrize("spelling", ["US", "U.S.", "U.S", "USA", "usa", "United States"])
+def test_united_states_spellings_are_merged(spelling: str):
+    index = theme_index.ThemeIndex()
+    assert index.canonical(spelling) == index.canonical("United States")
+
+@pytest.mark.parametrize("theme", ["us", "Us", "what it means for us"])
+def test_the_pronoun_us_is_not_a_country(theme: str):
+    assert "united" not in theme_index.ThemeIndex().canonical(theme)
+
+def test_spellings_resolve_to_the_first_seen_name():
+    index = theme_index.ThemeIndex()
+    assert index.resolve("AI") == "AI"
+    assert index.resolve("Artificial Intelligence") == "AI"
+    assert index.resolve("Niches") == index.resolve("niche")
+    assert len(index) == 2